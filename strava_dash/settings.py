@@ -99,6 +99,22 @@ DATABASES = {
     }
 }
 
+# 缓存：排行榜、群组列表等按数据代号缓存 (strava_web/caching.py)。
+# strava_pull / strava_worker 和网站是不同进程，缓存必须能跨进程共享，默认用文件缓存；
+# 也可以通过 .env 换成 memcached/redis。LocMemCache 只适合单进程开发和测试。
+# 文件缓存的 add 不是原子操作，缓存未命中时的 single-flight（只让一个请求计算）不能保证；
+# 需要合并多个 Web worker 的同一条重查询时用 memcached/redis（它们的 add 是原子的）。
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('CACHE_LOCATION', default='/var/tmp/strava_dash_cache'),
+        'TIMEOUT': 24 * 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -162,6 +178,12 @@ STRAVA_CLIENT_SECRET = config('STRAVA_CLIENT_SECRET')
 STRAVA_AUTHORIZE_URL = 'https://www.strava.com/oauth/authorize'
 STRAVA_TOKEN_URL = 'https://www.strava.com/oauth/token'
 STRAVA_API_BASE_URL = 'https://www.strava.com/api/v3'
+# 创建 Strava 推送订阅时使用的 verify_token，webhook 验证握手时校验
+STRAVA_WEBHOOK_VERIFY_TOKEN = config('STRAVA_WEBHOOK_VERIFY_TOKEN', default='')
+# 推送订阅的 ID（创建订阅时 Strava 返回），只接受 subscription_id 与之相同的事件；未配置时拒绝所有事件
+STRAVA_WEBHOOK_SUBSCRIPTION_ID = config('STRAVA_WEBHOOK_SUBSCRIPTION_ID', default=0, cast=int)
+# 用本地活动计算 recent/ytd/all_time 统计，只在对账时调用 /athletes/{id}/stats
+STRAVA_LOCAL_TOTALS = config('STRAVA_LOCAL_TOTALS', default=False, cast=bool)
 
 AUTH_USER_MODEL = 'strava_web.CustomUser'
 AUTHENTICATION_BACKENDS = [
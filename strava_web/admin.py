@@ -3,9 +3,16 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import Group
-from .models import CustomUser, Activity, GroupApplication
+from django.db.models import Q
+from .models import CustomUser, Activity, GroupApplication, StravaApiUsage, StravaWebhookEvent, SyncJob, StravaSyncState, ActivityDailyRollup, LeaderboardEntry, LeaderboardRebuildRequest, PersonalRecord
+from .rollups import refresh_daily_rollups, get_local_date
+from .records import refresh_personal_records
+from .search import activity_name_filter
+from .caching import bump_user_data, bump_group_data
+from .utils_group import refresh_group_counts
+from .memberships import approve_applications, reject_applications
+from .leaderboards import request_leaderboard_rebuild
 from unfold.admin import ModelAdmin
-from django.utils import timezone
 
 # 自定义用户模型的 Admin
 @admin.register(CustomUser)
@@ -34,27 +41,103 @@ class CustomUserAdmin(BaseUserAdmin, ModelAdmin):
         )}),
     )
 
+    # 在后台修改用户资料或所在群组时作废相关缓存（原来的群组和新的群组都要作废）
+    def save_related(self, request, form, formsets, change):
+        old_group_ids = set(form.instance.groups.values_list('pk', flat=True)) if change else set()
+        super().save_related(request, form, formsets, change)
+        group_ids = old_group_ids | set(form.instance.groups.values_list('pk', flat=True))
+        refresh_group_counts(group_ids)
+        # 群组、性别、出生年份或启用状态变化都会影响排行榜
+        request_leaderboard_rebuild(group_ids)
+        bump_user_data(form.instance.pk)
+
+    # 删除用户时，其成员关系和申请随之级联删除，需要重新统计这些群组的成员数和待审核申请数
+    def _get_related_group_ids(self, user_ids):
+        group_ids = set(Group.objects.filter(member__in=user_ids).values_list('pk', flat=True))
+        group_ids |= set(GroupApplication.objects.filter(user_id__in=user_ids).values_list('group_id', flat=True))
+        return group_ids
+
+    def delete_model(self, request, obj):
+        group_ids = self._get_related_group_ids([obj.pk])
+        super().delete_model(request, obj)
+        refresh_group_counts(group_ids)
+        request_leaderboard_rebuild(group_ids)
+
+    def delete_queryset(self, request, queryset):
+        group_ids = self._get_related_group_ids(queryset.values('pk'))
+        super().delete_queryset(request, queryset)
+        refresh_group_counts(group_ids)
+        request_leaderboard_rebuild(group_ids)
+
 # 自定义 Group 的 Admin
 # 先取消注册默认的 Group admin
 admin.site.unregister(Group)
 
 @admin.register(Group)
 class CustomGroupAdmin(ModelAdmin):
-    list_display = ('name', 'is_open', 'has_dashboard', 'admin')
+    list_display = ('name', 'is_open', 'has_dashboard', 'admin', 'member_count', 'pending_count')
     list_filter = ('is_open', 'has_dashboard')
     search_fields = ('name',)
     # 允许在 admin 中编辑这些字段
     fields = ('name', 'is_open', 'has_dashboard', 'admin', 'description', 'announcement', 'permissions') # 确保 permissions 也在里面
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        bump_group_data(obj.pk)
+
 @admin.register(Activity)
 class ActivityAdmin(ModelAdmin):
     date_hierarchy = 'start_date'
     list_display = ('name', 'user', 'activity_type', 'workout_type', 'is_race', 'start_date_local', 'distance', 'moving_time')
     list_filter = ('activity_type', 'workout_type', 'is_race', 'start_date')
-    search_fields = ('name', 'user__username', 'strava_id')
+    search_fields = ('user__username', 'strava_id', 'name') # 只用于显示搜索框，搜索条件在 get_search_results 中构造
     raw_id_fields = ('user',) # 对于 ForeignKey 字段，使用 raw_id_fields 可以提高性能
     date_hierarchy = 'start_date_local' # 按日期分层显示
 
+    def get_search_results(self, request, queryset, search_term):
+        # 不用默认的搜索：'=strava_id' 会变成 iexact（MySQL 上是 LIKE），几个条件 OR 在同一个连接查询里也用不上各自的索引。
+        # 每个条件单独成为按主键的子查询：用户名前缀走用户名索引和 (user, start_date_local) 索引，
+        # 活动名称走全文索引，纯数字按 strava_id 唯一索引精确匹配
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        users = CustomUser.objects.filter(username__startswith=search_term)
+        condition = Q(pk__in=Activity.objects.filter(user__in=users).values('pk')) | activity_name_filter(search_term)
+        if search_term.isdigit() and int(search_term) < 2 ** 63:
+            condition |= Q(strava_id=int(search_term))
+        return queryset.filter(condition), False
+
+    # 在后台修改或删除活动时同步更新每日汇总和个人最好成绩
+    def save_model(self, request, obj, form, change):
+        old = Activity.objects.filter(pk=obj.pk).values_list('user_id', 'start_date_local', 'race_distance').first() if change else None
+        super().save_model(request, obj, form, change)
+        if old:
+            refresh_daily_rollups(old[0], [get_local_date(old[1])])
+            refresh_personal_records(old[0], [old[2]])
+        refresh_daily_rollups(obj.user_id, [get_local_date(obj.start_date_local)])
+        refresh_personal_records(obj.user_id, [obj.race_distance])
+        if old:
+            bump_user_data(old[0])
+        bump_user_data(obj.user_id)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        refresh_daily_rollups(obj.user_id, [get_local_date(obj.start_date_local)])
+        refresh_personal_records(obj.user_id, [obj.race_distance])
+        bump_user_data(obj.user_id)
+
+    def delete_queryset(self, request, queryset):
+        affected = {}
+        for user_id, start_date_local, race_distance in queryset.values_list('user_id', 'start_date_local', 'race_distance'):
+            dates, distances = affected.setdefault(user_id, (set(), set()))
+            dates.add(get_local_date(start_date_local))
+            distances.add(race_distance)
+        super().delete_queryset(request, queryset)
+        for user_id, (dates, distances) in affected.items():
+            refresh_daily_rollups(user_id, dates)
+            refresh_personal_records(user_id, distances)
+            bump_user_data(user_id)
+
 # 注册 GroupApplication
 @admin.register(GroupApplication)
 class GroupApplicationAdmin(ModelAdmin):
@@ -65,26 +148,81 @@ class GroupApplicationAdmin(ModelAdmin):
     readonly_fields = ('applied_at',) # 申请时间自动生成，不允许手动修改
     actions = ['approve_applications', 'reject_applications'] # 添加批量操作
 
+    # 在后台直接修改或删除申请时重新统计群组的待审核申请数
+    def save_model(self, request, obj, form, change):
+        old_group_id = GroupApplication.objects.filter(pk=obj.pk).values_list('group_id', flat=True).first() if change else None
+        super().save_model(request, obj, form, change)
+        refresh_group_counts({old_group_id, obj.group_id} - {None})
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        refresh_group_counts([obj.group_id])
+
+    def delete_queryset(self, request, queryset):
+        group_ids = set(queryset.values_list('group_id', flat=True))
+        super().delete_queryset(request, queryset)
+        refresh_group_counts(group_ids)
+
     def approve_applications(self, request, queryset):
-        # 批量批准申请
-        for application in queryset:
-            if application.status == 'pending':
-                application.status = 'approved'
-                application.reviewed_at = timezone.now()
-                application.reviewer = request.user
-                application.save()
-                # 将用户添加到群组
-                application.group.members.add(application.user)
+        # 批量批准申请，并将用户添加到群组
+        approve_applications(queryset, request.user)
         self.message_user(request, "选定的申请已批准。")
     approve_applications.short_description = "批准选定的申请"
 
     def reject_applications(self, request, queryset):
         # 批量拒绝申请
-        for application in queryset:
-            if application.status == 'pending':
-                application.status = 'rejected'
-                application.reviewed_at = timezone.now()
-                application.reviewer = request.user
-                application.save()
+        reject_applications(queryset, request.user)
         self.message_user(request, "选定的申请已拒绝。")
-    reject_applications.short_description = "拒绝选定的申请"
\ No newline at end of file
+    reject_applications.short_description = "拒绝选定的申请"
+
+# Strava API 额度使用情况（只读）
+@admin.register(StravaApiUsage)
+class StravaApiUsageAdmin(ModelAdmin):
+    list_display = ('short_usage', 'short_limit', 'short_window_start', 'daily_usage', 'daily_limit', 'daily_window_start', 'updated_at')
+    readonly_fields = ('short_usage', 'short_limit', 'short_window_start', 'daily_usage', 'daily_limit', 'daily_window_start', 'updated_at')
+
+@admin.register(StravaWebhookEvent)
+class StravaWebhookEventAdmin(ModelAdmin):
+    list_display = ('object_type', 'object_id', 'aspect_type', 'owner_id', 'event_time', 'received_at', 'processed_at')
+    list_filter = ('object_type', 'aspect_type')
+    search_fields = ('object_id', 'owner_id')
+
+@admin.register(SyncJob)
+class SyncJobAdmin(ModelAdmin):
+    list_display = ('user', 'kind', 'status', 'priority', 'attempts', 'next_run_at', 'lease_expires_at', 'locked_by')
+    list_filter = ('kind', 'status')
+    search_fields = ('user__username',)
+    raw_id_fields = ('user', 'event')
+
+@admin.register(StravaSyncState)
+class StravaSyncStateAdmin(ModelAdmin):
+    list_display = ('user', 'high_water_mark', 'backfill_before', 'backfill_pages', 'backfill_completed_at', 'consecutive_failures', 'last_success_at')
+    search_fields = ('user__username',)
+    raw_id_fields = ('user',)
+
+@admin.register(ActivityDailyRollup)
+class ActivityDailyRollupAdmin(ModelAdmin):
+    list_display = ('user', 'date', 'count', 'distance', 'moving_time', 'elevation_gain')
+    search_fields = ('user__username',)
+    raw_id_fields = ('user',)
+    date_hierarchy = 'date'
+
+@admin.register(LeaderboardEntry)
+class LeaderboardEntryAdmin(ModelAdmin):
+    list_display = ('group', 'period', 'gender', 'age', 'rank_type', 'rank', 'user', 'built_at')
+    list_filter = ('period', 'gender', 'age', 'rank_type')
+    search_fields = ('group__name', 'user__username')
+    raw_id_fields = ('group', 'user')
+
+@admin.register(LeaderboardRebuildRequest)
+class LeaderboardRebuildRequestAdmin(ModelAdmin):
+    list_display = ('group', 'requested_at', 'built_at')
+    search_fields = ('group__name',)
+    raw_id_fields = ('group',)
+
+@admin.register(PersonalRecord)
+class PersonalRecordAdmin(ModelAdmin):
+    list_display = ('user', 'race_distance', 'chip_time', 'date', 'activity')
+    list_filter = ('race_distance',)
+    search_fields = ('user__username',)
+    raw_id_fields = ('user', 'activity')
@@ -1,6 +1,35 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+GROUP_COUNT_COLUMNS = {'member_count', 'pending_count'}
+
+def has_group_count_columns(connection):
+    # member_count / pending_count 由 add_to_class 加到 auth.Group 上，列由 auth 应用的迁移添加
+    with connection.cursor() as cursor:
+        columns = {column.name for column in connection.introspection.get_table_description(cursor, 'auth_group')}
+    return GROUP_COUNT_COLUMNS <= columns
+
+def repair_group_counts(sender, using, plan=None, **kwargs):
+    """
+    0026_backfill_group_counts 排在添加计数列的 auth 迁移之前时会跳过回填。
+    本次 migrate 运行了 auth 的迁移或 0026，且计数列已经存在时，在这里重新统计所有群组，不用再手动运行 repair_group_counts。
+    """
+    if not any(
+        migration.app_label == 'auth' or (migration.app_label, migration.name) == ('strava_web', '0026_backfill_group_counts')
+        for migration, backwards in plan or [] if not backwards
+    ):
+        return
+    if not has_group_count_columns(connections[using]):
+        return
+    from django.contrib.auth.models import Group
+    from .utils_group import refresh_group_counts
+    refresh_group_counts(Group.objects.using(using).values_list('pk', flat=True))
 
 
 class StravaWebConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'strava_web'
+
+    def ready(self):
+        post_migrate.connect(repair_group_counts, sender=self)
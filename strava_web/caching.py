@@ -0,0 +1,99 @@
+# strava_web/caching.py
+import hashlib
+import json
+import time
+import uuid
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import transaction
+
+CACHE_PREFIX = 'strava_web'
+CACHE_TIMEOUT = 24 * 3600 # 数据变化时换代，不靠过期；旧代的缓存没人再读，一天后自然清掉
+LOCK_TIMEOUT = 60 # 计算中的请求异常退出时，锁最多保留这么久
+WAIT_TIMEOUT = 10 # 等待其他请求算好同一个值的最长时间
+WAIT_INTERVAL = 0.05
+
+_MISSING = object()
+
+def _generation_key(scope, scope_id):
+    return f'{CACHE_PREFIX}:gen:{scope}:{scope_id}'
+
+def get_generation(scope, scope_id=0):
+    """
+    取数据代号。scope: 'user' 用户的活动和资料，'group' 群组成员及其数据，
+    'groups' 群组列表（成员、申请），'races' 全站比赛数据。
+    代号丢失（缓存重启或被清理）时取一个新的随机值，不会和丢失前的旧缓存撞上。
+    """
+    key = _generation_key(scope, scope_id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(key, generation, None):
+            generation = cache.get(key) or generation
+    return generation
+
+def bump_generation(scope, scope_id=0):
+    # 事务提交后再换代，避免其他请求在提交前读到旧数据又按新代号写回缓存
+    key = _generation_key(scope, scope_id)
+    transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, None))
+
+def bump_user_data(user_id):
+    """
+    用户的活动或资料（性别、出生年份）变化后调用：作废该用户、所在群组和全站比赛的缓存。
+    """
+    bump_generation('user', user_id)
+    bump_generation('races')
+    for group_id in Group.objects.filter(member=user_id).values_list('pk', flat=True):
+        bump_generation('group', group_id)
+
+def bump_group_data(group_id):
+    """
+    群组成员、申请或群组信息变化后调用。
+    """
+    bump_generation('group', group_id)
+    bump_generation('groups')
+
+def make_cache_key(name, generations, params):
+    """
+    缓存键 = 名称 + 所依赖数据的代号 + 查询参数，参数取摘要，避免超过 memcached 的键长限制。
+    generations 是 [(scope, scope_id), ...]。
+    """
+    parts = [get_generation(scope, scope_id) for scope, scope_id in generations]
+    digest = hashlib.md5(json.dumps([parts, params], sort_keys=True, default=str).encode()).hexdigest()
+    return f'{CACHE_PREFIX}:{name}:{digest}'
+
+def get_or_compute(name, generations, params, compute, timeout=CACHE_TIMEOUT):
+    """
+    读缓存，未命中时调用 compute() 计算并写入。
+    同一个键同时只有一个请求计算（single-flight）：其他请求等它写入缓存后直接读取，
+    同步结束后大量请求同时未命中时不会同时跑同一条重查询。等待超时或计算者失败时自己计算。
+    计算锁靠 cache.add，只有 add 是原子操作的后端才能保证只有一个计算者：memcached / redis 跨进程有效，
+    LocMemCache 在同一进程内有效。默认的 FileBasedCache 的 add 是先检查再写文件，不是原子的，
+    同时未命中的请求（不论是否同一进程）可能都拿到锁、各自计算一次；结果仍然正确，只是合并不了，
+    需要合并时换成 memcached / redis。
+    """
+    key = make_cache_key(name, generations, params)
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = compute()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if cache.get(lock_key) is None:
+            # 锁已释放：要么刚写入缓存，要么计算者失败
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            break
+    return compute()
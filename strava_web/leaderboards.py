@@ -0,0 +1,315 @@
+# strava_web/leaderboards.py
+import datetime
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import transaction, connection
+from django.db.models import F, Q, ExpressionWrapper, fields, Window
+from django.db.models.functions import Cast, Rank, RowNumber
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from strava_web.models import LeaderboardEntry, LeaderboardRebuildRequest
+from strava_web.rollups import get_rollup_totals, get_rollup_total_subquery
+
+User = get_user_model()
+
+AGE_RANGES = {
+    'all': (_('All Ages'), (None, None)),
+    '<40': (_('<40 years old'), (None, 39)),
+    '40-44': (_('40-44 years old'), (40, 44)),
+    '45-49': (_('45-49 years old'), (45, 49)),
+    '50-54': (_('50-54 years old'), (50, 54)),
+    '55-59': (_('55-59 years old'), (55, 59)),
+    '60-64': (_('60-64 years old'), (60, 64)),
+    '65-69': (_('65-69 years old'), (65, 69)),
+    '70-74': (_('70-74 years old'), (70, 74)),
+    '75-79': (_('75-79 years old'), (75, 79)),
+    '>=80': (_('>=80 years old'), (80, None)),
+}
+
+PERIODS = {
+    'weekly': _('This Week'),
+    'recent': _('4 Weeks'),
+    'month': _('This Month'),
+    'quarter': _('This Quarter'),
+    'ytd': _('YTD'),
+    'all_time': _('All Time'),
+}
+
+def get_rollup_period_range(period, today):
+    """
+    不在 CustomUser 统计字段里的时间段，从每日汇总表合计。返回 (开始日期, 结束日期)，
+    其他时间段返回 None。
+    """
+    if period == 'month':
+        return today.replace(day=1), today
+    if period == 'quarter':
+        return today.replace(month=(today.month - 1) // 3 * 3 + 1, day=1), today
+    return None
+
+RANK_TYPES = {
+    'distance': _('Distance'),
+    'moving_time': _('Moving time'),
+    'avg_pace': _('Average Pace'),
+    'elevation_gain': _('Elevation Gain'),
+}
+
+GENDERS = {'all': _('All Genders'), 'M': _('Male'), 'F': _('Female')}
+
+def get_ranking_field_map(period):
+    return {
+        'distance': f'{period}_run_distance',
+        'moving_time': f'{period}_run_moving_time',
+        'avg_pace': f'{period}_run_distance',
+        'elevation_gain': f'{period}_run_elevation_gain',
+    }
+
+def get_age_range_key(birth_year, current_year):
+    # 用户所在的年龄段（不含 'all'），没有出生年份时返回 None
+    if not birth_year:
+        return None
+    age = current_year - birth_year
+    for key, (_label, (start_age, end_age)) in AGE_RANGES.items():
+        if key == 'all':
+            continue
+        if (start_age is None or age >= start_age) and (end_age is None or age <= end_age):
+            return key
+    return None
+
+def get_ranked_members(group, period, gender, age_range_key, rank_type):
+    """
+    群组成员按 period / rank_type 排名的查询集，带窗口函数计算的 member_rank（并列同名次）
+    和 member_position（连续编号）。
+    """
+    ranking_field_map = get_ranking_field_map(period)
+    ranking_field = ranking_field_map.get(rank_type)
+    ranking_field2 = None
+
+    if rank_type == 'avg_pace':
+        ranking_field2 = f'{period}_run_moving_time'
+
+    group_members = User.objects.filter(groups=group, is_active=True)
+    rollup_range = get_rollup_period_range(period, datetime.date.today())
+    if rollup_range:
+        # 按每日汇总表合计，字段名与 CustomUser 的统计字段一致，后面的排名逻辑不用区分
+        group_members = group_members.annotate(**{
+            f'{period}_run_{column}': get_rollup_total_subquery(column, *rollup_range)
+            for column in ('distance', 'moving_time', 'elevation_gain')
+        })
+    if ranking_field2:
+        # 没有距离的用户无法计算配速，不参与排名
+        group_members = group_members.exclude(**{ranking_field2: None}).exclude(**{ranking_field: 0})
+
+    if gender != 'all':
+        group_members = group_members.filter(gender=gender)
+
+    if age_range_key != 'all' and age_range_key in AGE_RANGES:
+        group_members = group_members.exclude(Q(birth_year__isnull=True) | Q(birth_year=0))
+        start_age, end_age = AGE_RANGES[age_range_key][1]
+        current_year = datetime.date.today().year
+        q = Q()
+        if start_age is not None:
+            q &= Q(birth_year__lte=current_year - start_age)
+        if end_age is not None:
+            q &= Q(birth_year__gte=current_year - end_age)
+        group_members = group_members.filter(q)
+
+    if rank_type == 'avg_pace':
+        group_members = group_members.annotate(
+            avg_pace_value=ExpressionWrapper(
+                Cast(F(ranking_field2), output_field=fields.FloatField()) / Cast(F(ranking_field), output_field=fields.FloatField()),
+                output_field=fields.FloatField()
+            )
+        )
+        ranking_order = F('avg_pace_value').asc(nulls_last=True)
+    else:
+        ranking_order = F(ranking_field).desc(nulls_last=True)
+
+    # 名次在数据库中用窗口函数计算：member_rank 并列同名次，member_position 用于确定所在页
+    return group_members.annotate(
+        member_rank=Window(expression=Rank(), order_by=ranking_order),
+        member_position=Window(expression=RowNumber(), order_by=[ranking_order, F('pk').asc()]),
+    ).order_by(ranking_order, 'pk')
+
+def _get_period_values(members, today):
+    """
+    一次取出群组成员每个周期的 (距离, 运动时间, 爬升)。返回 (成员列表 [(user_id, gender, birth_year)],
+    {period: {user_id: (distance, moving_time, elevation_gain)}})。
+    CustomUser 上的统计字段和成员资料一条查询取完；月/季度各用一条分组查询从每日汇总表合计，没有汇总行的成员为 None。
+    """
+    user_periods = [period for period in PERIODS if not get_rollup_period_range(period, today)]
+    stat_fields = []
+    for period in user_periods:
+        field_map = get_ranking_field_map(period)
+        stat_fields += [field_map['distance'], field_map['moving_time'], field_map['elevation_gain']]
+    member_list = []
+    values = {period: {} for period in PERIODS}
+    for row in members.values_list('pk', 'gender', 'birth_year', *stat_fields):
+        member_list.append(row[:3])
+        for index, period in enumerate(user_periods):
+            values[period][row[0]] = row[3 + index * 3:6 + index * 3]
+    for period in PERIODS:
+        rollup_range = get_rollup_period_range(period, today)
+        if not rollup_range:
+            continue
+        totals = {
+            row['user_id']: (row['total_distance'], row['total_moving_time'], row['total_elevation_gain'])
+            for row in get_rollup_totals(*rollup_range, users=members.values('pk'))
+        }
+        values[period] = {user_id: totals.get(user_id, (None, None, None)) for user_id, _gender, _birth_year in member_list}
+    return member_list, values
+
+def _rank_members(values, user_ids, rank_type):
+    """
+    按 rank_type 给 user_ids 排名，与 get_ranked_members 的结果一致：空值排在最后，
+    并列同名次（rank），position 按 (成绩, 用户 id) 连续编号。返回 [(user_id, rank, position)]。
+    """
+    if rank_type == 'avg_pace':
+        # 没有运动时间或距离为 0 的用户无法计算配速，不参与排名；配速越小越靠前
+        candidates = [user_id for user_id in user_ids if values[user_id][1] is not None and values[user_id][0] != 0]
+        def score(user_id):
+            distance, moving_time, _elevation_gain = values[user_id]
+            return None if distance is None else moving_time / distance
+        sign = 1
+    else:
+        column = {'distance': 0, 'moving_time': 1, 'elevation_gain': 2}[rank_type]
+        candidates = user_ids
+        def score(user_id):
+            return values[user_id][column]
+        sign = -1
+    scored = sorted(
+        ((score(user_id), user_id) for user_id in candidates),
+        key=lambda item: (item[0] is None, 0 if item[0] is None else sign * item[0], item[1]),
+    )
+    ranked = []
+    rank = 0
+    for position, (value, user_id) in enumerate(scored, start=1):
+        if position == 1 or value != scored[position - 2][0]:
+            rank = position
+        ranked.append((user_id, rank, position))
+    return ranked
+
+def rebuild_group_leaderboard(group):
+    """
+    重建一个群组全部筛选组合的排行榜，返回写入的行数。
+    每个周期的成员数据只查询一次，各性别/年龄段/排名类型的名次在 Python 中计算；
+    只生成有成员的性别/年龄段组合，整个群组在一个事务中替换，页面不会读到一半的结果。
+    """
+    today = datetime.date.today()
+    member_list, period_values = _get_period_values(User.objects.filter(groups=group, is_active=True).order_by(), today)
+    member_groups = {}
+    for user_id, gender, birth_year in member_list:
+        # 成员所在的 (性别, 年龄段) 组合，'all' 包含所有成员
+        age_key = get_age_range_key(birth_year, today.year)
+        genders = ['all'] + ([gender] if gender in GENDERS and gender != 'all' else [])
+        age_keys = ['all'] + ([age_key] if age_key else [])
+        for gender_key in genders:
+            for age in age_keys:
+                member_groups.setdefault((gender_key, age), []).append(user_id)
+
+    created = 0
+    with transaction.atomic():
+        LeaderboardEntry.objects.filter(group=group).delete()
+        for period in PERIODS:
+            values = period_values[period]
+            rollup_range = get_rollup_period_range(period, today)
+            period_start = rollup_range[0] if rollup_range else None
+            entries = []
+            for (gender, age_key), user_ids in member_groups.items():
+                for rank_type in RANK_TYPES:
+                    for user_id, rank, position in _rank_members(values, user_ids, rank_type):
+                        distance, moving_time, elevation_gain = values[user_id]
+                        entries.append(LeaderboardEntry(
+                            group=group, period=period, gender=gender, age=age_key, rank_type=rank_type,
+                            user_id=user_id, rank=rank, position=position, period_start=period_start,
+                            distance=distance or 0, moving_time=moving_time or 0, elevation_gain=elevation_gain or 0,
+                        ))
+            LeaderboardEntry.objects.bulk_create(entries, batch_size=1000)
+            created += len(entries)
+    return created
+
+def request_leaderboard_rebuild(group_ids):
+    """
+    登记需要重建排行榜的群组，不在当前请求里重建。已登记的群组只更新登记时间，
+    重建期间新的登记会在本次重建后再重建一次。
+    """
+    requested_at = timezone.now()
+    LeaderboardRebuildRequest.objects.bulk_create(
+        [LeaderboardRebuildRequest(group_id=group_id, requested_at=requested_at) for group_id in set(group_ids)],
+        update_conflicts=True, update_fields=['requested_at'],
+        # MySQL 的 ON DUPLICATE KEY UPDATE 不能指定冲突字段，其他数据库需要指定
+        unique_fields=['group'] if connection.features.supports_update_conflicts_with_target else None,
+    )
+
+def request_leaderboard_rebuild_for_user(user_id):
+    # 用户的性别、出生年份或启用状态变化：重建其所在的全部群组
+    request_leaderboard_rebuild(Group.objects.filter(member=user_id).values_list('pk', flat=True))
+
+def request_leaderboard_rebuild_for_users(user_ids):
+    # 一批用户的活动数据有变化：登记其所在的群组，由 rebuild_requested_leaderboards 合并重建
+    if user_ids:
+        request_leaderboard_rebuild(Group.objects.filter(member__in=user_ids).values_list('pk', flat=True).distinct())
+
+def request_stale_period_leaderboards():
+    """
+    月/季度排行榜从每日汇总表合计，进入新的月份或季度后同步不会让旧的合计过期：
+    登记合计起始日期早于当前周期开始日期的群组。由每小时运行的 rollover_weekly_stats 调用，返回登记的群组数。
+    """
+    today = datetime.date.today()
+    stale = Q(pk__in=[])
+    for period in PERIODS:
+        rollup_range = get_rollup_period_range(period, today)
+        if rollup_range:
+            # 没有记录起始日期的是旧版本生成的排行榜，同样重建
+            stale |= Q(period=period) & (Q(period_start__isnull=True) | Q(period_start__lt=rollup_range[0]))
+    group_ids = set(LeaderboardEntry.objects.filter(stale).values_list('group_id', flat=True).distinct())
+    request_leaderboard_rebuild(group_ids)
+    return len(group_ids)
+
+def get_rebuild_delay_seconds(delay_seconds=None):
+    if delay_seconds is None:
+        delay_seconds = getattr(settings, 'LEADERBOARD_REBUILD_DELAY_SECONDS', 60)
+    return delay_seconds
+
+def rebuild_requested_leaderboards(stdout, delay_seconds=None):
+    """
+    重建已登记的群组。距上次重建不到 delay_seconds（默认 LEADERBOARD_REBUILD_DELAY_SECONDS）的群组留到以后，
+    这段时间内的多次登记合并为一次重建，活跃的群组不会在 worker 的每批任务后都重建一遍。
+    每个登记行在重建期间被锁住（SKIP LOCKED），多个进程不会重建同一个群组。返回重建的群组数。
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=get_rebuild_delay_seconds(delay_seconds))
+    due = Q(built_at__isnull=True) | Q(requested_at__gt=F('built_at'), built_at__lte=cutoff)
+    count = 0
+    for group_id in LeaderboardRebuildRequest.objects.filter(due).values_list('group_id', flat=True):
+        with transaction.atomic():
+            request = LeaderboardRebuildRequest.objects.select_for_update(skip_locked=True).filter(due, group_id=group_id).first()
+            if request is None:
+                continue
+            # 记录开始重建的时间：重建期间的新登记晚于它，下次还会重建
+            built_at = timezone.now()
+            created = rebuild_group_leaderboard(request.group)
+            LeaderboardRebuildRequest.objects.filter(group_id=group_id).update(built_at=built_at)
+        count += 1
+        stdout.write(f"Rebuilt requested leaderboard for group {request.group.name}: {created} entries.")
+    return count
+
+def rebuild_leaderboards(stdout, groups=None):
+    """
+    重建 groups（默认全部群组）的排行榜。返回重建的群组数。
+    """
+    if groups is None:
+        groups = Group.objects.all()
+    count = 0
+    for group in groups.order_by('pk'):
+        created = rebuild_group_leaderboard(group)
+        count += 1
+        stdout.write(f"Rebuilt leaderboard for group {group.name}: {created} entries.")
+    return count
+
+def rebuild_leaderboards_for_users(user_ids, stdout):
+    """
+    一批用户同步完后，只重建这些用户所在的群组。
+    """
+    if not user_ids:
+        return 0
+    return rebuild_leaderboards(stdout, Group.objects.filter(member__in=user_ids).distinct())
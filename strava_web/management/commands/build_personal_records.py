@@ -0,0 +1,34 @@
+# strava_app/management/commands/build_personal_records.py
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+from strava_web.records import rebuild_personal_records
+from datetime import datetime
+
+User = get_user_model()
+
+class Command(BaseCommand):
+    help = 'Builds (or rebuilds) the personal record (best race time per distance) table from existing activities.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user_id',
+            type=int,
+            help='Optional: Rebuild personal records for a specific user ID.',
+        )
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=500,
+            help='Optional: Number of users processed per batch.',
+        )
+
+    def handle(self, *args, **options):
+        user_id = options['user_id']
+        self.stdout.write(self.style.SUCCESS(f'Start building personal records at: {datetime.now()}'))
+        users = None
+        if user_id:
+            users = User.objects.filter(pk=user_id)
+            if not users.exists():
+                raise CommandError(f'User with ID "{user_id}" does not exist.')
+        rebuild_personal_records(self.stdout, users, options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Personal records built.'))
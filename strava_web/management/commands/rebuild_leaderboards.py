@@ -0,0 +1,35 @@
+# strava_app/management/commands/rebuild_leaderboards.py
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import Group
+from strava_web.leaderboards import rebuild_leaderboards, rebuild_requested_leaderboards
+from datetime import datetime
+
+class Command(BaseCommand):
+    help = 'Rebuilds the precomputed group leaderboards (strava_pull and strava_worker rebuild affected groups automatically).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--group_id',
+            type=int,
+            help='Optional: Rebuild the leaderboard of a specific group ID.',
+        )
+        parser.add_argument(
+            '--requested',
+            action="store_true",
+            help='Only rebuild groups whose leaderboard was requested after membership or profile changes.',
+        )
+
+    def handle(self, *args, **options):
+        group_id = options['group_id']
+        self.stdout.write(self.style.SUCCESS(f'Start rebuilding leaderboards at: {datetime.now()}'))
+        if options['requested']:
+            count = rebuild_requested_leaderboards(self.stdout, delay_seconds=0)
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt leaderboards for {count} groups.'))
+            return
+        groups = None
+        if group_id:
+            groups = Group.objects.filter(pk=group_id)
+            if not groups.exists():
+                raise CommandError(f'Group with ID "{group_id}" does not exist.')
+        count = rebuild_leaderboards(self.stdout, groups)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt leaderboards for {count} groups.'))
@@ -0,0 +1,39 @@
+# strava_app/management/commands/recompute_stats.py
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+from strava_web.services import recompute_stats
+from strava_web.leaderboards import rebuild_leaderboards, rebuild_leaderboards_for_users
+from datetime import datetime
+
+User = get_user_model()
+
+class Command(BaseCommand):
+    help = 'Recomputes weekly and 4-week stats for all users from local activities (no Strava API calls).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user_id',
+            type=int,
+            help='Optional: Recompute stats for a specific user ID.',
+        )
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=1000,
+            help='Optional: Number of users per bulk update.',
+        )
+
+    def handle(self, *args, **options):
+        user_id = options['user_id']
+        self.stdout.write(self.style.SUCCESS(f'Start recomputing stats at: {datetime.now()}'))
+        users = None
+        if user_id:
+            users = User.objects.filter(pk=user_id)
+            if not users.exists():
+                raise CommandError(f'User with ID "{user_id}" does not exist.')
+        if recompute_stats(self.stdout, users, options['chunk_size']):
+            if users is None:
+                rebuild_leaderboards(self.stdout)
+            else:
+                rebuild_leaderboards_for_users([user_id], self.stdout)
+        self.stdout.write(self.style.SUCCESS('Stats recompute completed.'))
@@ -0,0 +1,33 @@
+# strava_app/management/commands/repair_group_counts.py
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import Group
+from strava_web.utils_group import refresh_group_counts
+from datetime import datetime
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored member and pending application counts of groups.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--group_id',
+            type=int,
+            help='Optional: Repair counts for a specific group ID.',
+        )
+
+    def handle(self, *args, **options):
+        group_id = options['group_id']
+        self.stdout.write(self.style.SUCCESS(f'Start repairing group counts at: {datetime.now()}'))
+        groups = Group.objects.all()
+        if group_id:
+            groups = groups.filter(pk=group_id)
+            if not groups.exists():
+                raise CommandError(f'Group with ID "{group_id}" does not exist.')
+        before = dict((pk, (members, pending)) for pk, members, pending in groups.values_list('pk', 'member_count', 'pending_count'))
+        refresh_group_counts(before.keys())
+        repaired = 0
+        for pk, name, members, pending in groups.values_list('pk', 'name', 'member_count', 'pending_count'):
+            if before.get(pk) != (members, pending):
+                repaired += 1
+                old_members, old_pending = before[pk]
+                self.stdout.write(f'  {name}: members {old_members} -> {members}, pending {old_pending} -> {pending}')
+        self.stdout.write(self.style.SUCCESS(f'Group counts repaired: {repaired} of {len(before)} groups changed.'))
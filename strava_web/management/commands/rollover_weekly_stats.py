@@ -0,0 +1,27 @@
+# strava_app/management/commands/rollover_weekly_stats.py
+from django.core.management.base import BaseCommand
+from strava_web.services import rollover_weekly_stats
+from strava_web.leaderboards import rebuild_leaderboards, request_stale_period_leaderboards, rebuild_requested_leaderboards
+from datetime import datetime
+
+class Command(BaseCommand):
+    help = ("Moves weekly stats to the new week for users whose local Monday has started (no Strava API calls), "
+            "and rebuilds month/quarter leaderboards once a new month or quarter starts. "
+            "Run it hourly so every timezone rolls over shortly after its own week boundary.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=1000,
+            help='Optional: Number of users per bulk update.',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS(f'Start weekly stats rollover at: {datetime.now()}'))
+        if rollover_weekly_stats(self.stdout, options['chunk_size']):
+            rebuild_leaderboards(self.stdout)
+        elif request_stale_period_leaderboards():
+            # 进入新的月份或季度：月/季度排行榜的合计还是上一个周期的
+            rebuild_requested_leaderboards(self.stdout, delay_seconds=0)
+        self.stdout.write(self.style.SUCCESS('Weekly stats rollover completed.'))
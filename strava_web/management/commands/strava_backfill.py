@@ -0,0 +1,59 @@
+# strava_app/management/commands/strava_backfill.py
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+from strava_web.services import backfill_strava_history
+from strava_web.rate_limit import StravaRateLimitExceeded
+from datetime import datetime
+
+User = get_user_model()
+
+class Command(BaseCommand):
+    help = 'Backfills the full Strava activity history in checkpointed chunks; re-running resumes where it stopped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user_id',
+            type=int,
+            help='Optional: Backfill a specific user ID.',
+        )
+        parser.add_argument(
+            '--pages',
+            type=int,
+            default=None,
+            help='Optional: Maximum pages (200 activities each) per user in this run.',
+        )
+        parser.add_argument(
+            '--restart',
+            action="store_true",
+            help='Discard the saved backfill progress and start again from the newest activity.',
+        )
+
+    def handle(self, *args, **options):
+        user_id = options['user_id']
+        self.stdout.write(self.style.SUCCESS(f'Start the backfill process at: {datetime.now()}'))
+        if user_id:
+            try:
+                users = [User.objects.get(pk=user_id)]
+            except User.DoesNotExist:
+                raise CommandError(f'User with ID "{user_id}" does not exist.')
+        else:
+            users = User.objects.filter(strava_id__isnull=False).exclude(
+                sync_state__backfill_completed_at__isnull=False).iterator()
+
+        for user in users:
+            if options['restart'] and hasattr(user, 'sync_state'):
+                user.sync_state.backfill_before = None
+                user.sync_state.backfill_pages = 0
+                user.sync_state.backfill_completed_at = None
+                user.sync_state.save(update_fields=['backfill_before', 'backfill_pages', 'backfill_completed_at', 'updated_at'])
+            try:
+                self.stdout.write(f'Backfilling user: {user.username} (Strava ID: {user.strava_id})...')
+                pages = backfill_strava_history(user, self.stdout, options['pages'])
+                self.stdout.write(self.style.SUCCESS(f'Backfilled {pages} pages for {user.username}.'))
+            except StravaRateLimitExceeded as e:
+                self.stdout.write(self.style.ERROR(f'Rate limit reached, progress saved: {e}'))
+                break
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f'Failed to backfill {user.username}, progress saved: {e}'))
+
+        self.stdout.write(self.style.SUCCESS('Strava backfill completed.'))
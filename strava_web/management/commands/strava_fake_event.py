@@ -0,0 +1,92 @@
+# strava_app/management/commands/strava_fake_event.py
+import time
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+class Command(BaseCommand):
+    help = 'Posts a fake Strava webhook event (or the subscription validation handshake) to a local server for testing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            default='http://127.0.0.1:8000/strava_dash/webhook/strava/',
+            help='Webhook URL of the running server.',
+        )
+        parser.add_argument(
+            '--validate',
+            action="store_true",
+            help='Send the subscription validation handshake instead of an event.',
+        )
+        parser.add_argument(
+            '--object_type',
+            default='activity',
+            choices=['activity', 'athlete'],
+            help='Event object type.',
+        )
+        parser.add_argument(
+            '--aspect_type',
+            default='create',
+            choices=['create', 'update', 'delete'],
+            help='Event aspect type.',
+        )
+        parser.add_argument(
+            '--object_id',
+            type=int,
+            default=0,
+            help='Strava activity ID (or athlete ID for athlete events).',
+        )
+        parser.add_argument(
+            '--owner_id',
+            type=int,
+            required=False,
+            help='Strava athlete ID of the owner.',
+        )
+        parser.add_argument(
+            '--deauthorize',
+            action="store_true",
+            help='Send an athlete deauthorization event for owner_id.',
+        )
+
+    def handle(self, *args, **options):
+        url = options['url']
+        if options['validate']:
+            challenge = f'challenge-{int(time.time())}'
+            response = requests.get(url, params={
+                'hub.mode': 'subscribe',
+                'hub.challenge': challenge,
+                'hub.verify_token': settings.STRAVA_WEBHOOK_VERIFY_TOKEN,
+            }, timeout=10)
+            self.stdout.write(f'{response.status_code} {response.text}')
+            if response.status_code != 200 or response.json().get('hub.challenge') != challenge:
+                raise CommandError('Subscription validation failed.')
+            self.stdout.write(self.style.SUCCESS('Subscription validation succeeded.'))
+            return
+
+        owner_id = options['owner_id']
+        if not owner_id:
+            raise CommandError('--owner_id is required for events.')
+        if options['deauthorize']:
+            event = {
+                'object_type': 'athlete',
+                'object_id': owner_id,
+                'aspect_type': 'update',
+                'updates': {'authorized': 'false'},
+            }
+        else:
+            event = {
+                'object_type': options['object_type'],
+                'object_id': options['object_id'],
+                'aspect_type': options['aspect_type'],
+                'updates': {},
+            }
+        event.update({
+            'owner_id': owner_id,
+            'subscription_id': settings.STRAVA_WEBHOOK_SUBSCRIPTION_ID,
+            'event_time': int(time.time()),
+        })
+        response = requests.post(url, json=event, timeout=10)
+        self.stdout.write(f'{response.status_code} {event}')
+        if response.status_code != 200:
+            raise CommandError('Webhook rejected the event.')
+        self.stdout.write(self.style.SUCCESS('Event posted.'))
@@ -1,11 +1,19 @@
 # strava_app/management/commands/strava_pull.py
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth import get_user_model
-from strava_web.services import sync_strava_data_for_user
+from strava_web.services import sync_strava_data_for_user, StravaSyncError
+from strava_web.rate_limit import StravaRateLimitExceeded
+from strava_web.strava_client import strava_client
+from strava_web.sync_queue import enqueue_users_sync
+from strava_web.tokens import renew_expiring_tokens
+from strava_web.leaderboards import request_leaderboard_rebuild_for_users, rebuild_requested_leaderboards
 from django.conf import settings
 from django.utils import timezone
+from django.db import close_old_connections, connection
 from datetime import timedelta, datetime
 from django.db.models import Q
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import time
 
 User = get_user_model()
@@ -30,11 +38,62 @@ class Command(BaseCommand):
             action="store_true",
             help='Force update.',
         )
+        parser.add_argument(
+            '--enqueue',
+            action="store_true",
+            help='Only add sync jobs for due users to the queue; strava_worker runs them.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Optional: Number of users to sync concurrently (default 1).',
+        )
+
+    def add_counts(self, user, counts):
+        with self.counts_lock:
+            for k, v in counts.items():
+                self.activity_counts[k] += v
+            if counts['inserted'] or counts['updated']:
+                self.changed_user_ids.add(user.pk)
+
+    def sync_user(self, user, days):
+        """
+        同步单个用户，异常在这里捕获，保证一个用户失败不会影响其他用户。
+        返回 None 表示成功，否则返回错误信息。
+        """
+        try:
+            self.stdout.write(f'Syncing data for user: {user.username} (Strava ID: {user.strava_id})...')
+            counts = sync_strava_data_for_user(user, days, self.stdout)
+            self.add_counts(user, counts)
+            self.stdout.write(self.style.SUCCESS(f'Successfully synced data for {user.username}.'))
+            return None
+        except StravaSyncError as e:
+            # 失败前已经写入的活动也要计入统计、重建排行榜
+            self.add_counts(user, e.counts)
+            self.stdout.write(self.style.ERROR(f'Failed to sync data for {user.username}: {e}'))
+            return str(e)
+        except StravaRateLimitExceeded as e:
+            self.rate_limited = True
+            self.stdout.write(self.style.ERROR(f'Rate limit reached while syncing {user.username}: {e}'))
+            return str(e)
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'Failed to sync data for {user.username}: {e}'))
+            return str(e)
+
+    def sync_user_in_worker(self, user, days):
+        # 每个工作线程使用自己的数据库连接，任务结束后关闭，避免连接泄漏
+        close_old_connections()
+        try:
+            return self.sync_user(user, days)
+        finally:
+            connection.close()
 
     def handle(self, *args, **options):
         user_id = options['user_id']
         days = options['days']
         force = options['force']
+        workers = max(1, options['workers'])
         self.stdout.write(self.style.SUCCESS(f'Start the data pulling process at: {datetime.now()}'))
         if user_id:
             try:
@@ -49,22 +108,76 @@ class Command(BaseCommand):
             else:
                 sync_interval_seconds = getattr(settings, 'STRAVA_SYNC_INTERVAL_SECONDS', 3600)
             time_threshold = timezone.now() - timedelta(seconds=sync_interval_seconds)
-            users_to_sync = User.objects.filter(strava_id__isnull=False
-                ).filter(Q(last_strava_sync__isnull=True) | Q(last_strava_sync__lt=time_threshold))
+            users_to_sync = list(User.objects.filter(strava_id__isnull=False
+                ).filter(Q(last_strava_sync__isnull=True) | Q(last_strava_sync__lt=time_threshold)))
             self.stdout.write(self.style.SUCCESS('Attempting to sync data for all connected Strava users.'))
         if not users_to_sync:
             self.stdout.write(self.style.WARNING('No Strava connected users found to sync.'))
             return
-        for user in users_to_sync:
-            try:
-                self.stdout.write(f'Syncing data for user: {user.username} (Strava ID: {user.strava_id})...')
-                sync_strava_data_for_user(user, days, self.stdout)
-                self.stdout.write(self.style.SUCCESS(f'Successfully synced data for {user.username}.'))
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f'Failed to sync data for {user.username}: {e}'))
+        if options['enqueue']:
+            queued = enqueue_users_sync(users_to_sync)
+            self.stdout.write(self.style.SUCCESS(
+                f'Queued {queued} sync jobs ({len(users_to_sync) - queued} users already in the queue).'))
+            return
+
+        start_time = time.monotonic()
+        failed = {}
+        skipped = 0
+        # Strava API 的速率限制由 rate_limit.rate_limiter 统一控制，日额度用完时停止本次同步
+        self.rate_limited = False
+        self.counts_lock = threading.Lock()
+        self.activity_counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        self.changed_user_ids = set()
+        # 同步前先批量刷新即将过期的令牌，同步过程中不再刷新
+        try:
+            renew_expiring_tokens(users_to_sync, self.stdout)
+        except StravaRateLimitExceeded as e:
+            self.stdout.write(self.style.ERROR(f'Rate limit reached while renewing tokens: {e}'))
+            return
+        if workers == 1:
+            for index, user in enumerate(users_to_sync):
+                error = self.sync_user(user, days)
+                if error:
+                    failed[user.username] = error
+                if self.rate_limited:
+                    skipped = len(users_to_sync) - index - 1
+                    break
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Syncing {len(users_to_sync)} users with {workers} workers.'))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self.sync_user_in_worker, user, days): user for user in users_to_sync}
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        skipped += 1
+                        continue
+                    error = future.result()
+                    if error:
+                        failed[futures[future].username] = error
+                    if self.rate_limited:
+                        # 取消尚未开始的用户，正在同步的用户会自行结束
+                        for pending in futures:
+                            pending.cancel()
+
+        # 只重建数据有变化的用户所在群组，以及成员变化后登记需要重建的群组的排行榜
+        request_leaderboard_rebuild_for_users(self.changed_user_ids)
+        rebuild_requested_leaderboards(self.stdout, delay_seconds=0)
 
-            # 为了避免触及 Strava API 的速率限制，可以在每次请求后暂停一小段时间
-            # 例如，每 10 个用户暂停 1 秒
-            time.sleep(0.1) # 短暂暂停，避免连续请求过快
+        # 同步结果汇总
+        elapsed = time.monotonic() - start_time
+        succeeded = len(users_to_sync) - len(failed) - skipped
+        self.stdout.write(self.style.SUCCESS(
+            f'Summary: {succeeded} succeeded, {len(failed)} failed, {skipped} skipped, '
+            f'{len(users_to_sync)} total in {elapsed:.1f}s.'))
+        total_writes = sum(self.activity_counts.values())
+        avoided = self.activity_counts['unchanged'] * 100 / total_writes if total_writes else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Activities: {self.activity_counts['inserted']} inserted, {self.activity_counts['updated']} updated, "
+            f"{self.activity_counts['unchanged']} unchanged ({avoided:.0f}% of writes avoided)."))
+        for username, error in failed.items():
+            self.stdout.write(self.style.ERROR(f'  {username}: {error}'))
+        for endpoint, stat in strava_client.get_stats().items():
+            self.stdout.write(
+                f"  API {endpoint}: {stat['count']} calls, {stat['errors']} errors, "
+                f"avg {stat['avg_seconds'] * 1000:.0f}ms, max {stat['max_seconds'] * 1000:.0f}ms")
 
-        self.stdout.write(self.style.SUCCESS('Strava data pull completed.'))
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS('Strava data pull completed.'))
@@ -0,0 +1,113 @@
+# strava_app/management/commands/strava_worker.py
+import os
+import socket
+import time
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from strava_web.models import SyncJob
+from strava_web.services import sync_strava_data_for_user, process_webhook_event, StravaSyncError
+from strava_web.rate_limit import StravaRateLimitExceeded
+from strava_web.sync_queue import claim_jobs, start_job, complete_job, fail_job, release_job, SyncLeaseLost
+from strava_web.tokens import renew_expiring_tokens
+from strava_web.leaderboards import request_leaderboard_rebuild_for_users, rebuild_requested_leaderboards
+
+class Command(BaseCommand):
+    help = 'Claims and runs queued Strava sync jobs. Several workers can run at the same time on different hosts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch',
+            type=int,
+            default=5,
+            help='Optional: Number of jobs to claim at a time.',
+        )
+        parser.add_argument(
+            '--lease',
+            type=int,
+            default=None,
+            help='Optional: Lease length in seconds (default STRAVA_SYNC_LEASE_SECONDS).',
+        )
+        parser.add_argument(
+            '--once',
+            action="store_true",
+            help='Exit when the queue has no due jobs instead of waiting for new ones.',
+        )
+        parser.add_argument(
+            '--idle_sleep',
+            type=int,
+            default=10,
+            help='Optional: Seconds to wait when the queue is empty.',
+        )
+
+    def run_job(self, job):
+        # 返回用户的活动数据是否有变化
+        if job.kind == SyncJob.KIND_WEBHOOK_EVENT:
+            return process_webhook_event(job.event, self.stdout)
+        counts = sync_strava_data_for_user(job.user, 0, self.stdout)
+        return bool(counts['inserted'] or counts['updated'])
+
+    def handle(self, *args, **options):
+        worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.stdout.write(self.style.SUCCESS(f'Strava worker {worker_id} started at: {datetime.now()}'))
+        succeeded = 0
+        failed = 0
+        while True:
+            close_old_connections()
+            # 同步或成员变化后登记的群组排行榜在这里合并重建，不占用 Web 请求
+            rebuild_requested_leaderboards(self.stdout)
+            jobs = claim_jobs(worker_id, options['batch'], options['lease'])
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['idle_sleep'])
+                continue
+            rate_limited = False
+            try:
+                # 先批量刷新本批任务中即将过期的令牌
+                renew_expiring_tokens([job.user for job in jobs], self.stdout)
+            except StravaRateLimitExceeded as e:
+                self.stdout.write(self.style.ERROR(f'Rate limit reached while renewing tokens: {e}'))
+                rate_limited = True
+            changed_user_ids = set()
+            for job in jobs:
+                try:
+                    if rate_limited:
+                        release_job(job)
+                        continue
+                    # 排队时租约可能已经过期并被其他 worker 领走：开始执行时重新设置租约，失败就跳过
+                    if not start_job(job, options['lease']):
+                        self.stdout.write(f'Job {job.pk} was claimed by another worker, skipped.')
+                        continue
+                    try:
+                        self.stdout.write(f'Running job {job.pk}: {job}')
+                        if self.run_job(job):
+                            changed_user_ids.add(job.user_id)
+                        complete_job(job)
+                        succeeded += 1
+                    except StravaRateLimitExceeded as e:
+                        # 日额度用完：放回队列，一小时后再试，本 worker 退出
+                        self.stdout.write(self.style.ERROR(f'Rate limit reached: {e}'))
+                        release_job(job, delay_seconds=3600)
+                        rate_limited = True
+                    except SyncLeaseLost:
+                        raise
+                    except Exception as e:
+                        if isinstance(e, StravaSyncError) and (e.counts['inserted'] or e.counts['updated']):
+                            # 失败前已经写入的活动照常重建排行榜
+                            changed_user_ids.add(job.user_id)
+                        failed += 1
+                        retry = fail_job(job, e)
+                        self.stdout.write(self.style.ERROR(
+                            f'Job {job.pk} failed ({"will retry" if retry else "giving up"}): {e}'))
+                except SyncLeaseLost as e:
+                    # 任务已归其他 worker，不再完成、放回或记录失败；已经写入的活动可能有变化
+                    changed_user_ids.add(job.user_id)
+                    self.stdout.write(self.style.ERROR(f'{e} Another worker owns job {job.pk} now.'))
+            # 数据有变化的用户所在群组登记重建，循环开头合并重建，活跃的群组不会每批都重建一次
+            request_leaderboard_rebuild_for_users(changed_user_ids)
+            if rate_limited:
+                break
+        # 退出前重建还在等待合并的群组
+        rebuild_requested_leaderboards(self.stdout, delay_seconds=0)
+        self.stdout.write(self.style.SUCCESS(f'Strava worker {worker_id} stopped: {succeeded} succeeded, {failed} failed.'))
@@ -0,0 +1,153 @@
+# strava_web/memberships.py
+import csv
+import io
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from strava_web.models import GroupApplication
+from strava_web.utils_group import refresh_group_counts
+from strava_web.leaderboards import request_leaderboard_rebuild
+
+User = get_user_model()
+
+BATCH_SIZE = 1000 # 每批处理的用户或申请数，控制 IN 列表和批量插入语句的大小
+MAX_ROSTER_ROWS = 5000 # 名单导入的最大行数
+
+Membership = User.groups.through
+USER_FIELD = User.groups.field.m2m_field_name() # 中间表里指向用户的字段名（customuser）
+
+def _batches(items):
+    items = list(items)
+    for i in range(0, len(items), BATCH_SIZE):
+        yield items[i:i + BATCH_SIZE]
+
+def _add_memberships(group_id, user_ids):
+    # 已经是成员的跳过（中间表上有 (user, group) 唯一约束），每批一条 INSERT
+    Membership.objects.bulk_create(
+        [Membership(**{f'{USER_FIELD}_id': user_id, 'group_id': group_id}) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+
+def _review(applications, reviewer, status):
+    """
+    批量审核待处理的申请，返回 {group_id: [user_id, ...]}。
+    所有申请的审核结果、时间、审核人都相同，每批用一条 UPDATE 写入，不逐条 save()。
+    """
+    now = timezone.now()
+    reviewed = {}
+    with transaction.atomic():
+        pending = list(applications.filter(status='pending').select_for_update().values_list('pk', 'group_id', 'user_id'))
+        for batch in _batches(pending):
+            GroupApplication.objects.filter(pk__in=[pk for pk, _, _ in batch]).update(
+                status=status, reviewed_at=now, reviewer=reviewer,
+            )
+            for _, group_id, user_id in batch:
+                reviewed.setdefault(group_id, []).append(user_id)
+        if status == 'approved':
+            for group_id, user_ids in reviewed.items():
+                for batch in _batches(user_ids):
+                    _add_memberships(group_id, batch)
+            request_leaderboard_rebuild(reviewed.keys())
+        refresh_group_counts(reviewed.keys())
+    return reviewed
+
+def approve_applications(applications, reviewer):
+    """
+    批准 applications（GroupApplication 查询集）中待处理的申请并把申请人加入群组，返回批准的数量。
+    """
+    return sum(len(user_ids) for user_ids in _review(applications, reviewer, 'approved').values())
+
+def reject_applications(applications, reviewer):
+    """
+    拒绝 applications 中待处理的申请，返回拒绝的数量。
+    """
+    return sum(len(user_ids) for user_ids in _review(applications, reviewer, 'rejected').values())
+
+def add_members(group, user_ids, reviewer):
+    """
+    把用户批量加入群组，返回新加入的人数。这些用户待处理的申请一并标记为已批准。
+    """
+    user_ids = set(user_ids)
+    with transaction.atomic():
+        added = 0
+        for batch in _batches(user_ids):
+            existing = set(Membership.objects.filter(group=group, **{f'{USER_FIELD}_id__in': batch}).values_list(f'{USER_FIELD}_id', flat=True))
+            _add_memberships(group.pk, [user_id for user_id in batch if user_id not in existing])
+            added += len(batch) - len(existing)
+            GroupApplication.objects.filter(group=group, user_id__in=batch, status='pending').update(
+                status='approved', reviewed_at=timezone.now(), reviewer=reviewer,
+            )
+        refresh_group_counts([group.pk])
+        if added:
+            request_leaderboard_rebuild([group.pk])
+    return added
+
+def remove_members(group, user_ids):
+    """
+    把用户批量移出群组（群组管理员除外），返回移除的人数。
+    """
+    removed = 0
+    with transaction.atomic():
+        for batch in _batches(set(user_ids)):
+            memberships = Membership.objects.filter(group=group, **{f'{USER_FIELD}_id__in': batch})
+            if group.admin_id:
+                memberships = memberships.exclude(**{f'{USER_FIELD}_id': group.admin_id})
+            removed += memberships.delete()[0]
+        refresh_group_counts([group.pk])
+        if removed:
+            request_leaderboard_rebuild([group.pk])
+    return removed
+
+def _parse_roster(roster_file):
+    """
+    读取名单 CSV：每行第一个非空单元格是 Strava ID（纯数字）、邮箱（含 @）或用户名，表头行会被跳过。
+    返回 (strava_ids, emails, usernames)，每项是 {标识: 原始文本}。
+    """
+    text = io.TextIOWrapper(roster_file, encoding='utf-8-sig', errors='replace')
+    strava_ids, emails, usernames = {}, {}, {}
+    for index, row in enumerate(csv.reader(text)):
+        if index >= MAX_ROSTER_ROWS:
+            raise ValueError(f'Roster has more than {MAX_ROSTER_ROWS} rows.')
+        value = next((cell.strip() for cell in row if cell.strip()), '')
+        if not value or value.lower() in ('strava_id', 'strava id', 'username', 'email'):
+            continue
+        if value.isdigit():
+            strava_ids[int(value)] = value
+        elif '@' in value:
+            emails[value.lower()] = value
+        else:
+            usernames[value] = value
+    return strava_ids, emails, usernames
+
+def import_roster(group, roster_file, reviewer):
+    """
+    按 CSV 名单批量把用户加入群组。每种标识每批一次查询找出用户，再批量插入中间表。
+    返回 (新加入人数, 名单中已是成员的人数, 找不到的标识列表)。
+    """
+    strava_ids, emails, usernames = _parse_roster(roster_file)
+    user_ids = set()
+    not_found = []
+    # 只导入启用的用户
+    users = User.objects.filter(is_active=True)
+    lookups = (
+        ('strava_id', strava_ids),
+        # 邮箱不区分大小写：MySQL 的排序规则本身不区分大小写，直接用 email__in 走索引，
+        # 同时带上名单里的原始写法，区分大小写的数据库上原样填写的邮箱也能找到
+        ('email', emails),
+        ('username', usernames),
+    )
+    for field, values in lookups:
+        for batch in _batches(values):
+            candidates = set(batch)
+            if field == 'email':
+                candidates.update(values[key] for key in batch)
+            found = {}
+            for value, pk in users.filter(**{f'{field}__in': candidates}).values_list(field, 'pk'):
+                found[value.lower() if field == 'email' else value] = pk
+            for key in batch:
+                if key in found:
+                    user_ids.add(found[key])
+                else:
+                    not_found.append(values[key])
+    added = add_members(group, user_ids, reviewer) if user_ids else 0
+    return added, len(user_ids) - added, not_found
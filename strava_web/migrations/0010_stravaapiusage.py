@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0009_alter_customuser_first_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StravaApiUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('short_limit', models.IntegerField(default=200, verbose_name='15 Minutes Limit')),
+                ('short_usage', models.IntegerField(default=0, verbose_name='15 Minutes Usage')),
+                ('short_window_start', models.DateTimeField(verbose_name='15 Minutes Window Start')),
+                ('daily_limit', models.IntegerField(default=2000, verbose_name='Daily Limit')),
+                ('daily_usage', models.IntegerField(default=0, verbose_name='Daily Usage')),
+                ('daily_window_start', models.DateTimeField(verbose_name='Daily Window Start')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated AT')),
+            ],
+            options={
+                'verbose_name': 'Strava API Usage',
+                'verbose_name_plural': 'Strava API Usage',
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0010_stravaapiusage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StravaWebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_type', models.CharField(choices=[('activity', 'Activity'), ('athlete', 'Athlete')], max_length=20, verbose_name='Object Type')),
+                ('object_id', models.BigIntegerField(verbose_name='Object ID')),
+                ('aspect_type', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=20, verbose_name='Aspect Type')),
+                ('owner_id', models.BigIntegerField(verbose_name='Owner Strava ID')),
+                ('updates', models.JSONField(blank=True, default=dict, verbose_name='Updates')),
+                ('event_time', models.DateTimeField(verbose_name='Event Time')),
+                ('received_at', models.DateTimeField(auto_now_add=True, verbose_name='Received At')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Processed At')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+            ],
+            options={
+                'verbose_name': 'Strava Webhook Event',
+                'verbose_name_plural': 'Strava Webhook Events',
+                'ordering': ['received_at'],
+                'indexes': [models.Index(fields=['processed_at', 'received_at'], name='strava_web__process_745fcb_idx')],
+            },
+        ),
+    ]
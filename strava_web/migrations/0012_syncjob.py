@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:38
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0011_stravawebhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('user_sync', 'User Sync'), ('webhook_event', 'Webhook Event')], default='user_sync', max_length=20, verbose_name='Kind')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running')], default='pending', max_length=10, verbose_name='Status')),
+                ('priority', models.IntegerField(default=100, verbose_name='Priority')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('next_run_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next Run At')),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True, verbose_name='Lease Expires At')),
+                ('locked_by', models.CharField(blank=True, max_length=100, verbose_name='Locked By')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last Error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated AT')),
+                ('event', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sync_jobs', to='strava_web.stravawebhookevent', verbose_name='Webhook Event')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_jobs', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Sync Job',
+                'verbose_name_plural': 'Sync Jobs',
+                'ordering': ['priority', 'next_run_at'],
+                'indexes': [models.Index(fields=['status', 'priority', 'next_run_at'], name='strava_web__status_49917d_idx'), models.Index(fields=['status', 'lease_expires_at'], name='strava_web__status_cbb293_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0012_syncjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StravaSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('high_water_mark', models.DateTimeField(blank=True, null=True, verbose_name='High Water Mark')),
+                ('backfill_before', models.DateTimeField(blank=True, null=True, verbose_name='Backfill Cursor')),
+                ('backfill_pages', models.IntegerField(default=0, verbose_name='Backfill Pages')),
+                ('backfill_completed_at', models.DateTimeField(blank=True, null=True, verbose_name='Backfill Completed At')),
+                ('last_success_at', models.DateTimeField(blank=True, null=True, verbose_name='Last Success At')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last Error')),
+                ('last_error_at', models.DateTimeField(blank=True, null=True, verbose_name='Last Error At')),
+                ('consecutive_failures', models.IntegerField(default=0, verbose_name='Consecutive Failures')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated AT')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Strava Sync State',
+                'verbose_name_plural': 'Strava Sync States',
+            },
+        ),
+    ]
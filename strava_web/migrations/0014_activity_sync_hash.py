@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0013_stravasyncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=32, verbose_name='Sync Fingerprint'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0014_activity_sync_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='strava_timezone',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='Strava Timezone'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='weekly_stats_week_start',
+            field=models.DateField(blank=True, null=True, verbose_name='Weekly Stats Week Start'),
+        ),
+    ]
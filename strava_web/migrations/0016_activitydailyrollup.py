@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:44
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0015_customuser_weekly_stats_week_start_strava_timezone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('distance', models.FloatField(default=0.0, verbose_name='Distance (meters)')),
+                ('moving_time', models.IntegerField(default=0, verbose_name='Moving Time (seconds)')),
+                ('elapsed_time', models.IntegerField(default=0, verbose_name='Elapsed Time (seconds)')),
+                ('elevation_gain', models.FloatField(default=0.0, verbose_name='Elevation Gain (meters)')),
+                ('count', models.IntegerField(default=0, verbose_name='Activity Count')),
+                ('hr_time', models.FloatField(default=0.0, verbose_name='Heartrate Time')),
+                ('hr_moving_time', models.IntegerField(default=0, verbose_name='Heartrate Moving Time (seconds)')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Activity Daily Rollup',
+                'verbose_name_plural': 'Activity Daily Rollups',
+                'indexes': [models.Index(fields=['date', 'user'], name='strava_web__date_d5577a_idx')],
+                'unique_together': {('user', 'date')},
+            },
+        ),
+    ]
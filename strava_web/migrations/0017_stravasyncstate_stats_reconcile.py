@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0016_activitydailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravasyncstate',
+            name='stats_drift',
+            field=models.FloatField(default=0.0, verbose_name='Stats Drift'),
+        ),
+        migrations.AddField(
+            model_name='stravasyncstate',
+            name='stats_reconciled_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Stats Reconciled At'),
+        ),
+    ]
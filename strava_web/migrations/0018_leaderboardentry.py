@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('strava_web', '0017_stravasyncstate_stats_reconcile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(max_length=16, verbose_name='Period')),
+                ('gender', models.CharField(max_length=8, verbose_name='Gender')),
+                ('age', models.CharField(max_length=8, verbose_name='Age Range')),
+                ('rank_type', models.CharField(max_length=16, verbose_name='Rank Type')),
+                ('rank', models.IntegerField(verbose_name='Rank')),
+                ('position', models.IntegerField(verbose_name='Position')),
+                ('distance', models.FloatField(default=0.0, verbose_name='Distance (meters)')),
+                ('moving_time', models.IntegerField(default=0, verbose_name='Moving Time (seconds)')),
+                ('elevation_gain', models.FloatField(default=0.0, verbose_name='Elevation Gain (meters)')),
+                ('built_at', models.DateTimeField(auto_now=True, verbose_name='Built At')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_entries', to='auth.group', verbose_name='Group')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_entries', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Leaderboard Entry',
+                'verbose_name_plural': 'Leaderboard Entries',
+                'ordering': ['position'],
+                'unique_together': {('group', 'period', 'gender', 'age', 'rank_type', 'position'), ('group', 'period', 'gender', 'age', 'rank_type', 'user')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0018_leaderboardentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['is_race', 'race_distance', 'chip_time', 'user'], name='strava_web__is_race_922269_idx'),
+        ),
+    ]
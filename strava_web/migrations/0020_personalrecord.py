@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0019_activity_race_ranking_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PersonalRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('race_distance', models.CharField(choices=[('1km', '1 km'), ('1mi', '1 mile'), ('5km', '5 km'), ('5mi', '5 mile'), ('10km', '10 km'), ('15km', '15 km'), ('10mi', '10 mile'), ('HM', 'Half Marathon'), ('30km', '30 km'), ('FM', 'Marathon'), ('50km', '50 km'), ('100km', '100 km'), ('150km', '150 km'), ('100mi', '100 mile'), ('Other', 'Other')], max_length=50, verbose_name='Race Distance')),
+                ('chip_time', models.IntegerField(verbose_name='Chip Time (seconds)')),
+                ('date', models.DateTimeField(verbose_name='Start Date (Local)')),
+                ('activity', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='personal_record', to='strava_web.activity', verbose_name='Activity')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='personal_records', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Personal Record',
+                'verbose_name_plural': 'Personal Records',
+                'indexes': [models.Index(fields=['race_distance', 'chip_time'], name='strava_web__race_di_220376_idx')],
+                'unique_together': {('user', 'race_distance')},
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('strava_web', '0020_personalrecord'),
+    ]
+
+    operations = [
+        # 先建好以 user 开头的组合索引，再去掉多余的唯一索引和 user 单列索引（MySQL 外键需要有索引）
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'start_date_local'], name='strava_web__user_id_966716_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', 'is_race', 'race_distance', 'chip_time'], name='strava_web__user_id_714533_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['activity_type', 'user', 'start_date_local'], name='strava_web__activit_6054ea_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='activity',
+            unique_together=set(),
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='strava_id',
+            field=models.BigIntegerField(unique=True, verbose_name='Strava Activity ID'),
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='strava_activities', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['gender', 'birth_year'], name='strava_web__gender_b9aea1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['weekly_stats_week_start'], name='strava_web__weekly__5f3a18_idx'),
+        ),
+    ]
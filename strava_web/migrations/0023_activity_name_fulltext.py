@@ -0,0 +1,60 @@
+from django.db import migrations
+
+# 活动名称全文索引，见 strava_web/search.py。只在 MySQL 和 SQLite 上创建，其他数据库搜索时退回 icontains。
+# 注意：SQLite 上之后的迁移如果重建 strava_web_activity 表，会丢掉下面的触发器，需要在那个迁移里重新创建；
+# strava_web/tests.py 中的 ActivityNameSearchTests 会检查触发器是否还在。
+
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE strava_web_activity_fts USING fts5("
+    "name, content='strava_web_activity', content_rowid='id', tokenize='unicode61')",
+    "CREATE TRIGGER strava_web_activity_fts_insert AFTER INSERT ON strava_web_activity BEGIN "
+    "INSERT INTO strava_web_activity_fts(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER strava_web_activity_fts_delete AFTER DELETE ON strava_web_activity BEGIN "
+    "INSERT INTO strava_web_activity_fts(strava_web_activity_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER strava_web_activity_fts_update AFTER UPDATE OF name ON strava_web_activity BEGIN "
+    "INSERT INTO strava_web_activity_fts(strava_web_activity_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO strava_web_activity_fts(rowid, name) VALUES (new.id, new.name); END",
+    # 为已有的活动建立索引
+    "INSERT INTO strava_web_activity_fts(strava_web_activity_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS strava_web_activity_fts_insert",
+    "DROP TRIGGER IF EXISTS strava_web_activity_fts_delete",
+    "DROP TRIGGER IF EXISTS strava_web_activity_fts_update",
+    "DROP TABLE IF EXISTS strava_web_activity_fts",
+]
+
+# ngram 分词器按相邻字符切词，中文活动名称（没有空格分词）也能搜索。
+# 使用 ngram 时，InnoDB 默认的停用词表会丢掉所有包含停用词的词元（例如含 "a"、"in" 的二元组），
+# 英文名称大多搜不到，所以建索引时关闭停用词。InnoDB 在建索引时记下这个设置，查询时也按它处理，
+# 不需要改服务器的全局配置；这里只改当前会话，建完恢复原值。
+MYSQL_CREATE = [
+    "SET @strava_web_ft_stopword = @@SESSION.innodb_ft_enable_stopword",
+    "SET SESSION innodb_ft_enable_stopword = OFF",
+    "ALTER TABLE strava_web_activity ADD FULLTEXT INDEX strava_web_activity_name_ft (name) WITH PARSER ngram",
+    "SET SESSION innodb_ft_enable_stopword = @strava_web_ft_stopword",
+]
+
+MYSQL_DROP = ["ALTER TABLE strava_web_activity DROP INDEX strava_web_activity_name_ft"]
+
+def _run(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement, params=None)
+
+def create_fulltext_index(apps, schema_editor):
+    _run(schema_editor, {'mysql': MYSQL_CREATE, 'sqlite': SQLITE_CREATE})
+
+def drop_fulltext_index(apps, schema_editor):
+    _run(schema_editor, {'mysql': MYSQL_DROP, 'sqlite': SQLITE_DROP})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0022_customuser_first_name_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:16
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('strava_web', '0023_activity_name_fulltext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardRebuildRequest',
+            fields=[
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='leaderboard_rebuild_request', serialize=False, to='auth.group', verbose_name='Group')),
+                ('requested_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Requested At')),
+            ],
+            options={
+                'verbose_name': 'Leaderboard Rebuild Request',
+                'verbose_name_plural': 'Leaderboard Rebuild Requests',
+            },
+        ),
+    ]
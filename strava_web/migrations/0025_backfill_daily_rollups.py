@@ -0,0 +1,50 @@
+from datetime import timezone as dt_timezone
+from django.db import migrations
+from django.db.models import Q, F, Sum, Count, ExpressionWrapper, FloatField, Value
+from django.db.models.functions import TruncDate, Coalesce
+
+# 为已有活动生成每日汇总（与 rollups.rebuild_daily_rollups 相同的计算），
+# 升级后年份筛选、月/季度排行榜等读汇总表的功能不必等人工运行 build_daily_rollups。
+CHUNK_SIZE = 500
+
+def backfill_daily_rollups(apps, schema_editor):
+    User = apps.get_model('strava_web', 'CustomUser')
+    Activity = apps.get_model('strava_web', 'Activity')
+    ActivityDailyRollup = apps.get_model('strava_web', 'ActivityDailyRollup')
+    hr_filter = Q(has_heartrate=True, average_heartrate__gt=0, moving_time__gt=0)
+    time_hr = ExpressionWrapper(F('moving_time') * F('average_heartrate'), output_field=FloatField())
+    user_ids = list(User.objects.order_by('pk').values_list('pk', flat=True))
+    for i in range(0, len(user_ids), CHUNK_SIZE):
+        chunk = user_ids[i:i + CHUNK_SIZE]
+        rows = Activity.objects.filter(user_id__in=chunk, activity_type='Run').order_by().annotate(
+            date=TruncDate('start_date_local', tzinfo=dt_timezone.utc),
+        ).values('user_id', 'date').annotate(
+            total_distance=Coalesce(Sum('distance'), Value(0.0)),
+            total_moving_time=Coalesce(Sum('moving_time'), Value(0)),
+            total_elapsed_time=Coalesce(Sum('elapsed_time'), Value(0)),
+            total_elevation_gain=Coalesce(Sum('elevation_gain'), Value(0.0)),
+            total_count=Count('id'),
+            total_hr_time=Coalesce(Sum(time_hr, filter=hr_filter), Value(0.0)),
+            total_hr_moving_time=Coalesce(Sum('moving_time', filter=hr_filter), Value(0)),
+        )
+        ActivityDailyRollup.objects.filter(user_id__in=chunk).delete()
+        ActivityDailyRollup.objects.bulk_create([
+            ActivityDailyRollup(
+                user_id=row['user_id'], date=row['date'],
+                distance=row['total_distance'], moving_time=row['total_moving_time'],
+                elapsed_time=row['total_elapsed_time'], elevation_gain=row['total_elevation_gain'],
+                count=row['total_count'], hr_time=row['total_hr_time'], hr_moving_time=row['total_hr_moving_time'],
+            )
+            for row in rows
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0024_leaderboardrebuildrequest'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_daily_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# 重新统计所有群组的 member_count 和 pending_count（与 utils_group.refresh_group_counts 相同）。
+# 这两列是 add_to_class 加到 auth.Group 上的，不在迁移的历史模型里，所以直接用 SQL；
+# 升级前新增的列默认为 0，之前删除用户留下的计数也一并修正。
+BACKFILL_SQL = (
+    "UPDATE auth_group SET "
+    "member_count = (SELECT COUNT(*) FROM strava_web_customuser_groups WHERE strava_web_customuser_groups.group_id = auth_group.id), "
+    "pending_count = (SELECT COUNT(*) FROM strava_web_groupapplication "
+    "WHERE strava_web_groupapplication.group_id = auth_group.id AND strava_web_groupapplication.status = 'pending')"
+)
+
+SKIPPED_WARNING = (
+    "\n  WARNING: auth_group has no member_count/pending_count columns yet, group counts were not backfilled. "
+    "They are recounted automatically after a later migrate adds the columns (strava_web post_migrate handler); "
+    "otherwise run `python manage.py repair_group_counts` after deploying."
+)
+
+def backfill_group_counts(apps, schema_editor):
+    # 这两列由 auth 应用的迁移添加，可能排在本迁移之后。还没有这两列时跳过并提示：
+    # 加上这两列的那次 migrate 结束后由 apps.repair_group_counts（post_migrate）重新统计，
+    # 也可以在部署后手动运行 repair_group_counts 命令
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        columns = {column.name for column in connection.introspection.get_table_description(cursor, 'auth_group')}
+    if {'member_count', 'pending_count'} <= columns:
+        schema_editor.execute(BACKFILL_SQL, params=None)
+    else:
+        print(SKIPPED_WARNING)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0025_backfill_daily_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_group_counts, migrations.RunPython.noop),
+    ]
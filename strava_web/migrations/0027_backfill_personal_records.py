@@ -0,0 +1,39 @@
+from django.db import migrations
+from django.db.models import Q
+
+# 为已有比赛活动生成个人最好成绩（与 records.rebuild_personal_records 相同的计算），
+# 升级后个人最好成绩页和比赛排行榜（不限时间、每人最快一次）不必等人工运行 build_personal_records。
+CHUNK_SIZE = 500
+
+def backfill_personal_records(apps, schema_editor):
+    User = apps.get_model('strava_web', 'CustomUser')
+    Activity = apps.get_model('strava_web', 'Activity')
+    PersonalRecord = apps.get_model('strava_web', 'PersonalRecord')
+    user_ids = list(User.objects.order_by('pk').values_list('pk', flat=True))
+    for i in range(0, len(user_ids), CHUNK_SIZE):
+        chunk = user_ids[i:i + CHUNK_SIZE]
+        races = Activity.objects.filter(
+            Q(is_race__in=[True]), user_id__in=chunk, chip_time__gt=0, race_distance__isnull=False,
+        ).order_by('chip_time', 'start_date_local', 'pk').values_list(
+            'pk', 'user_id', 'race_distance', 'chip_time', 'start_date_local'
+        )
+        records = {}
+        for pk, user_id, race_distance, chip_time, start_date_local in races.iterator():
+            # 已按成绩排序，每个 (用户, 距离) 第一次出现的就是最好成绩
+            records.setdefault((user_id, race_distance), PersonalRecord(
+                user_id=user_id, race_distance=race_distance, activity_id=pk,
+                chip_time=chip_time, date=start_date_local,
+            ))
+        PersonalRecord.objects.filter(user_id__in=chunk).delete()
+        PersonalRecord.objects.bulk_create(records.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('strava_web', '0026_backfill_group_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_personal_records, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('strava_web', '0027_backfill_personal_records'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leaderboardentry',
+            name='period_start',
+            field=models.DateField(blank=True, null=True, verbose_name='Period Start'),
+        ),
+        migrations.AddField(
+            model_name='leaderboardrebuildrequest',
+            name='built_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Built At'),
+        ),
+        migrations.AddIndex(
+            model_name='leaderboardentry',
+            index=models.Index(fields=['period', 'period_start'], name='strava_web__period_f74e77_idx'),
+        ),
+    ]
@@ -70,7 +70,12 @@ class CustomUser(AbstractUser):
     weekly_run_elevation_gain = models.FloatField(default=0.0, verbose_name=_('Weekly Elevation Gain'))
     weekly_avg_heartrate = models.FloatField(default=0.0, verbose_name=_('Weekly Average Heart Rate'))
     weekly_max_heartrate = models.FloatField(default=0.0, verbose_name=_('Weekly Max Heart Rate'))
-    
+    # 周统计对应的那一周的周一（用户所在时区），换周时据此判断哪些用户需要重新计算
+    weekly_stats_week_start = models.DateField(null=True, blank=True, verbose_name=_('Weekly Stats Week Start'))
+
+    # 用户所在时区 (IANA 名称)，取自最近一次活动的 timezone，用于按用户本地时间划分周
+    strava_timezone = models.CharField(max_length=64, blank=True, default='', verbose_name=_("Strava Timezone"))
+
     use_metric = models.BooleanField(default=True, verbose_name=_("Use Metric System"))
     birth_year = models.IntegerField(null=True, blank=True, verbose_name=_("Birth Year"))
 
@@ -93,6 +98,14 @@ class CustomUser(AbstractUser):
     class Meta:
         verbose_name = _("User")
         verbose_name_plural = _("Users")
+        indexes = [
+            # 排行榜按性别、年龄段筛选成员
+            models.Index(fields=['gender', 'birth_year']),
+            # 每周一只重新计算周统计过期的用户
+            models.Index(fields=['weekly_stats_week_start']),
+            # 选择用户时按昵称前缀搜索（用户名本身有唯一索引）
+            models.Index(fields=['first_name']),
+        ]
         # 定义自定义权限
         permissions = [
             ("can_sync_strava_data", _("Can sync Strava data")),
@@ -111,29 +124,10 @@ class CustomUser(AbstractUser):
         return self.strava_id is not None
 
     def get_strava_access_token(self):
-        if not self.strava_access_token or not self.strava_refresh_token:
-            return None
-
-        # 检查是否过期，留出一些余量 (例如，在过期前5分钟刷新)
-        if self.strava_token_expires_at and self.strava_token_expires_at < timezone.now() + timezone.timedelta(minutes=5):
-            # 令牌已过期或即将过期，尝试刷新
-            try:
-                # 避免循环导入，在需要时局部导入或在函数外定义服务
-                from strava_web.services import refresh_strava_token 
-                new_tokens = refresh_strava_token(self)
-                self.strava_access_token = new_tokens['access_token']
-                self.strava_refresh_token = new_tokens['refresh_token']
-                self.strava_token_expires_at = timezone.now() + timezone.timedelta(seconds=new_tokens['expires_in'])
-                self.save()
-                return self.strava_access_token
-            except Exception as e:
-                # 刷新失败，需要用户重新授权
-                self.strava_access_token = None
-                self.strava_refresh_token = None
-                self.strava_token_expires_at = None
-                self.save()
-                raise ValueError(f"Failed to refresh Strava token for user {self.username}: {e}. Please re-authorize.")
-        return self.strava_access_token
+        # 令牌刷新由 tokens 模块统一处理（单用户 single-flight，只写令牌字段）
+        # 避免循环导入，在需要时局部导入
+        from strava_web.tokens import get_access_token
+        return get_access_token(self)
 
 # 扩展 Django Group 模型，添加组类型字段
 Group.add_to_class('is_open', models.BooleanField(default=True, verbose_name=_("Allow Free Joining"),
@@ -165,6 +159,13 @@ Group.add_to_class('announcement', models.TextField(
     verbose_name=_("Group Announcement"),
     help_text=_("Group announcement. Max length 1000 chars"),
 ))
+# 成员数和待审核申请数，成员或申请变化时由 utils_group.refresh_group_counts 重新统计，群组列表直接按这两列排序
+Group.add_to_class('member_count', models.PositiveIntegerField(
+    default=0, db_index=True, editable=False, verbose_name=_("Members"),
+))
+Group.add_to_class('pending_count', models.PositiveIntegerField(
+    default=0, db_index=True, editable=False, verbose_name=_("Pending Applications"),
+))
 
 # GroupApplication 模型
 class GroupApplication(models.Model):
@@ -192,8 +193,9 @@ class GroupApplication(models.Model):
 
 # Activity 模型 (用于存储 Strava 活动数据)
 class Activity(models.Model):
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='strava_activities')
-    strava_id = models.BigIntegerField(unique=True, db_index=True, verbose_name=_("Strava Activity ID"))
+    # user 的单列索引由下面以 user 开头的组合索引代替
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='strava_activities', db_index=False)
+    strava_id = models.BigIntegerField(unique=True, verbose_name=_("Strava Activity ID"))
 
     name = models.CharField(max_length=255, verbose_name=_("Activity Name"))
     activity_type = models.CharField(max_length=50, verbose_name=_("Activity Type")) # 'Run', 'Ride' etc.
@@ -222,6 +224,9 @@ class Activity(models.Model):
     # 比赛特定的额外字段
     is_race = models.BooleanField(default=False, verbose_name=_("Is Race")) # 方便快速筛选比赛，根据 workout_type=1 设置
 
+    # Strava 摘要内容的指纹，同步时指纹不变就跳过写入
+    sync_hash = models.CharField(max_length=32, blank=True, default='', verbose_name=_("Sync Fingerprint"))
+
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Created At"))
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Updated AT"))
     RACE_DISTANCE_CHOINCE = [
@@ -245,10 +250,265 @@ class Activity(models.Model):
 
     class Meta:
         ordering = ['-start_date_local'] # 默认按日期倒序
-        unique_together = ('user', 'strava_id')
+        # strava_id 本身唯一，不再需要 (user, strava_id) 的唯一索引
+        indexes = [
+            # 活动列表（按日期排序/筛选）、每日汇总按天刷新
+            models.Index(fields=['user', 'start_date_local']),
+            # 比赛列表和个人最好成绩：某个用户某个距离的比赛按完赛时间排序
+            models.Index(fields=['user', 'is_race', 'race_distance', 'chip_time']),
+            # 比赛排行榜：按距离筛选后按完赛时间排序，每人最快一次 (ROW_NUMBER 按 user 分区)
+            models.Index(fields=['is_race', 'race_distance', 'chip_time', 'user']),
+            # 周统计和汇总表重建：一批用户某段时间内的跑步
+            models.Index(fields=['activity_type', 'user', 'start_date_local']),
+        ]
         verbose_name = _("Activity")
         verbose_name_plural = _("Activities")
 
     def __str__(self):
         return f"{self.user.username}'s {self.activity_type} on {self.start_date_local.strftime('%Y-%m-%d')} - {self.name}"
-    
+
+# 筛选比赛用 filter(RACE_FILTER)，不用 filter(is_race=True)：后者生成的是 WHERE is_race，
+# 数据库不把它当作 is_race 上的等值条件，复合索引里 is_race 之后的列（race_distance, chip_time）就用不上了
+RACE_FILTER = models.Q(is_race__in=[True])
+
+# Strava API 调用额度（全局只有一行），所有进程共享，用于限流
+class StravaApiUsage(models.Model):
+    short_limit = models.IntegerField(default=200, verbose_name=_("15 Minutes Limit"))
+    short_usage = models.IntegerField(default=0, verbose_name=_("15 Minutes Usage"))
+    short_window_start = models.DateTimeField(verbose_name=_("15 Minutes Window Start"))
+    daily_limit = models.IntegerField(default=2000, verbose_name=_("Daily Limit"))
+    daily_usage = models.IntegerField(default=0, verbose_name=_("Daily Usage"))
+    daily_window_start = models.DateTimeField(verbose_name=_("Daily Window Start"))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Updated AT"))
+
+    class Meta:
+        verbose_name = _("Strava API Usage")
+        verbose_name_plural = _("Strava API Usage")
+
+    def __str__(self):
+        return f"{self.short_usage}/{self.short_limit}, {self.daily_usage}/{self.daily_limit}"
+
+# Strava 推送订阅 (webhook) 收到的事件，先入队，再由 strava_worker 命令处理
+class StravaWebhookEvent(models.Model):
+    OBJECT_TYPE_CHOICES = [
+        ('activity', _('Activity')),
+        ('athlete', _('Athlete')),
+    ]
+    ASPECT_TYPE_CHOICES = [
+        ('create', _('Create')),
+        ('update', _('Update')),
+        ('delete', _('Delete')),
+    ]
+    object_type = models.CharField(max_length=20, choices=OBJECT_TYPE_CHOICES, verbose_name=_("Object Type"))
+    object_id = models.BigIntegerField(verbose_name=_("Object ID"))
+    aspect_type = models.CharField(max_length=20, choices=ASPECT_TYPE_CHOICES, verbose_name=_("Aspect Type"))
+    owner_id = models.BigIntegerField(verbose_name=_("Owner Strava ID"))
+    updates = models.JSONField(default=dict, blank=True, verbose_name=_("Updates"))
+    event_time = models.DateTimeField(verbose_name=_("Event Time"))
+    received_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Received At"))
+    processed_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Processed At"))
+    error = models.TextField(blank=True, verbose_name=_("Error"))
+
+    class Meta:
+        ordering = ['received_at']
+        indexes = [
+            models.Index(fields=['processed_at', 'received_at']),
+        ]
+        verbose_name = _("Strava Webhook Event")
+        verbose_name_plural = _("Strava Webhook Events")
+
+    def __str__(self):
+        return f"{self.object_type} {self.object_id} {self.aspect_type} (owner {self.owner_id})"
+
+    @property
+    def is_deauthorization(self):
+        return self.object_type == 'athlete' and str(self.updates.get('authorized', '')).lower() == 'false'
+
+# 同步任务队列：strava_worker 命令用 SELECT ... FOR UPDATE SKIP LOCKED 领取任务
+class SyncJob(models.Model):
+    KIND_USER_SYNC = 'user_sync'
+    KIND_WEBHOOK_EVENT = 'webhook_event'
+    KIND_CHOICES = [
+        (KIND_USER_SYNC, _('User Sync')),
+        (KIND_WEBHOOK_EVENT, _('Webhook Event')),
+    ]
+    STATUS_CHOICES = [
+        ('pending', _('Pending')),
+        ('running', _('Running')),
+    ]
+    # 数值越小越先执行：新用户和 webhook 事件优先于例行同步
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 100
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sync_jobs', verbose_name=_("User"))
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default=KIND_USER_SYNC, verbose_name=_("Kind"))
+    event = models.ForeignKey(StravaWebhookEvent, on_delete=models.CASCADE, null=True, blank=True, related_name='sync_jobs', verbose_name=_("Webhook Event"))
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', verbose_name=_("Status"))
+    priority = models.IntegerField(default=PRIORITY_NORMAL, verbose_name=_("Priority"))
+    attempts = models.IntegerField(default=0, verbose_name=_("Attempts"))
+    next_run_at = models.DateTimeField(default=timezone.now, verbose_name=_("Next Run At"))
+    lease_expires_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Lease Expires At"))
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name=_("Locked By"))
+    last_error = models.TextField(blank=True, verbose_name=_("Last Error"))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Created At"))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Updated AT"))
+
+    class Meta:
+        ordering = ['priority', 'next_run_at']
+        indexes = [
+            models.Index(fields=['status', 'priority', 'next_run_at']),
+            models.Index(fields=['status', 'lease_expires_at']),
+        ]
+        verbose_name = _("Sync Job")
+        verbose_name_plural = _("Sync Jobs")
+
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.user} ({self.status}, attempt {self.attempts})"
+
+# 每个用户的同步状态：增量同步的高水位、历史回填进度和失败记录
+class StravaSyncState(models.Model):
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sync_state', verbose_name=_("User"))
+    # 已同步活动中最新的 start_date (UTC)，下次增量同步从这里继续
+    high_water_mark = models.DateTimeField(null=True, blank=True, verbose_name=_("High Water Mark"))
+    # 历史回填的游标：下一批取 start_date 早于该时间的活动 (Strava 的 before 参数)
+    backfill_before = models.DateTimeField(null=True, blank=True, verbose_name=_("Backfill Cursor"))
+    backfill_pages = models.IntegerField(default=0, verbose_name=_("Backfill Pages"))
+    backfill_completed_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Backfill Completed At"))
+    last_success_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Last Success At"))
+    last_error = models.TextField(blank=True, verbose_name=_("Last Error"))
+    last_error_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Last Error At"))
+    consecutive_failures = models.IntegerField(default=0, verbose_name=_("Consecutive Failures"))
+    # 最近一次用 Strava stats 接口对账的时间，以及本地统计与 Strava 的相对偏差
+    stats_reconciled_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Stats Reconciled At"))
+    stats_drift = models.FloatField(default=0.0, verbose_name=_("Stats Drift"))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Updated AT"))
+
+    class Meta:
+        verbose_name = _("Strava Sync State")
+        verbose_name_plural = _("Strava Sync States")
+
+    def __str__(self):
+        return f"{self.user} (high water mark: {self.high_water_mark})"
+
+    def record_success(self):
+        self.last_success_at = timezone.now()
+        self.consecutive_failures = 0
+        self.save(update_fields=['last_success_at', 'consecutive_failures', 'updated_at'])
+
+    def record_failure(self, error):
+        self.last_error = str(error)[:2000]
+        self.last_error_at = timezone.now()
+        self.consecutive_failures += 1
+        self.save(update_fields=['last_error', 'last_error_at', 'consecutive_failures', 'updated_at'])
+
+    def advance_high_water_mark(self, start_date):
+        # 只前进不后退，每处理完一页就保存，失败后可以从这里继续
+        if start_date and (self.high_water_mark is None or start_date > self.high_water_mark):
+            self.high_water_mark = start_date
+            self.save(update_fields=['high_water_mark', 'updated_at'])
+
+    def record_stats_reconcile(self, drift):
+        self.stats_reconciled_at = timezone.now()
+        self.stats_drift = drift
+        self.save(update_fields=['stats_reconciled_at', 'stats_drift', 'updated_at'])
+
+class ActivityDailyRollup(models.Model):
+    """
+    每个用户每天的跑步汇总（按活动的本地日期），活动写入、修改、删除时增量维护。
+    任意时间段（月、季度、自定义）的统计只需汇总少量的行，不必扫描 Activity。
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='daily_rollups', verbose_name=_("User"))
+    date = models.DateField(verbose_name=_("Date"))
+    distance = models.FloatField(default=0.0, verbose_name=_("Distance (meters)"))
+    moving_time = models.IntegerField(default=0, verbose_name=_("Moving Time (seconds)"))
+    elapsed_time = models.IntegerField(default=0, verbose_name=_("Elapsed Time (seconds)"))
+    elevation_gain = models.FloatField(default=0.0, verbose_name=_("Elevation Gain (meters)"))
+    count = models.IntegerField(default=0, verbose_name=_("Activity Count"))
+    # 有心率的活动 moving_time * average_heartrate 之和及其 moving_time 之和，用于计算加权平均心率
+    hr_time = models.FloatField(default=0.0, verbose_name=_("Heartrate Time"))
+    hr_moving_time = models.IntegerField(default=0, verbose_name=_("Heartrate Moving Time (seconds)"))
+
+    class Meta:
+        unique_together = ('user', 'date')
+        indexes = [
+            models.Index(fields=['date', 'user']), # 按时间段汇总所有用户（排行榜）
+        ]
+        verbose_name = _("Activity Daily Rollup")
+        verbose_name_plural = _("Activity Daily Rollups")
+
+    def __str__(self):
+        return f"{self.user} on {self.date}: {self.count} runs, {self.distance} m"
+
+class LeaderboardEntry(models.Model):
+    """
+    预先计算好的群组排行榜：每个 (群组, 周期, 性别, 年龄段, 排名类型) 组合下每个成员一行，
+    名次已经算好。同步后只重建受影响的群组，排行榜页面按 position 做范围读取。
+    """
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='leaderboard_entries', verbose_name=_("Group"))
+    period = models.CharField(max_length=16, verbose_name=_("Period")) # weekly / recent / month / quarter / ytd / all_time
+    gender = models.CharField(max_length=8, verbose_name=_("Gender")) # all / M / F
+    age = models.CharField(max_length=8, verbose_name=_("Age Range")) # AGE_RANGES 的 key
+    rank_type = models.CharField(max_length=16, verbose_name=_("Rank Type")) # distance / moving_time / avg_pace / elevation_gain
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='leaderboard_entries', verbose_name=_("User"))
+    rank = models.IntegerField(verbose_name=_("Rank")) # 并列同名次
+    position = models.IntegerField(verbose_name=_("Position")) # 从 1 开始连续编号，用于分页
+    distance = models.FloatField(default=0.0, verbose_name=_("Distance (meters)"))
+    moving_time = models.IntegerField(default=0, verbose_name=_("Moving Time (seconds)"))
+    elevation_gain = models.FloatField(default=0.0, verbose_name=_("Elevation Gain (meters)"))
+    # 月/季度排行榜合计的起始日期，进入新的月份或季度后据此找出需要重建的群组；其他周期为空
+    period_start = models.DateField(null=True, blank=True, verbose_name=_("Period Start"))
+    built_at = models.DateTimeField(auto_now=True, verbose_name=_("Built At"))
+
+    class Meta:
+        ordering = ['position']
+        unique_together = [
+            ('group', 'period', 'gender', 'age', 'rank_type', 'position'),
+            ('group', 'period', 'gender', 'age', 'rank_type', 'user'),
+        ]
+        indexes = [
+            models.Index(fields=['period', 'period_start']), # 找出月/季度合计已经过期的群组
+        ]
+        verbose_name = _("Leaderboard Entry")
+        verbose_name_plural = _("Leaderboard Entries")
+
+    def __str__(self):
+        return f"{self.group} {self.period}/{self.gender}/{self.age}/{self.rank_type} #{self.rank}: {self.user}"
+
+class LeaderboardRebuildRequest(models.Model):
+    """
+    群组排行榜的重建登记：同步后成员数据有变化、成员加入/退出、成员的性别或出生年份变化时登记，
+    由 strava_worker / strava_pull / rebuild_leaderboards --requested 在 Web 请求之外重建。
+    requested_at 晚于 built_at 时需要重建；重建后保留这一行，记录重建时间用于合并短时间内的多次登记。
+    """
+    group = models.OneToOneField(Group, on_delete=models.CASCADE, primary_key=True, related_name='leaderboard_rebuild_request', verbose_name=_("Group"))
+    requested_at = models.DateTimeField(default=timezone.now, verbose_name=_("Requested At"))
+    built_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Built At"))
+
+    class Meta:
+        verbose_name = _("Leaderboard Rebuild Request")
+        verbose_name_plural = _("Leaderboard Rebuild Requests")
+
+    def __str__(self):
+        return f"{self.group} ({self.requested_at})"
+
+class PersonalRecord(models.Model):
+    """
+    每个用户每个比赛距离的最好成绩（chip_time 最短的比赛活动）。
+    活动同步、编辑、删除时更新，个人最好成绩和比赛排行榜（每人最快一次）直接读这张表。
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='personal_records', verbose_name=_("User"))
+    race_distance = models.CharField(max_length=50, choices=Activity.RACE_DISTANCE_CHOINCE, verbose_name=_("Race Distance"))
+    activity = models.OneToOneField(Activity, on_delete=models.CASCADE, related_name='personal_record', verbose_name=_("Activity"))
+    chip_time = models.IntegerField(verbose_name=_("Chip Time (seconds)"))
+    date = models.DateTimeField(verbose_name=_("Start Date (Local)"))
+
+    class Meta:
+        unique_together = ('user', 'race_distance')
+        indexes = [
+            models.Index(fields=['race_distance', 'chip_time']), # 比赛排行榜（每人最快一次）
+        ]
+        verbose_name = _("Personal Record")
+        verbose_name_plural = _("Personal Records")
+
+    def __str__(self):
+        return f"{self.user} {self.race_distance}: {self.chip_time}s"
@@ -0,0 +1,176 @@
+# strava_web/pagination.py
+import datetime
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+
+CURSOR_SALT = 'strava_web.pagination'
+
+class CursorEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder 会把微秒截到毫秒，游标需要完整精度，否则同一秒内的活动会被跳过或重复
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+class CursorSerializer(signing.JSONSerializer):
+    # 游标里的排序值可能是日期时间，转成字符串，过滤时数据库字段会自动解析
+    def dumps(self, obj):
+        return CursorEncoder(separators=(',', ':')).encode(obj).encode('latin-1')
+
+class CursorPage:
+    """
+    一页数据，接口尽量和 django.core.paginator.Page 一致，模板可以直接迭代。
+    没有页码，只有上一页 / 下一页的游标。
+    """
+    def __init__(self, object_list, paginator, start_index, has_previous, has_next):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._start_index = start_index
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def start_index(self):
+        # 本页第一条在整个结果中的序号（从 1 开始），排行榜用它显示名次
+        return self._start_index
+
+    def end_index(self):
+        return self._start_index + len(self.object_list) - 1
+
+    @property
+    def next_cursor(self):
+        if not self._has_next or not self.object_list:
+            return ''
+        return self.paginator.encode_cursor(self.object_list[-1], 'next', self._start_index + len(self.object_list))
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous or not self.object_list:
+            return ''
+        return self.paginator.encode_cursor(self.object_list[0], 'prev', self._start_index - self.paginator.per_page)
+
+class CursorPaginator:
+    """
+    按 (排序字段, id) 做键集分页（seek pagination）：用 WHERE 条件从上一页最后一行接着读，
+    不用 OFFSET，也不需要 COUNT(*)，翻到多深的页代价都和第一页一样。
+
+    游标是签名后的 (排序值, id, 方向, 起始序号)，排序字段或方向变了旧游标自动作废，回到第一页。
+    可以为空的排序字段 NULL 统一排在最后。
+    count_limit 不为 None 时提供近似总数：最多数到 count_limit 条，超出时 count_is_capped 为 True。
+    """
+    def __init__(self, queryset, per_page, sort_field='pk', descending=False, count_limit=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.sort_field = sort_field
+        self.descending = descending
+        self.count_limit = count_limit
+        # 按注解排序时（如全文检索的 relevance）注解值不为空
+        self.nullable = (
+            sort_field != 'pk' and sort_field not in queryset.query.annotations
+            and queryset.model._meta.get_field(sort_field).null
+        )
+        self.key = f"{sort_field}:{'desc' if descending else 'asc'}"
+        self._count = None
+
+    def get_ordering(self, reverse=False):
+        descending = self.descending != reverse
+        pk_order = '-pk' if descending else 'pk'
+        if self.sort_field == 'pk':
+            return [pk_order]
+        if self.nullable:
+            # 正向 NULL 在最后，反向读上一页时 NULL 在最前
+            nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+            field = F(self.sort_field)
+            return [field.desc(**nulls) if descending else field.asc(**nulls), pk_order]
+        return [f"-{self.sort_field}" if descending else self.sort_field, pk_order]
+
+    def _seek(self, value, pk, forward):
+        # forward=True: 排在 (value, pk) 之后的行；False: 之前的行
+        op = '__gt' if self.descending != forward else '__lt'
+        if self.sort_field == 'pk':
+            return Q(**{f'pk{op}': pk})
+        field = self.sort_field
+        if value is None:
+            # NULL 排在最后：之后只剩 id 更靠后的 NULL 行，之前是所有非 NULL 行和 id 更靠前的 NULL 行
+            condition = Q(**{f'{field}__isnull': True, f'pk{op}': pk})
+            return condition if forward else condition | Q(**{f'{field}__isnull': False})
+        condition = Q(**{f'{field}{op}': value}) | Q(**{field: value, f'pk{op}': pk})
+        if forward and self.nullable:
+            condition |= Q(**{f'{field}__isnull': True})
+        return condition
+
+    def encode_cursor(self, obj, direction, start_index):
+        value = obj.pk if self.sort_field == 'pk' else getattr(obj, self.sort_field)
+        return signing.dumps(
+            {'k': self.key, 'v': value, 'id': obj.pk, 'd': direction, 's': max(1, start_index)},
+            salt=CURSOR_SALT, serializer=CursorSerializer,
+        )
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            payload = signing.loads(cursor, salt=CURSOR_SALT, serializer=CursorSerializer)
+        except signing.BadSignature:
+            return None
+        if not isinstance(payload, dict) or payload.get('k') != self.key or payload.get('d') not in ('next', 'prev'):
+            return None
+        return payload
+
+    def get_page(self, cursor=None):
+        """
+        返回游标对应的页，游标为空、无效或已过期时返回第一页。
+        """
+        payload = self.decode_cursor(cursor)
+        if payload is None:
+            return self._first_page()
+        if payload['d'] == 'next':
+            rows = list(self.queryset.filter(
+                self._seek(payload['v'], payload['id'], forward=True)
+            ).order_by(*self.get_ordering())[:self.per_page + 1])
+            return CursorPage(rows[:self.per_page], self, payload['s'], True, len(rows) > self.per_page)
+        rows = list(self.queryset.filter(
+            self._seek(payload['v'], payload['id'], forward=False)
+        ).order_by(*self.get_ordering(reverse=True))[:self.per_page + 1])
+        has_previous = len(rows) > self.per_page
+        if not has_previous:
+            # 已经回到开头，按第一页重新读，避免数据变化后第一页不满
+            return self._first_page()
+        rows = rows[:self.per_page]
+        rows.reverse()
+        return CursorPage(rows, self, payload['s'], True, True)
+
+    def _first_page(self):
+        rows = list(self.queryset.order_by(*self.get_ordering())[:self.per_page + 1])
+        return CursorPage(rows[:self.per_page], self, 1, False, len(rows) > self.per_page)
+
+    @property
+    def count(self):
+        # 近似总数：最多数到 count_limit 条，不做全表 COUNT(*)
+        if self.count_limit is None:
+            return None
+        if self._count is None:
+            self._count = self.queryset.order_by()[:self.count_limit + 1].count()
+        return min(self._count, self.count_limit)
+
+    @property
+    def count_is_capped(self):
+        return self.count is not None and self._count > self.count_limit
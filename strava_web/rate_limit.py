@@ -0,0 +1,164 @@
+# strava_web/rate_limit.py
+import threading
+import time
+from datetime import timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db.models import F, Q, Case, When, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from strava_web.models import StravaApiUsage
+from strava_web.sync_queue import renew_lease
+
+SHORT_WINDOW_SECONDS = 15 * 60
+WAIT_STEP_SECONDS = 60 # 等待下一个窗口时每次最多睡这么久，期间延长同步任务的租约
+
+class StravaRateLimitExceeded(Exception):
+    """
+    Strava 的调用额度已用完（日额度用完，或者调用方不愿等待下一个 15 分钟窗口）。
+    """
+    pass
+
+def get_short_window_start(current_time):
+    # Strava 的 15 分钟窗口按自然时间对齐 (0, 15, 30, 45 分)
+    return current_time.replace(minute=current_time.minute - current_time.minute % 15, second=0, microsecond=0)
+
+def get_daily_window_start(current_time):
+    # Strava 的日额度在 UTC 午夜重置
+    return current_time.astimezone(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def parse_rate_limit_headers(headers):
+    """
+    解析 X-RateLimit-Limit / X-RateLimit-Usage（以及 X-ReadRateLimit-*）头部，
+    格式为 "15分钟值,日值"。返回 (short_limit, short_usage, daily_limit, daily_usage)，
+    两组头部都存在时取剩余额度更少的一组。没有头部时返回 None。
+    """
+    result = None
+    for prefix in ('X-RateLimit', 'X-ReadRateLimit'):
+        limit = headers.get(f'{prefix}-Limit')
+        usage = headers.get(f'{prefix}-Usage')
+        if not limit or not usage:
+            continue
+        try:
+            short_limit, daily_limit = [int(v) for v in limit.split(',')[:2]]
+            short_usage, daily_usage = [int(v) for v in usage.split(',')[:2]]
+        except ValueError:
+            continue
+        if result is None:
+            result = [short_limit, short_usage, daily_limit, daily_usage]
+            continue
+        if short_limit - short_usage < result[0] - result[1]:
+            result[0], result[1] = short_limit, short_usage
+        if daily_limit - daily_usage < result[2] - result[3]:
+            result[2], result[3] = daily_limit, daily_usage
+    return tuple(result) if result else None
+
+class StravaRateLimiter:
+    """
+    所有 Strava API 调用共享的限流器。
+
+    进程内使用令牌桶平滑请求速度；跨进程的 15 分钟和每日额度保存在 StravaApiUsage 表中，
+    每次调用前用一条条件 UPDATE 原子地换窗口并预占一个额度，调用后用一条 UPDATE 根据 Strava 返回的头部校正用量。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._burst = getattr(settings, 'STRAVA_RATE_LIMIT_BURST', 10)
+        self._margin = getattr(settings, 'STRAVA_RATE_LIMIT_MARGIN', 2)
+        self._tokens = float(self._burst)
+        self._last_refill = time.monotonic()
+        self._rate = getattr(settings, 'STRAVA_RATE_LIMIT_15MIN', 200) / SHORT_WINDOW_SECONDS
+
+    def _take_token(self):
+        # 进程内令牌桶：按 15 分钟额度均匀补充，最多累积 burst 个
+        while True:
+            with self._lock:
+                current = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (current - self._last_refill) * self._rate)
+                self._last_refill = current
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self._rate
+            time.sleep(wait_seconds)
+
+    def _create_usage(self, current_time):
+        StravaApiUsage.objects.get_or_create(pk=1, defaults={
+            'short_limit': getattr(settings, 'STRAVA_RATE_LIMIT_15MIN', 200),
+            'daily_limit': getattr(settings, 'STRAVA_RATE_LIMIT_DAILY', 2000),
+            'short_window_start': get_short_window_start(current_time),
+            'daily_window_start': get_daily_window_start(current_time),
+        })
+
+    def _reserve(self, current_time):
+        """
+        一条条件 UPDATE 完成换窗口和预占：窗口已过期时用量从 1 重新计，否则加 1 且不能超出额度。
+        UPDATE 是原子的，多个进程同时预占时不会超出额度。返回是否预占成功（没有用量行时也返回 False）。
+        """
+        short_start = get_short_window_start(current_time)
+        daily_start = get_daily_window_start(current_time)
+        short_expired = Q(short_window_start__lt=short_start)
+        daily_expired = Q(daily_window_start__lt=daily_start)
+        return StravaApiUsage.objects.filter(
+            short_expired | Q(short_usage__lt=F('short_limit') - self._margin),
+            daily_expired | Q(daily_usage__lt=F('daily_limit') - self._margin),
+            pk=1,
+        ).update(
+            short_usage=Case(When(short_expired, then=Value(1)), default=F('short_usage') + 1),
+            short_window_start=Case(When(short_expired, then=Value(short_start)), default=F('short_window_start')),
+            daily_usage=Case(When(daily_expired, then=Value(1)), default=F('daily_usage') + 1),
+            daily_window_start=Case(When(daily_expired, then=Value(daily_start)), default=F('daily_window_start')),
+        ) == 1
+
+    def acquire(self, wait=True):
+        """
+        在发出一次 Strava 请求之前调用。额度不足时等待到下一个 15 分钟窗口；
+        wait=False（例如 Web 请求中）或日额度已用完时抛出 StravaRateLimitExceeded。
+        """
+        self._take_token()
+        while True:
+            current_time = timezone.now()
+            if self._reserve(current_time):
+                return
+            usage = StravaApiUsage.objects.filter(pk=1).first()
+            if usage is None:
+                # 第一次调用：创建用量行后重试
+                self._create_usage(current_time)
+                continue
+            if usage.daily_window_start >= get_daily_window_start(current_time) and usage.daily_usage >= usage.daily_limit - self._margin:
+                raise StravaRateLimitExceeded(
+                    f"Strava daily rate limit reached ({usage.daily_usage}/{usage.daily_limit}).")
+            if not wait:
+                raise StravaRateLimitExceeded(
+                    f"Strava 15-minute rate limit reached ({usage.short_usage}/{usage.short_limit}).")
+            next_window = get_short_window_start(current_time) + timedelta(seconds=SHORT_WINDOW_SECONDS)
+            remaining = max(1.0, (next_window - timezone.now()).total_seconds() + 1)
+            while remaining > 0:
+                # 可能要等将近 15 分钟：分段等待，正在执行的同步任务的租约不会在等待中过期
+                renew_lease()
+                step = min(remaining, WAIT_STEP_SECONDS)
+                time.sleep(step)
+                remaining -= step
+
+    def update(self, response):
+        """
+        在收到 Strava 响应后调用，用响应头中的权威用量校正共享额度。
+        """
+        values = parse_rate_limit_headers(response.headers)
+        if values is None:
+            return
+        short_limit, short_usage, daily_limit, daily_usage = values
+        if response.status_code == 429:
+            # 已被限流：把当前窗口标记为用完，其他进程也会停下来等待
+            short_usage = max(short_usage, short_limit)
+        with self._lock:
+            self._rate = short_limit / SHORT_WINDOW_SECONDS
+        # 一条 UPDATE 校正；用量行在 acquire() 中已经创建
+        StravaApiUsage.objects.filter(pk=1).update(
+            short_limit=short_limit,
+            daily_limit=daily_limit,
+            short_usage=Greatest(F('short_usage'), short_usage),
+            daily_usage=Greatest(F('daily_usage'), daily_usage),
+        )
+
+# 模块级共享实例，services.py 和 views_strava.py 都通过它发出请求
+rate_limiter = StravaRateLimiter()
@@ -0,0 +1,60 @@
+# strava_web/records.py
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from strava_web.models import Activity, PersonalRecord, RACE_FILTER
+
+User = get_user_model()
+
+def _best_races(activities):
+    # chip_time 为 0 的比赛没有有效成绩，不算个人最好成绩；成绩相同时取较早的一次
+    return activities.filter(RACE_FILTER, chip_time__gt=0, race_distance__isnull=False).order_by(
+        'chip_time', 'start_date_local', 'pk'
+    )
+
+def refresh_personal_records(user_id, race_distances):
+    """
+    活动写入、修改或删除后调用：重新计算该用户受影响的比赛距离的最好成绩。
+    race_distances 应包含修改前后的距离，活动改了距离或不再是比赛时旧距离的记录也能更新。
+    """
+    race_distances = {d for d in race_distances if d}
+    if not race_distances:
+        return
+    records = []
+    for race_distance in race_distances:
+        best = _best_races(Activity.objects.filter(user_id=user_id, race_distance=race_distance)).values_list(
+            'pk', 'chip_time', 'start_date_local'
+        ).first()
+        if best:
+            records.append(PersonalRecord(
+                user_id=user_id, race_distance=race_distance, activity_id=best[0], chip_time=best[1], date=best[2],
+            ))
+    # 整体替换这几个距离的记录：活动改了距离时，一对一的 activity 不会和旧记录冲突
+    with transaction.atomic():
+        PersonalRecord.objects.filter(user_id=user_id, race_distance__in=race_distances).delete()
+        PersonalRecord.objects.bulk_create(records)
+
+def rebuild_personal_records(stdout, users=None, chunk_size=500):
+    """
+    为已有数据重建个人最好成绩表，每批 chunk_size 个用户。返回写入的行数。
+    """
+    if users is None:
+        users = User.objects.all()
+    user_ids = list(users.order_by('pk').values_list('pk', flat=True))
+    created = 0
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        records = {}
+        for pk, user_id, race_distance, chip_time, start_date_local in _best_races(
+            Activity.objects.filter(user_id__in=chunk)
+        ).values_list('pk', 'user_id', 'race_distance', 'chip_time', 'start_date_local').iterator():
+            # 已按成绩排序，每个 (用户, 距离) 第一次出现的就是最好成绩
+            records.setdefault((user_id, race_distance), PersonalRecord(
+                user_id=user_id, race_distance=race_distance, activity_id=pk,
+                chip_time=chip_time, date=start_date_local,
+            ))
+        with transaction.atomic():
+            PersonalRecord.objects.filter(user_id__in=chunk).delete()
+            PersonalRecord.objects.bulk_create(records.values(), batch_size=1000)
+        created += len(records)
+        stdout.write(f"Rebuilt personal records for {min(i + chunk_size, len(user_ids))}/{len(user_ids)} users ({created} rows).")
+    return created
@@ -0,0 +1,133 @@
+# strava_web/rollups.py
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q, F, Sum, Count, ExpressionWrapper, FloatField, Value, OuterRef, Subquery
+from django.db.models.functions import TruncDate, Coalesce
+from strava_web.models import Activity, ActivityDailyRollup
+
+User = get_user_model()
+
+HR_FILTER = Q(has_heartrate=True, average_heartrate__gt=0, moving_time__gt=0)
+
+def get_local_date(start_date_local):
+    # start_date_local 是用户本地时间（标记为 UTC），直接取日期即为用户本地日期
+    return start_date_local.astimezone(dt_timezone.utc).date()
+
+def _aggregate_daily(activities):
+    """
+    按 (用户, 本地日期) 分组汇总跑步活动，返回未保存的 ActivityDailyRollup 列表。
+    """
+    time_hr = ExpressionWrapper(F('moving_time') * F('average_heartrate'), output_field=FloatField())
+    rows = activities.filter(activity_type='Run').order_by().annotate(
+        date=TruncDate('start_date_local', tzinfo=dt_timezone.utc),
+    ).values('user_id', 'date').annotate(
+        total_distance=Coalesce(Sum('distance'), Value(0.0)),
+        total_moving_time=Coalesce(Sum('moving_time'), Value(0)),
+        total_elapsed_time=Coalesce(Sum('elapsed_time'), Value(0)),
+        total_elevation_gain=Coalesce(Sum('elevation_gain'), Value(0.0)),
+        total_count=Count('id'),
+        total_hr_time=Coalesce(Sum(time_hr, filter=HR_FILTER), Value(0.0)),
+        total_hr_moving_time=Coalesce(Sum('moving_time', filter=HR_FILTER), Value(0)),
+    )
+    return [
+        ActivityDailyRollup(
+            user_id=row['user_id'],
+            date=row['date'],
+            distance=row['total_distance'],
+            moving_time=row['total_moving_time'],
+            elapsed_time=row['total_elapsed_time'],
+            elevation_gain=row['total_elevation_gain'],
+            count=row['total_count'],
+            hr_time=row['total_hr_time'],
+            hr_moving_time=row['total_hr_moving_time'],
+        )
+        for row in rows
+    ]
+
+def _day_range(dates):
+    # 把日期转成 start_date_local 的范围条件（不对列取函数，便于使用索引）
+    condition = Q(pk__in=[])
+    for day in dates:
+        start = datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+        condition |= Q(start_date_local__gte=start, start_date_local__lt=start + timedelta(days=1))
+    return condition
+
+def refresh_daily_rollups(user_id, dates):
+    """
+    活动写入、修改或删除后调用：只重新汇总该用户受影响的那几天。
+    重新汇总而不是加减差值，活动改了日期、类型或被删除都能保持正确。
+    """
+    dates = set(dates)
+    if not dates:
+        return
+    with transaction.atomic():
+        ActivityDailyRollup.objects.filter(user_id=user_id, date__in=dates).delete()
+        ActivityDailyRollup.objects.bulk_create(
+            _aggregate_daily(Activity.objects.filter(_day_range(dates), user_id=user_id))
+        )
+
+def rebuild_daily_rollups(stdout, users=None, chunk_size=500):
+    """
+    为已有数据重建汇总表，每批 chunk_size 个用户一条分组 SQL。返回写入的行数。
+    """
+    if users is None:
+        users = User.objects.all()
+    user_ids = list(users.order_by('pk').values_list('pk', flat=True))
+    created = 0
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        with transaction.atomic():
+            ActivityDailyRollup.objects.filter(user_id__in=chunk).delete()
+            rollups = ActivityDailyRollup.objects.bulk_create(
+                _aggregate_daily(Activity.objects.filter(user_id__in=chunk)), batch_size=1000
+            )
+        created += len(rollups)
+        stdout.write(f"Rebuilt daily rollups for {min(i + chunk_size, len(user_ids))}/{len(user_ids)} users ({created} rows).")
+    return created
+
+def get_rollup_totals(start_date=None, end_date=None, users=None):
+    """
+    汇总 [start_date, end_date]（含两端，用户本地日期）内每个用户的跑步数据，
+    返回按 user_id 分组的查询集，字段为 total_distance, total_moving_time, total_elapsed_time,
+    total_elevation_gain, total_count, total_hr_time, total_hr_moving_time（加权平均心率 = 后两者相除）。
+    可以继续 filter/order_by，用于排行榜和仪表盘的任意时间段统计。
+    """
+    rollups = ActivityDailyRollup.objects.all()
+    if start_date:
+        rollups = rollups.filter(date__gte=start_date)
+    if end_date:
+        rollups = rollups.filter(date__lte=end_date)
+    if users is not None:
+        rollups = rollups.filter(user__in=users)
+    return rollups.order_by().values('user_id').annotate(
+        total_distance=Sum('distance'),
+        total_moving_time=Sum('moving_time'),
+        total_elapsed_time=Sum('elapsed_time'),
+        total_elevation_gain=Sum('elevation_gain'),
+        total_count=Sum('count'),
+        total_hr_time=Sum('hr_time'),
+        total_hr_moving_time=Sum('hr_moving_time'),
+    )
+
+def get_rollup_total_subquery(column, start_date=None, end_date=None):
+    """
+    用户在 [start_date, end_date] 内 column 合计的关联子查询，可以 annotate 到用户查询集上
+    （按 pk 关联），没有数据时为 NULL。
+    """
+    totals = get_rollup_totals(start_date, end_date).filter(user_id=OuterRef('pk'))
+    return Subquery(totals.values(f'total_{column}'))
+
+def get_activity_years(user):
+    """
+    用户有活动的年份（倒序），从每日汇总表读取，不用在活动表上对日期取年份再去重。
+    汇总表只统计跑步；没有汇总行时（只有其他类型的活动，或汇总表还没建好）从活动表读取。
+    """
+    years = [day.year for day in ActivityDailyRollup.objects.filter(user=user).dates('date', 'year', order='DESC')]
+    if not years:
+        years = [
+            day.year for day in Activity.objects.filter(user=user).datetimes(
+                'start_date_local', 'year', order='DESC', tzinfo=dt_timezone.utc
+            )
+        ]
+    return years
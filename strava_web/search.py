@@ -0,0 +1,57 @@
+# strava_web/search.py
+import re
+from django.db import connection
+from django.db.models import Q, FloatField
+from django.db.models.expressions import RawSQL
+
+# 活动名称的全文索引：MySQL 用 FULLTEXT（ngram 分词，中文也能搜，不用停用词），SQLite 用 FTS5 虚拟表，
+# 都由 0023_activity_name_fulltext 迁移创建。MySQL 的全文索引随表自动更新；
+# SQLite 的 FTS5 表由触发器同步，批量写入（bulk_create / update）也会同步。
+FTS_TABLE = 'strava_web_activity_fts'
+
+def get_search_terms(text):
+    # 只取字母、数字和汉字组成的词，全文检索语法里的运算符不会被用户输入带进去
+    return re.findall(r'\w+', text or '')[:10]
+
+def _match_query(terms):
+    # 每个词都必须出现，按前缀匹配
+    if connection.vendor == 'mysql':
+        return ' '.join(f'+{term}*' for term in terms)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def activity_name_filter(text):
+    """
+    返回按活动名称全文检索的 Q 条件，走全文索引，不用前后都是通配符的 LIKE 扫全表。
+    其他数据库没有全文索引时退回 icontains。
+    """
+    terms = get_search_terms(text)
+    if not terms:
+        return Q(pk__in=[])
+    if connection.vendor == 'mysql':
+        sql = 'SELECT id FROM strava_web_activity WHERE MATCH(name) AGAINST (%s IN BOOLEAN MODE)'
+    elif connection.vendor == 'sqlite':
+        sql = f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+    else:
+        condition = Q()
+        for term in terms:
+            condition &= Q(name__icontains=term)
+        return condition
+    return Q(pk__in=RawSQL(sql, [_match_query(terms)]))
+
+def search_activities(queryset, text):
+    """
+    过滤活动名称匹配 text 的活动，并标注 relevance（越大越相关），可以按它排序。
+    """
+    queryset = queryset.filter(activity_name_filter(text))
+    terms = get_search_terms(text)
+    if connection.vendor == 'mysql' and terms:
+        relevance = RawSQL('MATCH(strava_web_activity.name) AGAINST (%s IN BOOLEAN MODE)', [_match_query(terms)], output_field=FloatField())
+    elif connection.vendor == 'sqlite' and terms:
+        # bm25() 越小越相关，取负数
+        relevance = RawSQL(
+            f'SELECT -bm25({FTS_TABLE}) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid = strava_web_activity.id',
+            [_match_query(terms)], output_field=FloatField(),
+        )
+    else:
+        relevance = RawSQL('0', [], output_field=FloatField())
+    return queryset.annotate(relevance=relevance)
@@ -1,49 +1,34 @@
 # strava_web/services.py
+import hashlib
+import json
 import requests
 from datetime import timedelta, timezone
 from django.conf import settings
 from django.utils.timezone import now
-from django.db import transaction
+from django.db import transaction, connection
+from django.db.models import Q, F, Sum, Count, Max, ExpressionWrapper, FloatField, OuterRef, Subquery
+from django.utils.dateparse import parse_datetime
 from django.contrib.auth import get_user_model
-from strava_web.models import Activity
-from strava_web.utils import get_monday_of_week, get_float, get_int, get_days_ago, local_now
+from strava_web.models import Activity, ActivityDailyRollup, StravaWebhookEvent, StravaSyncState
+from strava_web.rate_limit import StravaRateLimitExceeded
+from strava_web.sync_queue import SyncLeaseLost, renew_lease
+from strava_web.strava_client import strava_client
+from strava_web.rollups import refresh_daily_rollups, get_local_date
+from strava_web.records import refresh_personal_records
+from strava_web.caching import bump_user_data
+from strava_web.tokens import confirm_deauthorization
+from strava_web.utils import get_float, get_int, get_athlete_today, get_athlete_week_windows, parse_strava_timezone
 
 User = get_user_model() # 在服务层获取用户模型
 
-def refresh_strava_token(user_instance):
+class StravaSyncError(Exception):
     """
-    使用 refresh_token 获取新的 access_token 和 refresh_token。
+    同步中途获取或处理活动页失败。已处理的页照常保存，counts 是失败前的写入统计；
+    调用者据此重建排行榜，并按失败处理（队列任务进入退避重试）。
     """
-    if not user_instance.strava_refresh_token:
-        raise ValueError("No refresh token available for this user.")
-
-    payload = {
-        'client_id': settings.STRAVA_CLIENT_ID,
-        'client_secret': settings.STRAVA_CLIENT_SECRET,
-        'grant_type': 'refresh_token',
-        'refresh_token': user_instance.strava_refresh_token
-    }
-
-    try:
-        response = requests.post(settings.STRAVA_TOKEN_URL, data=payload)
-        response.raise_for_status()
-        token_data = response.json()
-
-        # 更新用户模型中的令牌信息
-        # 使用原子性操作确保数据一致性
-        with transaction.atomic():
-            user_instance.strava_access_token = token_data['access_token']
-            user_instance.strava_refresh_token = token_data['refresh_token']
-            user_instance.strava_token_expires_at = now() + timedelta(seconds=token_data['expires_in'])
-            user_instance.save(update_fields=['strava_access_token', 'strava_refresh_token', 'strava_token_expires_at'])
-
-        return {
-            'access_token': token_data['access_token'],
-            'refresh_token': token_data['refresh_token'],
-            'expires_in': token_data['expires_in']
-        }
-    except requests.exceptions.RequestException as e:
-        raise Exception(f"Failed to refresh Strava token: {e}")
+    def __init__(self, error, counts):
+        super().__init__(str(error))
+        self.counts = counts
 
 def guess_race_distance(distance_meters):
     if 800 <= distance_meters <= 1000:
@@ -73,76 +58,247 @@ def guess_race_distance(distance_meters):
     else:
         return "Other" # Or handle other cases as needed
 
-#@transaction.atomic # 确保数据同步的原子性
-def sync_strava_data_for_user(user_instance, days, stdout):
+# 同步时由 Strava 数据覆盖的 Activity 字段
+ACTIVITY_SYNC_FIELDS = [
+    'name', 'activity_type', 'workout_type', 'distance', 'moving_time', 'elapsed_time', 'chip_time',
+    'race_distance', 'elevation_gain', 'start_date', 'start_date_local', 'timezone', 'average_speed',
+    'max_speed', 'average_heartrate', 'max_heartrate', 'average_cadence', 'has_heartrate', 'has_power', 'is_race',
+]
+
+# 参与指纹计算的 Strava 摘要字段（即 ACTIVITY_SYNC_FIELDS 的来源）
+STRAVA_SUMMARY_FIELDS = [
+    'name', 'type', 'workout_type', 'distance', 'moving_time', 'elapsed_time', 'total_elevation_gain',
+    'start_date', 'start_date_local', 'timezone', 'average_speed', 'max_speed', 'average_heartrate',
+    'max_heartrate', 'average_cadence', 'has_heartrate', 'has_power',
+]
+
+def get_activity_fingerprint(activity_summary):
     """
-    获取用户的 Strava 数据（统计和跑步比赛活动）。
+    Strava 摘要内容的指纹，指纹相同说明活动没有变化，可以跳过写入。
     """
-    access_token = user_instance.get_strava_access_token() # 使用用户模型的方法获取 token
-    if not access_token:
-        raise ValueError("Cannot get Strava access token for this user. Re-authorization may be needed.")
+    payload = json.dumps([activity_summary.get(field) for field in STRAVA_SUMMARY_FIELDS], separators=(',', ':'))
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
 
-    headers = {'Authorization': f'Bearer {access_token}'}
+def get_activity_defaults(activity_summary):
+    """
+    将 Strava 活动摘要转换为 Activity 字段值。
+    """
+    is_race = (activity_summary.get('workout_type') == 1)
+    chip_time = activity_summary.get('moving_time', 0) if is_race else 0
+    race_distance = guess_race_distance(activity_summary.get('distance', 0)) if is_race else None
+    return {
+        'name': activity_summary.get('name', ''),
+        'activity_type': activity_summary.get('type', 'Run'),
+        'workout_type': activity_summary.get('workout_type') if activity_summary.get('workout_type') else 0,
+        'distance': activity_summary.get('distance', 0),
+        'moving_time': activity_summary.get('moving_time', 0),
+        'elapsed_time': activity_summary.get('elapsed_time', 0),
+        'chip_time': chip_time,
+        'race_distance': race_distance,
+        'elevation_gain': activity_summary.get('total_elevation_gain', 0),
+        'start_date': parse_datetime(activity_summary.get('start_date')),
+        'start_date_local': parse_datetime(activity_summary.get('start_date_local')),
+        'timezone': activity_summary.get('timezone'),
+        'average_speed': activity_summary.get('average_speed'),
+        'max_speed': activity_summary.get('max_speed'),
+        'average_heartrate': activity_summary.get('average_heartrate'),
+        'max_heartrate': activity_summary.get('max_heartrate'),
+        'average_cadence': activity_summary.get('average_cadence'),
+        'has_heartrate': activity_summary.get('has_heartrate', False),
+        'has_power': activity_summary.get('has_power', False),
+        'is_race': is_race,
+    }
 
-    # 1. 获取聚合统计数据
-    stdout.write(f"Last Sync of user ({user_instance.username}): {user_instance.last_strava_sync} UTC")
+def upsert_activities(user_instance, activity_summaries):
+    """
+    一页活动一次性写入：一次 SELECT 取出已有记录的指纹，指纹未变的活动直接跳过，
+    新增和有变化的活动用一次批量 upsert 写入，整页在同一个事务中完成。
+    返回 inserted / updated / unchanged 计数（unchanged 即省掉的写入）。
+    """
+    existing = {
+        strava_id: (sync_hash, start_date_local, race_distance)
+        for strava_id, sync_hash, start_date_local, race_distance in Activity.objects.filter(
+            strava_id__in=[a.get('id') for a in activity_summaries]
+        ).values_list('strava_id', 'sync_hash', 'start_date_local', 'race_distance')
+    }
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    to_write = {}
+    changed_dates = set() # 需要重新汇总的日期（新旧日期都算）
+    changed_distances = set() # 需要重新计算个人最好成绩的比赛距离（新旧距离都算）
+    for activity_summary in activity_summaries:
+        strava_id = activity_summary.get('id')
+        sync_hash = get_activity_fingerprint(activity_summary)
+        if strava_id not in existing:
+            counts['inserted'] += 1
+        elif existing[strava_id][0] == sync_hash:
+            counts['unchanged'] += 1
+            continue
+        else:
+            counts['updated'] += 1
+            changed_dates.add(get_local_date(existing[strava_id][1]))
+            changed_distances.add(existing[strava_id][2])
+        to_write[strava_id] = Activity(
+            user=user_instance, strava_id=strava_id, sync_hash=sync_hash,
+            **get_activity_defaults(activity_summary)
+        )
+        if to_write[strava_id].start_date_local:
+            changed_dates.add(get_local_date(to_write[strava_id].start_date_local))
+        changed_distances.add(to_write[strava_id].race_distance)
+
+    if to_write:
+        # MySQL 的 ON DUPLICATE KEY UPDATE 不能指定冲突字段，其他数据库需要指定
+        unique_fields = ['strava_id'] if connection.features.supports_update_conflicts_with_target else None
+        with transaction.atomic():
+            Activity.objects.bulk_create(
+                list(to_write.values()),
+                update_conflicts=True,
+                unique_fields=unique_fields,
+                update_fields=ACTIVITY_SYNC_FIELDS + ['sync_hash', 'updated_at'],
+            )
+            refresh_daily_rollups(user_instance.pk, changed_dates)
+            refresh_personal_records(user_instance.pk, changed_distances)
+            bump_user_data(user_instance.pk)
+    return counts
+
+def delete_activity(user_instance, strava_activity_id):
+    """
+    删除一个活动并更新当天的汇总和个人最好成绩，返回是否有活动被删除。
+    """
+    with transaction.atomic():
+        removed = list(
+            Activity.objects.filter(user=user_instance, strava_id=strava_activity_id).values_list('start_date_local', 'race_distance')
+        )
+        deleted, _ = Activity.objects.filter(user=user_instance, strava_id=strava_activity_id).delete()
+        refresh_daily_rollups(user_instance.pk, [get_local_date(d) for d, _ in removed])
+        refresh_personal_records(user_instance.pk, [race_distance for _, race_distance in removed])
+        if deleted:
+            bump_user_data(user_instance.pk)
+    return deleted > 0
+
+def get_sync_state(user_instance):
+    state, _ = StravaSyncState.objects.get_or_create(user=user_instance)
+    return state
+
+def get_page_start_dates(activities_data):
+    return [parse_datetime(a['start_date']) for a in activities_data if a.get('start_date')]
+
+# recent (4 周) / ytd / all_time 统计字段，对应 Strava stats 接口的 recent_run_totals / ytd_run_totals / all_run_totals
+TOTALS_PERIODS = {'recent_run': 'recent_run_totals', 'ytd_run': 'ytd_run_totals', 'all_time_run': 'all_run_totals'}
+TOTALS_COLUMNS = ['distance', 'count', 'moving_time', 'elapsed_time', 'elevation_gain']
+TOTALS_FIELDS = [f'{period}_{column}' for period in TOTALS_PERIODS for column in TOTALS_COLUMNS]
+
+def save_totals(user_instance, totals):
+    for field, value in totals.items():
+        setattr(user_instance, field, value)
+    user_instance.save(update_fields=TOTALS_FIELDS)
+
+def get_local_totals(user_instance):
+    """
+    用每日汇总表计算 recent (最近 28 天) / ytd / all_time 统计，一条 SQL，不调用 Strava API。
+    日期按用户所在时区计算。
+    """
+    today = get_athlete_today(user_instance.strava_timezone)
+    filters = {
+        'recent_run': Q(date__gt=today - timedelta(days=28)),
+        'ytd_run': Q(date__gte=today.replace(month=1, day=1)),
+        'all_time_run': None,
+    }
+    totals = ActivityDailyRollup.objects.filter(user=user_instance).aggregate(**{
+        f'{period}_{column}': Sum(column, filter=filters[period])
+        for period in TOTALS_PERIODS for column in TOTALS_COLUMNS
+    })
+    return {field: value or 0 for field, value in totals.items()}
+
+def get_totals_drift(local_totals, remote_totals):
+    # 本地与 Strava 的 all_time 次数和距离的最大相对偏差
+    return max(
+        abs(local_totals[field] - remote_totals[field]) / max(remote_totals[field], 1)
+        for field in ('all_time_run_count', 'all_time_run_distance')
+    )
+
+def needs_stats_reconcile(state):
+    """
+    是否需要调用 Strava stats 接口：未开启 STRAVA_LOCAL_TOTALS、历史活动还没回填完（本地数据不全）、
+    超过对账周期 (STRAVA_STATS_RECONCILE_HOURS)，或上次对账偏差超过 STRAVA_STATS_DRIFT_RATIO。
+    """
+    if not getattr(settings, 'STRAVA_LOCAL_TOTALS', False) or state.backfill_completed_at is None:
+        return True
+    if state.stats_reconciled_at is None or state.stats_drift > getattr(settings, 'STRAVA_STATS_DRIFT_RATIO', 0.01):
+        return True
+    reconcile_hours = getattr(settings, 'STRAVA_STATS_RECONCILE_HOURS', 168)
+    return state.stats_reconciled_at < now() - timedelta(hours=reconcile_hours)
+
+def fetch_strava_stats(user_instance, access_token, state, stdout):
+    """
+    调用 Strava stats 接口保存统计。开启本地统计时同时与本地结果对账，记录偏差。
+    """
     try:
         stdout.write(f"Get user stats from Strava")
-        stats_url = f"{settings.STRAVA_API_BASE_URL}/athletes/{user_instance.strava_id}/stats"
-        stats_response = requests.get(stats_url, headers=headers)
+        stats_response = strava_client.get(f"/athletes/{user_instance.strava_id}/stats", access_token, 'athlete_stats')
         stats_response.raise_for_status()
         stats_data = stats_response.json()
-
-        # 将 stats_data 映射到 user_instance 的统计字段并保存
-        user_instance.recent_run_distance = get_float(stats_data['recent_run_totals']['distance'])
-        user_instance.recent_run_count = get_int(stats_data['recent_run_totals']['count'])
-        user_instance.recent_run_moving_time = get_int(stats_data['recent_run_totals']['moving_time'])
-        user_instance.recent_run_elapsed_time = get_int(stats_data['recent_run_totals']['elapsed_time'])
-        user_instance.recent_run_elevation_gain = get_int(stats_data['recent_run_totals']['elevation_gain'])
-
-        user_instance.ytd_run_distance = get_float(stats_data['ytd_run_totals']['distance'])
-        user_instance.ytd_run_count = get_int(stats_data['ytd_run_totals']['count'])
-        user_instance.ytd_run_moving_time = get_int(stats_data['ytd_run_totals']['moving_time'])
-        user_instance.ytd_run_elapsed_time = get_int(stats_data['ytd_run_totals']['elapsed_time'])
-        user_instance.ytd_run_elevation_gain = get_int(stats_data['ytd_run_totals']['elevation_gain'])
-
-        user_instance.all_time_run_distance = get_float(stats_data['all_run_totals']['distance'])
-        user_instance.all_time_run_count = get_int(stats_data['all_run_totals']['count'])
-        user_instance.all_time_run_moving_time = get_int(stats_data['all_run_totals']['moving_time'])
-        user_instance.all_time_run_elapsed_time = get_int(stats_data['all_run_totals']['elapsed_time'])
-        user_instance.all_time_run_elevation_gain = get_int(stats_data['all_run_totals']['elevation_gain'])
-        user_instance.save(update_fields=[
-            'recent_run_distance', 'recent_run_count', 'recent_run_moving_time', 'recent_run_elapsed_time', 'recent_run_elevation_gain',
-            'ytd_run_distance', 'ytd_run_count', 'ytd_run_moving_time', 'ytd_run_elapsed_time', 'ytd_run_elevation_gain',
-            'all_time_run_distance', 'all_time_run_count', 'all_time_run_moving_time', 'all_time_run_elapsed_time', 'all_time_run_elevation_gain',
-        ])
-        stdout.write(f"Save user stats. Recent run counts: {user_instance.recent_run_count}")
-        stdout.write(f"Save user stats. Recent run distance: {user_instance.recent_run_distance}")
     except requests.exceptions.RequestException as e:
         stdout.write(f"Failed to get Strava stats for user {user_instance.first_name}({user_instance.id}): {e}")
-        # 这里可以选择记录错误，或者抛出异常让调用者处理
+        return
+
+    # 将 stats_data 映射到 user_instance 的统计字段并保存
+    remote_totals = {}
+    for period, key in TOTALS_PERIODS.items():
+        for column in TOTALS_COLUMNS:
+            value = stats_data[key][column]
+            remote_totals[f'{period}_{column}'] = get_float(value) if column == 'distance' else get_int(value)
+    save_totals(user_instance, remote_totals)
+    stdout.write(f"Save user stats. Recent run counts: {user_instance.recent_run_count}")
+    stdout.write(f"Save user stats. Recent run distance: {user_instance.recent_run_distance}")
+
+    if getattr(settings, 'STRAVA_LOCAL_TOTALS', False) and state.backfill_completed_at:
+        drift = get_totals_drift(get_local_totals(user_instance), remote_totals)
+        state.record_stats_reconcile(drift)
+        stdout.write(f"Stats reconciled for user {user_instance.id}: drift {drift:.2%}")
+
+#@transaction.atomic # 确保数据同步的原子性
+def sync_strava_data_for_user(user_instance, days, stdout):
+    """
+    获取用户的 Strava 数据（统计和跑步比赛活动）。
+    活动页获取或处理失败时，记录失败并抛出 StravaSyncError。
+    """
+    state = get_sync_state(user_instance)
+    try:
+        access_token = user_instance.get_strava_access_token() # 使用用户模型的方法获取 token
+        if not access_token:
+            raise ValueError("Cannot get Strava access token for this user. Re-authorization may be needed.")
+    except (StravaRateLimitExceeded, SyncLeaseLost):
+        raise
+    except Exception as e:
+        state.record_failure(e)
+        raise
 
-    # 2. 获取跑步比赛活动数据 (增量更新)
-    latest_activity = Activity.objects.filter(user=user_instance).order_by('-start_date').first()
+    stdout.write(f"Last Sync of user ({user_instance.username}): {user_instance.last_strava_sync} UTC")
+
+    # 1. 获取跑步比赛活动数据 (增量更新，从高水位继续)
     params = {'per_page': 200, 'type': 'Run'} # 默认只获取 Run 类型活动
     if days:
         utc_last_sync = now() - timedelta(days=days)
-    elif latest_activity:
-        utc_last_sync = latest_activity.start_date
+    elif state.high_water_mark:
+        utc_last_sync = state.high_water_mark
     else:
-        utc_last_sync = now() - timedelta(days=1)
+        latest_activity = Activity.objects.filter(user=user_instance).order_by('-start_date').first()
+        utc_last_sync = latest_activity.start_date if latest_activity else now() - timedelta(days=1)
     params['after'] = int(utc_last_sync.timestamp())
     stdout.write(f"Activity Pull Params: {params}")
 
     page = 1
     has_more_activities = True
     has_change = False
+    page_error = None
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
 
     while has_more_activities:
         params['page'] = page
+        # 每页之间延长同步任务的租约；租约丢失时抛出 SyncLeaseLost，停止同步
+        renew_lease()
         try:
-            activities_url = f"{settings.STRAVA_API_BASE_URL}/athlete/activities"
-            activities_response = requests.get(activities_url, headers=headers, params=params)
+            activities_response = strava_client.get("/athlete/activities", access_token, 'athlete_activities', params=params)
             activities_response.raise_for_status()
             activities_data = activities_response.json()
 
@@ -150,126 +306,289 @@ def sync_strava_data_for_user(user_instance, days, stdout):
                 has_more_activities = False
                 break
 
-            for activity_summary in activities_data:
-                if activity_summary.get('type') == 'Run':
+            runs = [a for a in activities_data if a.get('type') == 'Run']
+            if runs:
+                page_counts = upsert_activities(user_instance, runs)
+                for k, v in page_counts.items():
+                    counts[k] += v
+                if page_counts['inserted'] or page_counts['updated']:
                     has_change = True
-                    is_race = (activity_summary.get('workout_type') == 1)
-                    chip_time = activity_summary.get('moving_time', 0) if is_race else 0
-                    race_distance = guess_race_distance(activity_summary.get('distance', 0)) if is_race else None
-                    
-                    Activity.objects.update_or_create(
-                        user=user_instance,
-                        strava_id=activity_summary.get('id'),
-                        defaults={
-                            'name': activity_summary.get('name', ''),
-                            'activity_type': activity_summary.get('type', 'Run'),
-                            'workout_type': activity_summary.get('workout_type') if activity_summary.get('workout_type') else 0,
-                            'distance': activity_summary.get('distance', 0),
-                            'moving_time': activity_summary.get('moving_time', 0),
-                            'elapsed_time': activity_summary.get('elapsed_time', 0),
-                            'chip_time': chip_time,
-                            'race_distance': race_distance,
-                            'elevation_gain': activity_summary.get('total_elevation_gain', 0),
-                            'start_date': activity_summary.get('start_date'),
-                            'start_date_local': activity_summary.get('start_date_local'),
-                            'timezone': activity_summary.get('timezone'),
-                            'average_speed': activity_summary.get('average_speed'),
-                            'max_speed': activity_summary.get('max_speed'),
-                            'average_heartrate': activity_summary.get('average_heartrate'),
-                            'max_heartrate': activity_summary.get('max_heartrate'),
-                            'average_cadence': activity_summary.get('average_cadence'),
-                            'has_heartrate': activity_summary.get('has_heartrate', False),
-                            'has_power': activity_summary.get('has_power', False),
-                            'is_race': is_race, 
-                        }
-                    )
-                    stdout.write(f"Processed run activity: {activity_summary.get('start_date')} (ID: {activity_summary['id']})")
+                stdout.write(f"Processed page {page}: {page_counts['inserted']} inserted, "
+                             f"{page_counts['updated']} updated, {page_counts['unchanged']} unchanged")
+            # 指定 after 时 Strava 按时间正序返回，本页处理完即可推进高水位
+            state.advance_high_water_mark(max(get_page_start_dates(activities_data), default=None))
             page += 1
             if len(activities_data) < params['per_page']:
                 has_more_activities = False
         except requests.exceptions.RequestException as e:
             stdout.write(f"Failed to get Strava activities for user {user_instance.id} (page {page}): {e}")
+            page_error = e
             has_more_activities = False # 遇到错误停止分页
+        except (StravaRateLimitExceeded, SyncLeaseLost):
+            raise # 额度用完或租约丢失，交给调用者停止本次同步，不更新 last_strava_sync
         except Exception as e:
             stdout.write(f"Error processing activity data for user {user_instance.id}: {e}")
+            page_error = e
             has_more_activities = False
 
     # 遍历所有获取到的跑步活动，计算本周数据
     if has_change:
         update_stats(user_instance, stdout)
 
+    # 2. 聚合统计数据：平时用本地活动计算，需要对账时才调用 Strava stats 接口
+    if needs_stats_reconcile(state):
+        fetch_strava_stats(user_instance, access_token, state, stdout)
+    else:
+        save_totals(user_instance, get_local_totals(user_instance))
+        stdout.write(f"Save local user stats. Recent run counts: {user_instance.recent_run_count}")
+
     # 更新最后同步时间
     user_instance.last_strava_sync = now()
     user_instance.save(update_fields=['last_strava_sync'])
-    stdout.write(f"Strava data sync completed for user {user_instance.id}.")
+    if page_error:
+        state.record_failure(page_error)
+        raise StravaSyncError(page_error, counts)
+    state.record_success()
+    stdout.write(f"Strava data sync completed for user {user_instance.id}: {counts['inserted']} inserted, "
+                 f"{counts['updated']} updated, {counts['unchanged']} unchanged.")
+    return counts
     
+def backfill_strava_history(user_instance, stdout, max_pages=None):
+    """
+    从最新往最早回填用户的全部历史活动。每页处理完就保存游标 (before)，
+    中断后再次运行会从上次停下的地方继续；每次只在内存中保留一页数据。
+    返回本次处理的页数。
+    """
+    state = get_sync_state(user_instance)
+    if state.backfill_completed_at:
+        stdout.write(f"Backfill already completed for user {user_instance.id} at {state.backfill_completed_at}.")
+        return 0
+    access_token = user_instance.get_strava_access_token()
+    if not access_token:
+        raise ValueError("Cannot get Strava access token for this user. Re-authorization may be needed.")
+
+    per_page = 200
+    pages = 0
+    has_change = False
+    while max_pages is None or pages < max_pages:
+        before = state.backfill_before or now()
+        params = {'per_page': per_page, 'page': 1, 'before': int(before.timestamp())}
+        try:
+            response = strava_client.get("/athlete/activities", access_token, 'athlete_activities', params=params)
+            response.raise_for_status()
+            activities_data = response.json()
+        except requests.exceptions.RequestException as e:
+            state.record_failure(e)
+            raise
+
+        runs = [a for a in activities_data if a.get('type') == 'Run']
+        if runs:
+            page_counts = upsert_activities(user_instance, runs)
+            if page_counts['inserted'] or page_counts['updated']:
+                has_change = True
+            stdout.write(f"Backfill before {before}: {page_counts['inserted']} inserted, "
+                         f"{page_counts['updated']} updated, {page_counts['unchanged']} unchanged")
+        pages += 1
+
+        # 没有 after 时 Strava 按时间倒序返回，本页最早的活动就是下一批的游标
+        start_dates = get_page_start_dates(activities_data)
+        if start_dates:
+            state.backfill_before = min(start_dates)
+        state.backfill_pages += 1
+        if len(activities_data) < per_page:
+            state.backfill_completed_at = now()
+        state.save(update_fields=['backfill_before', 'backfill_pages', 'backfill_completed_at', 'updated_at'])
+        state.advance_high_water_mark(max(start_dates, default=None))
+        if state.backfill_completed_at:
+            stdout.write(f"Backfill completed for user {user_instance.id} after {state.backfill_pages} pages.")
+            break
+
+    if has_change:
+        update_stats(user_instance, stdout)
+    state.record_success()
+    return pages
+
+def sync_strava_activity(user_instance, strava_activity_id, stdout):
+    """
+    只获取一个活动（webhook 事件触发），写入或删除对应的 Activity。
+    返回是否有数据变化。
+    """
+    access_token = user_instance.get_strava_access_token()
+    if not access_token:
+        raise ValueError("Cannot get Strava access token for this user. Re-authorization may be needed.")
+    response = strava_client.get(f"/activities/{strava_activity_id}", access_token, 'activity')
+    if response.status_code == 404:
+        # 活动已删除或设为私密
+        return delete_activity(user_instance, strava_activity_id)
+    response.raise_for_status()
+    activity_data = response.json()
+    if activity_data.get('type') != 'Run':
+        # 只保存跑步活动，类型被改为非跑步时删除
+        return delete_activity(user_instance, strava_activity_id)
+    counts = upsert_activities(user_instance, [activity_data])
+    stdout.write(f"Processed activity {strava_activity_id} for user {user_instance.id}: {counts}")
+    return bool(counts['inserted'] or counts['updated'])
+
+def process_webhook_event(event, stdout):
+    """
+    处理一个已入队的 Strava webhook 事件，返回活动数据是否有变化。
+    """
+    has_change = False
+    user_instance = User.objects.filter(strava_id=event.owner_id).first()
+    if user_instance is None:
+        stdout.write(f"Ignore event {event.id}: no user with Strava ID {event.owner_id}.")
+    elif event.is_deauthorization:
+        # 用户在 Strava 取消授权：向 Strava 确认后才清除令牌
+        if confirm_deauthorization(user_instance):
+            stdout.write(f"User {user_instance.id} deauthorized Strava access.")
+        else:
+            stdout.write(f"Ignore event {event.id}: Strava authorization of user {user_instance.id} is still valid.")
+    elif event.object_type == 'activity':
+        # 删除事件也先向 Strava 读取活动，返回 404 才删除本地活动（见 sync_strava_activity），
+        # 伪造的删除事件不会删掉数据
+        has_change = sync_strava_activity(user_instance, event.object_id, stdout)
+        if has_change:
+            update_stats(user_instance, stdout)
+    event.processed_at = now()
+    event.error = ''
+    event.save(update_fields=['processed_at', 'error'])
+    return has_change
+
 def get_weekly_activities(user_instance):
-    start_of_28_days = get_days_ago(local_now(), 28)
+    _, _, start_of_28_days = get_athlete_week_windows(user_instance.strava_timezone)
     activities = Activity.objects.filter(
         activity_type='Run',
         start_date_local__gte=start_of_28_days,
         user=user_instance,
     ).order_by('start_date_local')
     return activities
-    
+
+# 由本地 Activity 计算的周/4 周统计字段
+WEEKLY_STATS_FIELDS = [
+    'weekly_run_distance', 'weekly_run_count', 'weekly_run_moving_time', 'weekly_run_elapsed_time',
+    'weekly_run_elevation_gain', 'weekly_max_heartrate', 'weekly_avg_heartrate',
+    'recent_max_heartrate', 'recent_avg_heartrate',
+]
+
+def get_empty_weekly_stats():
+    return {field: 0 for field in WEEKLY_STATS_FIELDS}
+
+def update_athlete_timezones(users):
+    """
+    用每个用户最近一次活动的 timezone 更新 strava_timezone，不需要调用 Strava API。返回更新的用户数。
+    """
+    latest_timezone = Activity.objects.filter(user=OuterRef('pk')).order_by('-start_date').values('timezone')[:1]
+    changed = []
+    for user in users.only('pk', 'strava_timezone').annotate(latest_timezone=Subquery(latest_timezone)).iterator():
+        tz_name = parse_strava_timezone(user.latest_timezone)
+        if tz_name and tz_name != user.strava_timezone:
+            user.strava_timezone = tz_name
+            changed.append(user)
+    User.objects.bulk_update(changed, ['strava_timezone'], batch_size=1000)
+    return len(changed)
+
+def compute_weekly_stats(users):
+    """
+    计算 users (查询集) 最近一周和 4 周的统计，返回 {user_id: {字段: 值}}。
+    每个时区一条分组 SQL，周的边界按用户自己的时区计算。
+    平均心率按移动时间加权，只统计有心率数据的活动。没有近期活动的用户不在结果中。
+    """
+    with_hr = Q(has_heartrate=True, average_heartrate__gt=0, moving_time__gt=0)
+    time_hr = ExpressionWrapper(F('moving_time') * F('average_heartrate'), output_field=FloatField())
+    stats = {}
+    for tz_name in users.order_by().values_list('strava_timezone', flat=True).distinct():
+        _, start_of_week, start_of_28_days = get_athlete_week_windows(tz_name)
+        this_week = Q(start_date_local__gte=start_of_week)
+        rows = Activity.objects.filter(
+            activity_type='Run',
+            start_date_local__gte=start_of_28_days,
+            user__in=users.filter(strava_timezone=tz_name).values('pk'),
+        ).order_by().values('user_id').annotate(
+            weekly_run_distance=Sum('distance', filter=this_week),
+            weekly_run_count=Count('id', filter=this_week),
+            weekly_run_moving_time=Sum('moving_time', filter=this_week),
+            weekly_run_elapsed_time=Sum('elapsed_time', filter=this_week),
+            weekly_run_elevation_gain=Sum('elevation_gain', filter=this_week),
+            weekly_max_heartrate=Max('max_heartrate', filter=this_week),
+            weekly_time_hr=Sum(time_hr, filter=this_week & with_hr),
+            weekly_hr_moving_time=Sum('moving_time', filter=this_week & with_hr),
+            recent_max_heartrate=Max('max_heartrate'),
+            recent_time_hr=Sum(time_hr, filter=with_hr),
+            recent_hr_moving_time=Sum('moving_time', filter=with_hr),
+        )
+        for row in rows:
+            stats[row['user_id']] = {
+                'weekly_run_distance': row['weekly_run_distance'] or 0.0,
+                'weekly_run_count': row['weekly_run_count'] or 0,
+                'weekly_run_moving_time': row['weekly_run_moving_time'] or 0,
+                'weekly_run_elapsed_time': row['weekly_run_elapsed_time'] or 0,
+                'weekly_run_elevation_gain': row['weekly_run_elevation_gain'] or 0.0,
+                'weekly_max_heartrate': row['weekly_max_heartrate'] or 0.0,
+                'weekly_avg_heartrate': row['weekly_time_hr'] / row['weekly_hr_moving_time'] if row['weekly_hr_moving_time'] else 0,
+                'recent_max_heartrate': row['recent_max_heartrate'] or 0.0,
+                'recent_avg_heartrate': row['recent_time_hr'] / row['recent_hr_moving_time'] if row['recent_hr_moving_time'] else 0,
+            }
+    return stats
+
 def update_stats(user_instance, stdout):
-    all_recent_activities = get_weekly_activities(user_instance)
-    start_of_week_local = get_monday_of_week(local_now())
-    if not all_recent_activities:
-        stdout.write(f"Weekly stats for user {user_instance.id} are up-to-date. No save needed.")
-        return
-    weekly_distance = 0.0
-    weekly_count = 0
-    weekly_moving_time = 0
-    weekly_moving_time1 = 0
-    weekly_elapsed_time = 0
-    weekly_elevation_gain = 0
-    weekly_time_hr = 0.0
-    weekly_max_heartrate_val = 0.0
-    recent_time_hr = 0.0
-    recent_moving_time1 = 0.0
-    recent_max_heartrate_val = 0.0
-    for activity in all_recent_activities:
-        if activity.has_heartrate and activity.average_heartrate is not None:
-            time_hr = activity.moving_time * activity.average_heartrate
-        else:
-            time_hr = None
-        if time_hr:
-            recent_moving_time1 += activity.moving_time
-            recent_time_hr += time_hr
-        if activity.max_heartrate is not None:
-            recent_max_heartrate_val = max(recent_max_heartrate_val, activity.max_heartrate)
-        if activity.start_date_local >= start_of_week_local:
-            weekly_distance += activity.distance
-            weekly_count += 1
-            weekly_moving_time += activity.moving_time
-            weekly_elapsed_time += activity.elapsed_time
-            weekly_elevation_gain += activity.elevation_gain
-            if time_hr:
-                weekly_moving_time1 += activity.moving_time
-                weekly_time_hr += time_hr
-            if activity.max_heartrate is not None:
-                weekly_max_heartrate_val = max(weekly_max_heartrate_val, activity.max_heartrate)
-    # 仅当计算出的周数据与现有数据不同时才保存，减少不必要的数据库写入
-    update_fields_for_weekly = []
-    update_fields_for_weekly.append('weekly_run_distance')
-    update_fields_for_weekly.append('weekly_run_count')
-    update_fields_for_weekly.append('weekly_run_moving_time')
-    update_fields_for_weekly.append('weekly_run_elapsed_time')
-    update_fields_for_weekly.append('weekly_run_elevation_gain')
-    update_fields_for_weekly.append('recent_max_heartrate')
-    update_fields_for_weekly.append('recent_avg_heartrate')
-    update_fields_for_weekly.append('weekly_max_heartrate')
-    update_fields_for_weekly.append('weekly_avg_heartrate')
-    user_instance.recent_max_heartrate = recent_max_heartrate_val
-    user_instance.recent_avg_heartrate = recent_time_hr / recent_moving_time1 if recent_moving_time1 else 0
-    user_instance.weekly_run_distance = weekly_distance
-    user_instance.weekly_run_count = weekly_count
-    user_instance.weekly_run_moving_time = weekly_moving_time
-    user_instance.weekly_run_elapsed_time = weekly_elapsed_time
-    user_instance.weekly_run_elevation_gain = weekly_elevation_gain
-    user_instance.weekly_max_heartrate = weekly_max_heartrate_val
-    user_instance.weekly_avg_heartrate = weekly_time_hr / weekly_moving_time1 if weekly_moving_time1 else 0
-    user_instance.save(update_fields=update_fields_for_weekly)
+    users = User.objects.filter(pk=user_instance.pk)
+    if update_athlete_timezones(users):
+        user_instance.strava_timezone = users.values_list('strava_timezone', flat=True).get()
+    values = compute_weekly_stats(users).get(user_instance.pk, get_empty_weekly_stats())
+    for field, value in values.items():
+        setattr(user_instance, field, value)
+    user_instance.weekly_stats_week_start = get_athlete_week_windows(user_instance.strava_timezone)[0]
+    user_instance.save(update_fields=WEEKLY_STATS_FIELDS + ['weekly_stats_week_start'])
     stdout.write(f"Weekly stats updated for user {user_instance.id}.")
 
+def recompute_stats(stdout, users=None, chunk_size=1000):
+    """
+    不调用 Strava API，按时区分组聚合算出用户的周/4 周统计，再按块 bulk_update 回写。
+    只写入数值或所属周有变化的用户。返回更新的用户数。
+    """
+    if users is None:
+        users = User.objects.all()
+    update_athlete_timezones(users)
+    stats = compute_weekly_stats(users)
+    week_starts = {}
+    empty = get_empty_weekly_stats()
+    fields = WEEKLY_STATS_FIELDS + ['weekly_stats_week_start']
+    changed = []
+    updated = 0
+    # 不按 id 排序：换周时只读过期的用户，排序会让数据库放弃 weekly_stats_week_start 索引而扫描整张用户表
+    for user in users.only('pk', 'strava_timezone', *fields).order_by().iterator(chunk_size=chunk_size):
+        if user.strava_timezone not in week_starts:
+            week_starts[user.strava_timezone] = get_athlete_week_windows(user.strava_timezone)[0]
+        values = dict(stats.get(user.pk, empty), weekly_stats_week_start=week_starts[user.strava_timezone])
+        if all(getattr(user, field) == value for field, value in values.items()):
+            continue
+        for field, value in values.items():
+            setattr(user, field, value)
+        changed.append(user)
+        if len(changed) >= chunk_size:
+            User.objects.bulk_update(changed, fields)
+            updated += len(changed)
+            changed = []
+    if changed:
+        User.objects.bulk_update(changed, fields)
+        updated += len(changed)
+    stdout.write(f"Weekly stats recomputed: {len(stats)} users with recent runs, {updated} users updated.")
+    return updated
+
+def rollover_weekly_stats(stdout, chunk_size=1000):
+    """
+    换周：只重新计算所在时区已经进入新一周、但周统计还停留在上一周的用户。
+    可以每小时运行一次，各时区的用户会在自己的周一零点之后被切换到新的一周。返回更新的用户数。
+    """
+    update_athlete_timezones(User.objects.all())
+    stale = Q(pk__in=[])
+    for tz_name in User.objects.order_by().values_list('strava_timezone', flat=True).distinct():
+        week_start_date = get_athlete_week_windows(tz_name)[0]
+        stale |= Q(strava_timezone=tz_name) & (
+            Q(weekly_stats_week_start__isnull=True) | Q(weekly_stats_week_start__lt=week_start_date)
+        )
+    users = User.objects.filter(stale)
+    if not users.exists():
+        stdout.write("Weekly stats are up-to-date for all users.")
+        return 0
+    return recompute_stats(stdout, users, chunk_size)
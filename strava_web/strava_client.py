@@ -0,0 +1,105 @@
+# strava_web/strava_client.py
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from django.conf import settings
+from strava_web.rate_limit import rate_limiter
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def is_connect_error(error):
+    # 连接没有建立，请求一定没有发出去（连接超时，或 DNS 解析、拒绝连接等建立连接时的错误）
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+class StravaClient:
+    """
+    所有 Strava API 调用共用的 HTTP 客户端。
+
+    使用带连接池的 requests.Session 复用 TCP/TLS 连接，对网络错误和 5xx 做有限次数的
+    指数退避重试（带随机抖动），每次请求都经过 rate_limiter，并按 endpoint 统计延迟。
+    """
+
+    def __init__(self):
+        self.timeout = getattr(settings, 'STRAVA_HTTP_TIMEOUT', (5, 30))
+        self.max_retries = getattr(settings, 'STRAVA_HTTP_MAX_RETRIES', 3)
+        self.backoff = getattr(settings, 'STRAVA_HTTP_BACKOFF_SECONDS', 1.0)
+        pool_size = getattr(settings, 'STRAVA_HTTP_POOL_SIZE', 10)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def _record(self, endpoint, seconds, failed):
+        with self._stats_lock:
+            stat = self._stats.setdefault(endpoint, {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            stat['count'] += 1
+            stat['total_seconds'] += seconds
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+            if failed:
+                stat['errors'] += 1
+
+    def _sleep_before_retry(self, attempt):
+        # 指数退避 + 全抖动，避免多个 worker 同时重试
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def request(self, method, url, endpoint, wait=True, idempotent=True, **kwargs):
+        """
+        发出一次 Strava 请求并返回最后一次的 Response（不检查状态码）。
+        重试次数用完仍然失败时，抛出最后一次的 requests 异常。
+        wait=False 时额度不足直接抛出 StravaRateLimitExceeded，并且不重试 429。
+        idempotent=False 的请求（只能使用一次的授权码、refresh token）只在连接没有建立时重试：
+        请求发出后超时或返回 5xx 时，Strava 可能已经用掉了它，重试只会失败。
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            rate_limiter.acquire(wait=wait)
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                self._record(endpoint, time.monotonic() - start, True)
+                if attempt >= self.max_retries or not (idempotent or is_connect_error(error)):
+                    raise
+            else:
+                self._record(endpoint, time.monotonic() - start, response.status_code >= 400)
+                rate_limiter.update(response)
+                retryable = idempotent and response.status_code in RETRY_STATUS_CODES and (wait or response.status_code != 429)
+                if not retryable or attempt >= self.max_retries:
+                    return response
+            self._sleep_before_retry(attempt)
+            attempt += 1
+
+    def get(self, path, access_token, endpoint, params=None, wait=True):
+        return self.request(
+            'GET',
+            f"{settings.STRAVA_API_BASE_URL}{path}",
+            endpoint,
+            wait=wait,
+            headers={'Authorization': f'Bearer {access_token}'},
+            params=params,
+        )
+
+    def post_token(self, payload, wait=True):
+        return self.request('POST', settings.STRAVA_TOKEN_URL, 'oauth_token', wait=wait, idempotent=False, data=payload)
+
+    def get_stats(self):
+        """
+        返回每个 endpoint 的调用次数、错误次数、平均和最大延迟（秒）。
+        """
+        with self._stats_lock:
+            return {
+                endpoint: dict(stat, avg_seconds=stat['total_seconds'] / stat['count'] if stat['count'] else 0.0)
+                for endpoint, stat in self._stats.items()
+            }
+
+# 模块级共享实例，整个进程共用一个连接池
+strava_client = StravaClient()
@@ -0,0 +1,167 @@
+# strava_web/sync_queue.py
+import random
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from strava_web.models import SyncJob
+
+def enqueue_user_sync(user_instance, priority=SyncJob.PRIORITY_NORMAL):
+    """
+    为用户加入一个同步任务。已有任务时只提升优先级，不重复入队。
+    """
+    job = SyncJob.objects.filter(user=user_instance, kind=SyncJob.KIND_USER_SYNC).first()
+    if job is None:
+        return SyncJob.objects.create(user=user_instance, kind=SyncJob.KIND_USER_SYNC, priority=priority)
+    if priority < job.priority:
+        SyncJob.objects.filter(pk=job.pk).update(priority=priority)
+    return job
+
+def enqueue_users_sync(users, priority=SyncJob.PRIORITY_NORMAL):
+    """
+    批量加入例行同步任务，跳过已在队列中（包括正在退避）的用户。返回新加入的任务数。
+    """
+    queued_user_ids = set(SyncJob.objects.filter(kind=SyncJob.KIND_USER_SYNC).values_list('user_id', flat=True))
+    jobs = [
+        SyncJob(user=user, kind=SyncJob.KIND_USER_SYNC, priority=priority)
+        for user in users if user.pk not in queued_user_ids
+    ]
+    SyncJob.objects.bulk_create(jobs, batch_size=500)
+    return len(jobs)
+
+def enqueue_webhook_event(event, user_instance):
+    return SyncJob.objects.create(
+        user=user_instance,
+        kind=SyncJob.KIND_WEBHOOK_EVENT,
+        event=event,
+        priority=SyncJob.PRIORITY_HIGH,
+    )
+
+class SyncLeaseLost(Exception):
+    """
+    任务的租约已过期并被其他 worker 领取，本 worker 不能再执行、完成或放回这个任务。
+    """
+    pass
+
+# 当前线程正在执行的任务的租约：(任务 id, worker, 租约秒数, 上次延长的时间)
+_current_lease = threading.local()
+
+def get_lease_seconds(lease_seconds=None):
+    if lease_seconds is None:
+        lease_seconds = getattr(settings, 'STRAVA_SYNC_LEASE_SECONDS', 900)
+    return lease_seconds
+
+def claim_jobs(worker_id, batch_size=1, lease_seconds=None):
+    """
+    领取到期的任务（包括租约已过期的任务），多个进程/主机同时领取时通过 SKIP LOCKED 互不重复。
+    领取时的租约只保证排队期间不被别人领走，每个任务开始执行时要调用 start_job 重新设置租约。
+    """
+    lease_seconds = get_lease_seconds(lease_seconds)
+    current_time = now()
+    with transaction.atomic():
+        jobs = list(
+            SyncJob.objects.select_for_update(skip_locked=True).filter(
+                Q(status='pending', next_run_at__lte=current_time) |
+                Q(status='running', lease_expires_at__lt=current_time)
+            ).order_by('priority', 'next_run_at')[:batch_size]
+        )
+        if jobs:
+            SyncJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                status='running',
+                locked_by=worker_id,
+                lease_expires_at=current_time + timedelta(seconds=lease_seconds),
+            )
+    # 加锁的查询不关联 user 表，避免锁住用户行；领取后再一次性取出用户和事件
+    return list(
+        SyncJob.objects.select_related('user', 'event').filter(pk__in=[job.pk for job in jobs])
+        .order_by('priority', 'next_run_at')
+    )
+
+def _owned(job):
+    # 只更新仍由本 worker 持有的任务；租约过期后被其他 worker 领取的任务 locked_by 已经变了
+    return SyncJob.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by)
+
+def _clear_lease(job):
+    lease = getattr(_current_lease, 'lease', None)
+    if lease and lease[0] == job.pk:
+        _current_lease.lease = None
+
+def start_job(job, lease_seconds=None):
+    """
+    开始执行领取到的任务：从现在起重新计算租约，并登记为当前线程的任务，
+    等待额度和翻页时由 renew_lease 延长。任务已被其他 worker 领走时返回 False，不要执行。
+    """
+    lease_seconds = get_lease_seconds(lease_seconds)
+    if not _owned(job).update(lease_expires_at=now() + timedelta(seconds=lease_seconds)):
+        return False
+    _current_lease.lease = (job.pk, job.locked_by, lease_seconds, time.monotonic())
+    return True
+
+def renew_lease():
+    """
+    在长时间运行的任务中调用（等待 Strava 额度、每页之间）：延长当前线程任务的租约。
+    距上次延长不到租约的三分之一时不写数据库；不在执行任务时什么也不做。
+    租约已经丢失时抛出 SyncLeaseLost，调用者应停止执行。
+    """
+    lease = getattr(_current_lease, 'lease', None)
+    if lease is None:
+        return
+    job_id, worker_id, lease_seconds, renewed_at = lease
+    current = time.monotonic()
+    if current - renewed_at < lease_seconds / 3:
+        return
+    if not SyncJob.objects.filter(pk=job_id, status='running', locked_by=worker_id).update(
+        lease_expires_at=now() + timedelta(seconds=lease_seconds),
+    ):
+        _current_lease.lease = None
+        raise SyncLeaseLost(f"Lease on sync job {job_id} was lost.")
+    _current_lease.lease = (job_id, worker_id, lease_seconds, current)
+
+def complete_job(job):
+    # 成功的任务直接删除，队列中只保留待执行和退避中的任务
+    _clear_lease(job)
+    if not _owned(job).delete()[0]:
+        raise SyncLeaseLost(f"Lease on sync job {job.pk} was lost.")
+
+def release_job(job, delay_seconds=0):
+    """
+    不计失败次数地放回队列（例如遇到 Strava 额度限制）。
+    """
+    _clear_lease(job)
+    if not _owned(job).update(
+        status='pending',
+        locked_by='',
+        lease_expires_at=None,
+        next_run_at=now() + timedelta(seconds=delay_seconds),
+    ):
+        raise SyncLeaseLost(f"Lease on sync job {job.pk} was lost.")
+
+def fail_job(job, error):
+    """
+    任务失败：按指数退避（带抖动）推迟下次执行。webhook 任务超过最大次数后放弃，
+    用户同步任务在最大退避间隔上继续重试。返回是否还会重试。
+    """
+    _clear_lease(job)
+    attempts = job.attempts + 1
+    max_attempts = getattr(settings, 'STRAVA_SYNC_MAX_ATTEMPTS', 8)
+    if job.kind == SyncJob.KIND_WEBHOOK_EVENT and attempts >= max_attempts:
+        if not _owned(job).delete()[0]:
+            raise SyncLeaseLost(f"Lease on sync job {job.pk} was lost.")
+        return False
+    base = getattr(settings, 'STRAVA_SYNC_BACKOFF_SECONDS', 300)
+    max_backoff = getattr(settings, 'STRAVA_SYNC_MAX_BACKOFF_SECONDS', 86400)
+    delay = min(max_backoff, base * (2 ** (attempts - 1)))
+    delay = random.uniform(delay / 2, delay)
+    if not _owned(job).update(
+        status='pending',
+        attempts=attempts,
+        locked_by='',
+        lease_expires_at=None,
+        last_error=str(error)[:2000],
+        next_run_at=now() + timedelta(seconds=delay),
+    ):
+        raise SyncLeaseLost(f"Lease on sync job {job.pk} was lost.")
+    return True
@@ -1,3 +1,756 @@
-from django.test import TestCase
+import re
+import time
+import requests
+from io import StringIO
+from types import SimpleNamespace
+from importlib import import_module
+from unittest import mock, skipUnless
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from django.apps import apps as django_apps
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from strava_web.models import (
+    CustomUser, Activity, ActivityDailyRollup, GroupApplication, LeaderboardEntry, LeaderboardRebuildRequest, PersonalRecord, StravaApiUsage, SyncJob,
+    RACE_FILTER,
+)
+from strava_web.search import FTS_TABLE, search_activities
+from strava_web.pagination import CursorPaginator
+from strava_web.services import compute_weekly_stats, rollover_weekly_stats, upsert_activities
+from strava_web.records import refresh_personal_records
+from strava_web.rollups import refresh_daily_rollups, get_local_date
+from strava_web.utils_group import refresh_group_counts
+from strava_web.apps import repair_group_counts
+from strava_web.leaderboards import (
+    PERIODS, RANK_TYPES, get_ranked_members, rebuild_group_leaderboard, request_leaderboard_rebuild,
+    request_stale_period_leaderboards, rebuild_requested_leaderboards,
+)
+from strava_web.rate_limit import rate_limiter, StravaRateLimitExceeded
+from strava_web.strava_client import strava_client
+from strava_web.tokens import get_access_token, StravaTokenRevoked
+from strava_web.sync_queue import (
+    enqueue_user_sync, claim_jobs, start_job, renew_lease, complete_job, release_job, fail_job, SyncLeaseLost,
+)
 
 # Create your tests here.
+
+def create_activity(user, strava_id, **fields):
+    start = fields.pop('start_date_local', datetime(2024, 3, 1, 7, 0, tzinfo=dt_timezone.utc))
+    values = {
+        'name': f'Run {strava_id}', 'activity_type': 'Run', 'distance': 5000.0, 'moving_time': 1500,
+        'elapsed_time': 1600, 'elevation_gain': 10.0, 'start_date': start, 'start_date_local': start,
+        'timezone': 'UTC', 'average_speed': 3.3,
+    }
+    values.update(fields)
+    return Activity.objects.create(user=user, strava_id=strava_id, **values)
+
+def get_index_name(model, fields):
+    return next(index.name for index in model._meta.indexes if index.fields == fields)
+
+
+@skipUnless(connection.vendor in ('sqlite', 'mysql'), 'query plans are only checked on SQLite and MySQL')
+class QueryPlanTestCase(TestCase):
+    """
+    用 EXPLAIN 检查查询走了哪些索引、有没有整表扫描。测试库的数据很少，
+    这里只看执行计划的形状，不看代价。
+    """
+
+    def explain(self, sql, params=()):
+        # 返回 [(表名或别名, 使用的索引或 None, 是否整表扫描)]，按索引读完整个表（SCAN ... USING INDEX）也算整表扫描
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                steps = []
+                for row in cursor.fetchall():
+                    match = re.match(r'(SCAN|SEARCH) (\S+)(?: USING (?:COVERING )?INDEX (\S+))?', row[3])
+                    # SCAN qualify / subquery / (subquery-N) 是读窗口函数或子查询的中间结果，不是数据表
+                    if match and not match.group(2).startswith(('(', 'qualify', 'subquery')):
+                        steps.append((match.group(2), match.group(3), match.group(1) == 'SCAN'))
+                return steps
+            cursor.execute(f'EXPLAIN {sql}', params)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            # <derivedN> 是派生表的中间结果；type 为 index 是按索引顺序读完整个索引，同样算整表扫描
+            return [(row['table'], row['key'], row['type'] in ('ALL', 'index')) for row in rows if row['table'] and not row['table'].startswith('<')]
+
+    def explain_queryset(self, queryset):
+        return self.explain(*queryset.query.sql_with_params())
+
+    def assertNoFullScan(self, steps):
+        self.assertEqual([table for table, _, full_scan in steps if full_scan], [], steps)
+
+    def assertUsesIndex(self, steps, index_name):
+        self.assertIn(index_name, [index for _, index, _ in steps], steps)
+        self.assertNoFullScan(steps)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RaceRankingQueryTests(QueryPlanTestCase):
+    """
+    比赛排行榜的“每人最快一次”：在筛选后的结果上用 ROW_NUMBER() 按用户分区取第一名，
+    不再对每一行做关联子查询。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group = Group.objects.create(name='club')
+        cls.users = [CustomUser.objects.create(username=f'racer{i}', email=f'racer{i}@example.com') for i in range(3)]
+        for user in cls.users[:2]:
+            user.groups.add(cls.group)
+        races = [
+            # (用户, chip_time, 日期)
+            (0, 10800, date(2024, 4, 1)), (0, 10500, date(2024, 10, 1)), (0, 10000, date(2023, 4, 1)),
+            (1, 0, date(2024, 4, 1)), (1, 12000, date(2024, 11, 1)),
+            (2, 9000, date(2024, 4, 1)),
+        ]
+        for strava_id, (user_index, chip_time, day) in enumerate(races, start=1):
+            start = datetime(day.year, day.month, day.day, 7, 0, tzinfo=dt_timezone.utc)
+            create_activity(
+                cls.users[user_index], strava_id, start_date_local=start, start_date=start,
+                is_race=True, race_distance='FM', chip_time=chip_time,
+            )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.users[0])
+
+    def get_ranking(self, group_id, **params):
+        params = {'fastest_only': 'yes', 'date_range': '2024', 'race_distance': 'FM', **params}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/strava_dash/groups/{group_id}/race-ranking/', params)
+        self.assertEqual(response.status_code, 200)
+        ranking_queries = [query['sql'] for query in queries.captured_queries if 'ROW_NUMBER' in query['sql']]
+        self.assertEqual(len(ranking_queries), 1)
+        rows = [(activity.user.username, activity.chip_time) for activity in response.context['page_obj'].object_list]
+        return rows, ranking_queries[0], len(queries.captured_queries)
+
+    def test_fastest_only_in_group(self):
+        rows, sql, _ = self.get_ranking(self.group.pk)
+        # 2023 年的成绩不在范围内，chip_time 为 0 的成绩不参与排名，racer2 不在群组里
+        self.assertEqual(rows, [('racer0', 10500), ('racer1', 12000)])
+        # 活动表只在外层按主键取行和子查询里编号各读一次，没有按行执行的关联子查询
+        self.assertEqual(len(re.findall(r'FROM [`"]strava_web_activity[`"]', sql)), 2)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        _, _, count = self.get_ranking(self.group.pk)
+        self.users[2].groups.add(self.group)
+        create_activity(self.users[2], 100, is_race=True, race_distance='FM', chip_time=8000,
+                        start_date_local=datetime(2024, 6, 1, tzinfo=dt_timezone.utc), start_date=datetime(2024, 6, 1, tzinfo=dt_timezone.utc))
+        cache.clear()
+        rows, _, new_count = self.get_ranking(self.group.pk)
+        self.assertEqual(rows, [('racer2', 8000), ('racer0', 10500), ('racer1', 12000)])
+        self.assertEqual(new_count, count)
+
+    def test_ranking_plan_has_no_full_scan(self):
+        # 群组排行从群组成员出发，按 (user, start_date_local) 索引取每个成员的比赛
+        _, sql, _ = self.get_ranking(self.group.pk)
+        self.assertNoFullScan(self.explain(sql))
+
+    def test_year_filter_is_a_date_range(self):
+        _, sql, _ = self.get_ranking(self.group.pk)
+        # 按年份筛选用 start_date_local 上的半开区间，不对列取年份
+        self.assertNotRegex(sql, r'(?i)extract|strftime')
+        self.assertRegex(sql, r'start_date_local[`"]? >= .*start_date_local[`"]? < ')
+
+    def test_available_years_from_first_and_last_race(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/strava_dash/groups/{self.group.pk}/race-ranking/')
+        self.assertEqual(response.context['available_years'], [2024, 2023])
+        self.assertFalse([query['sql'] for query in queries.captured_queries if 'DISTINCT' in query['sql']])
+
+    def test_all_time_fastest_falls_back_until_records_exist(self):
+        # 个人最好成绩表还没有回填时按 ROW_NUMBER() 现算，不会是空榜
+        rows, _, _ = self.get_ranking(self.group.pk, date_range='all')
+        self.assertEqual(rows, [('racer0', 10000), ('racer1', 12000)])
+        import_module('strava_web.migrations.0027_backfill_personal_records').backfill_personal_records(django_apps, None)
+        self.assertEqual(PersonalRecord.objects.count(), 3)
+        cache.clear()
+        response = self.client.get(f'/strava_dash/groups/{self.group.pk}/race-ranking/', {
+            'fastest_only': 'yes', 'date_range': 'all', 'race_distance': 'FM',
+        })
+        rows = [(activity.user.username, activity.chip_time) for activity in response.context['page_obj'].object_list]
+        self.assertEqual(rows, [('racer0', 10000), ('racer1', 12000)])
+
+    def test_race_filter_uses_race_index(self):
+        # 不按群组筛选时，按距离筛选比赛、按完赛时间排序走 (is_race, race_distance, chip_time, user) 索引
+        races = Activity.objects.filter(RACE_FILTER, chip_time__gt=0, race_distance='FM').order_by('chip_time').values('pk', 'user_id')
+        self.assertUsesIndex(self.explain_queryset(races), get_index_name(Activity, ['is_race', 'race_distance', 'chip_time', 'user']))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class HotQueryPlanTests(QueryPlanTestCase):
+    """
+    活动列表、周统计、个人最好成绩、换周和排行榜成员筛选这几条高频查询都要走索引，不能整表扫描。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group = Group.objects.create(name='club')
+        cls.users = [
+            CustomUser.objects.create(username=f'runner{i}', email=f'runner{i}@example.com', gender='M', birth_year=1980 + i)
+            for i in range(3)
+        ]
+        for user in cls.users:
+            user.groups.add(cls.group)
+        for i in range(30):
+            start = datetime(2024, 1 + i % 12, 1 + i % 28, 7, 0, tzinfo=dt_timezone.utc)
+            create_activity(
+                cls.users[i % 3], i + 1, start_date_local=start, start_date=start, activity_type='Run' if i % 4 else 'Ride',
+                is_race=i % 5 == 0, race_distance='HM' if i % 5 == 0 else None, chip_time=6000 + i if i % 5 == 0 else 0,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def capture_plans(self, func, table='strava_web_activity', where=''):
+        # 执行 func，返回其中从 table 读取、WHERE 条件里含有 where 的 SELECT 的执行计划
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        plans = [
+            self.explain(query['sql']) for query in queries.captured_queries
+            if query['sql'].startswith('SELECT') and re.search(rf'FROM [`"]{table}[`"].* WHERE .*{where}', query['sql'])
+        ]
+        self.assertTrue(plans)
+        return plans
+
+    def test_activity_list_uses_user_date_index(self):
+        self.client.force_login(self.users[0])
+        index_name = get_index_name(Activity, ['user', 'start_date_local'])
+        for plan in self.capture_plans(lambda: self.client.get('/strava_dash/activities/', {'year': '2024'})):
+            self.assertUsesIndex(plan, index_name)
+
+    def test_weekly_stats_use_type_user_date_index(self):
+        users = CustomUser.objects.filter(pk__in=[user.pk for user in self.users])
+        index_name = get_index_name(Activity, ['activity_type', 'user', 'start_date_local'])
+        for plan in self.capture_plans(lambda: compute_weekly_stats(users)):
+            self.assertUsesIndex(plan, index_name)
+
+    def test_personal_records_use_user_race_index(self):
+        index_name = get_index_name(Activity, ['user', 'is_race', 'race_distance', 'chip_time'])
+        for plan in self.capture_plans(lambda: refresh_personal_records(self.users[0].pk, ['HM'])):
+            self.assertUsesIndex(plan, index_name)
+
+    def test_rollover_finds_stale_users_by_week_start(self):
+        # 只看筛选周统计过期用户的查询；取全部时区等查询本来就要读所有用户
+        index_name = get_index_name(CustomUser, ['weekly_stats_week_start'])
+        plans = self.capture_plans(lambda: rollover_weekly_stats(StringIO()), table='strava_web_customuser', where='weekly_stats_week_start')
+        for plan in plans:
+            self.assertUsesIndex(plan, index_name)
+
+    def test_ranking_member_filter_uses_gender_index(self):
+        members = get_ranked_members(self.group, 'weekly', 'M', '40-44', 'distance')
+        self.assertUsesIndex(self.explain_queryset(members), get_index_name(CustomUser, ['gender', 'birth_year']))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'FTS5 triggers only exist on SQLite')
+class ActivityNameSearchTests(TestCase):
+    """
+    SQLite 的全文索引靠 0023 迁移创建的触发器同步。之后的迁移如果重建了活动表，触发器会被丢掉，搜索结果就会过时。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='runner', email='runner@example.com')
+
+    def search(self, text):
+        return set(search_activities(Activity.objects.filter(user=self.user), text).values_list('strava_id', flat=True))
+
+    def test_triggers_exist(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'strava_web_activity'")
+            triggers = {row[0] for row in cursor.fetchall()}
+        self.assertEqual(triggers, {f'{FTS_TABLE}_insert', f'{FTS_TABLE}_delete', f'{FTS_TABLE}_update'})
+
+    def test_index_follows_writes(self):
+        activity = create_activity(self.user, 1, name='Morning tempo')
+        create_activity(self.user, 2, name='Evening easy')
+        self.assertEqual(self.search('tem'), {1})
+        self.assertEqual(self.search('morning tempo'), {1})
+        activity.name = 'Long run'
+        activity.save()
+        self.assertEqual(self.search('tempo'), set())
+        self.assertEqual(self.search('long'), {1})
+        activity.delete()
+        self.assertEqual(self.search('long'), set())
+        self.assertEqual(self.search('evening'), {2})
+
+
+class StravaClientRetryTests(SimpleTestCase):
+    """
+    授权码和 refresh token 只能用一次：请求发出后出错不重试，只有连接没有建立时才重试。
+    """
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(rate_limiter, 'acquire'),
+            mock.patch.object(rate_limiter, 'update'),
+            mock.patch.object(strava_client, '_sleep_before_retry'),
+            mock.patch.object(strava_client.session, 'request'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.session_request = strava_client.session.request
+
+    def response(self, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        return response
+
+    def test_token_post_is_not_retried_after_sending(self):
+        self.session_request.side_effect = requests.exceptions.ReadTimeout()
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            strava_client.post_token({'grant_type': 'refresh_token'})
+        self.assertEqual(self.session_request.call_count, 1)
+        self.session_request.side_effect = None
+        self.session_request.return_value = self.response(502)
+        self.session_request.reset_mock()
+        self.assertEqual(strava_client.post_token({'grant_type': 'refresh_token'}).status_code, 502)
+        self.assertEqual(self.session_request.call_count, 1)
+
+    def test_token_post_is_retried_when_not_connected(self):
+        self.session_request.side_effect = [requests.exceptions.ConnectTimeout(), self.response(200)]
+        self.assertEqual(strava_client.post_token({'grant_type': 'refresh_token'}).status_code, 200)
+        self.assertEqual(self.session_request.call_count, 2)
+
+    def test_get_is_retried(self):
+        self.session_request.side_effect = [requests.exceptions.ReadTimeout(), self.response(503), self.response(200)]
+        self.assertEqual(strava_client.get('/athlete', 'token', 'athlete').status_code, 200)
+        self.assertEqual(self.session_request.call_count, 3)
+
+
+
+@skipUnless(connection.vendor == 'sqlite', 'FTS5 triggers only exist on SQLite')
+class ActivityAdminSearchTests(TestCase):
+    """
+    后台活动搜索：纯数字精确匹配 strava_id，用户名按前缀匹配，活动名称走全文索引，三者取并集。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create(username='admin', email='admin@example.com', is_staff=True, is_superuser=True)
+        cls.runner = CustomUser.objects.create(username='runner', email='runner@example.com')
+        create_activity(cls.runner, 1234, name='Morning tempo')
+        create_activity(cls.admin, 12345, name='Run 2024')
+        create_activity(cls.admin, 99, name='Evening runner club')
+
+    def search(self, term):
+        self.client.force_login(self.admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/strava_dash/admin/strava_web/activity/', {'q': term})
+        self.assertEqual(response.status_code, 200)
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        # 没有默认搜索生成的 LIKE 条件
+        self.assertNotIn('LIKE \'%', sql)
+        return {activity.strava_id for activity in response.context['cl'].result_list}
+
+    def test_numeric_term_matches_strava_id_exactly(self):
+        self.assertEqual(self.search('1234'), {1234})
+
+    def test_username_prefix_and_name(self):
+        # 用户名前缀 runner 的活动，以及名称里有 runner 的活动
+        self.assertEqual(self.search('runner'), {1234, 99})
+        self.assertEqual(self.search('adm'), {12345, 99})
+        self.assertEqual(self.search('tempo'), {1234})
+
+
+class RateLimiterTests(TestCase):
+    """
+    每次调用前一条 UPDATE 换窗口并预占额度，调用后一条 UPDATE 按响应头校正。
+    """
+
+    def setUp(self):
+        patch = mock.patch.object(rate_limiter, '_take_token')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_acquire_is_one_update(self):
+        rate_limiter.acquire(wait=False)
+        with self.assertNumQueries(1):
+            rate_limiter.acquire(wait=False)
+        usage = StravaApiUsage.objects.get(pk=1)
+        self.assertEqual((usage.short_usage, usage.daily_usage), (2, 2))
+
+    def test_acquire_rolls_expired_windows(self):
+        rate_limiter.acquire(wait=False)
+        old = timezone.now() - timedelta(days=2)
+        StravaApiUsage.objects.filter(pk=1).update(
+            short_usage=F('short_limit'), daily_usage=F('daily_limit'), short_window_start=old, daily_window_start=old,
+        )
+        with self.assertNumQueries(1):
+            rate_limiter.acquire(wait=False)
+        usage = StravaApiUsage.objects.get(pk=1)
+        self.assertEqual((usage.short_usage, usage.daily_usage), (1, 1))
+        self.assertGreater(usage.short_window_start, old)
+
+    def test_acquire_without_quota_raises(self):
+        rate_limiter.acquire(wait=False)
+        StravaApiUsage.objects.filter(pk=1).update(short_usage=F('short_limit'))
+        with self.assertRaises(StravaRateLimitExceeded):
+            rate_limiter.acquire(wait=False)
+
+    def test_update_is_one_query(self):
+        rate_limiter.acquire(wait=False)
+        response = requests.Response()
+        response.status_code = 200
+        response.headers.update({'X-RateLimit-Limit': '100,1000', 'X-RateLimit-Usage': '40,400'})
+        with self.assertNumQueries(1):
+            rate_limiter.update(response)
+        usage = StravaApiUsage.objects.get(pk=1)
+        self.assertEqual((usage.short_limit, usage.short_usage, usage.daily_limit, usage.daily_usage), (100, 40, 1000, 400))
+
+
+class SyncQueueLeaseTests(TestCase):
+    """
+    任务租约：领取后只有持有者能完成、放回或记录失败；租约过期被其他 worker 领走后，原来的 worker 不能再改动它。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='queued', email='queued@example.com')
+
+    def setUp(self):
+        self.job = enqueue_user_sync(self.user)
+
+    def expire_lease(self):
+        SyncJob.objects.filter(pk=self.job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_claim_sets_owner_and_lease(self):
+        [job] = claim_jobs('worker-a', lease_seconds=60)
+        self.assertEqual((job.status, job.locked_by), ('running', 'worker-a'))
+        self.assertGreater(job.lease_expires_at, timezone.now())
+        # 租约有效期间其他 worker 领不到
+        self.assertEqual(claim_jobs('worker-b'), [])
+
+    def test_stale_worker_cannot_touch_reclaimed_job(self):
+        [stale] = claim_jobs('worker-a', lease_seconds=60)
+        self.expire_lease()
+        [job] = claim_jobs('worker-b', lease_seconds=60)
+        self.assertFalse(start_job(stale))
+        for finish in (complete_job, release_job, lambda job: fail_job(job, 'error')):
+            with self.assertRaises(SyncLeaseLost):
+                finish(stale)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by, job.attempts), ('running', 'worker-b', 0))
+        self.assertTrue(start_job(job))
+        complete_job(job)
+        self.assertFalse(SyncJob.objects.filter(pk=job.pk).exists())
+
+    def test_renew_lease_extends_and_detects_loss(self):
+        [job] = claim_jobs('worker-a', lease_seconds=60)
+        self.assertTrue(start_job(job, lease_seconds=60))
+        self.expire_lease()
+        with mock.patch('strava_web.sync_queue.time.monotonic', return_value=time.monotonic() + 30):
+            renew_lease()
+        self.assertGreater(SyncJob.objects.get(pk=job.pk).lease_expires_at, timezone.now())
+        # 被其他 worker 领走后，下一次延长租约时发现并停止
+        self.expire_lease()
+        claim_jobs('worker-b', lease_seconds=60)
+        with mock.patch('strava_web.sync_queue.time.monotonic', return_value=time.monotonic() + 60):
+            with self.assertRaises(SyncLeaseLost):
+                renew_lease()
+        renew_lease() # 已不在执行任务，什么也不做
+
+    def test_fail_job_backs_off(self):
+        [job] = claim_jobs('worker-a')
+        self.assertTrue(start_job(job))
+        self.assertTrue(fail_job(job, 'boom'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by, job.attempts, job.last_error), ('pending', '', 1, 'boom'))
+        self.assertGreater(job.next_run_at, timezone.now())
+
+
+class TokenRefreshTests(TestCase):
+    """
+    刷新令牌时按旧的 refresh_token 做 compare-and-swap：其他进程先刷新时使用它写入的令牌，不覆盖也不清除。
+    """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(
+            username='athlete', email='athlete@example.com', strava_id=1,
+            strava_access_token='access-1', strava_refresh_token='refresh-1',
+            strava_token_expires_at=timezone.now() - timedelta(minutes=1),
+        )
+
+    def token_data(self, n):
+        return {'access_token': f'access-{n}', 'refresh_token': f'refresh-{n}', 'expires_in': 21600}
+
+    def stored_tokens(self):
+        return CustomUser.objects.filter(pk=self.user.pk).values_list('strava_access_token', 'strava_refresh_token').get()
+
+    def test_refresh_saves_new_tokens(self):
+        with mock.patch('strava_web.tokens.request_token_refresh', return_value=self.token_data(2)) as refresh:
+            self.assertEqual(get_access_token(self.user), 'access-2')
+        refresh.assert_called_once_with('refresh-1')
+        self.assertEqual(self.stored_tokens(), ('access-2', 'refresh-2'))
+        self.assertGreater(self.user.strava_token_expires_at, timezone.now())
+
+    def test_concurrent_refresh_keeps_first_writer(self):
+        def other_process_wins(refresh_token):
+            # 请求 Strava 期间另一个进程已经刷新并写入
+            CustomUser.objects.filter(pk=self.user.pk).update(
+                strava_access_token='access-3', strava_refresh_token='refresh-3',
+                strava_token_expires_at=timezone.now() + timedelta(hours=6),
+            )
+            return self.token_data(2)
+        with mock.patch('strava_web.tokens.request_token_refresh', side_effect=other_process_wins):
+            self.assertEqual(get_access_token(self.user), 'access-3')
+        self.assertEqual(self.stored_tokens(), ('access-3', 'refresh-3'))
+
+    def test_revoked_token_clears_only_if_unchanged(self):
+        with mock.patch('strava_web.tokens.request_token_refresh', side_effect=StravaTokenRevoked('rejected')):
+            with self.assertRaises(ValueError):
+                get_access_token(self.user)
+        self.assertEqual(self.stored_tokens(), (None, None))
+
+    def test_revoked_old_token_after_other_refresh(self):
+        def other_process_wins(refresh_token):
+            CustomUser.objects.filter(pk=self.user.pk).update(strava_access_token='access-3', strava_refresh_token='refresh-3')
+            raise StravaTokenRevoked('already used')
+        with mock.patch('strava_web.tokens.request_token_refresh', side_effect=other_process_wins):
+            self.assertEqual(get_access_token(self.user), 'access-3')
+        self.assertEqual(self.stored_tokens(), ('access-3', 'refresh-3'))
+
+
+class LeaderboardRebuildTests(TestCase):
+    """
+    排行榜重建：每个周期的成员数据只查一次，名次在 Python 中计算，结果要和 get_ranked_members 的窗口函数一致；
+    月/季度合计在进入新的周期后重建，短时间内的多次登记合并为一次重建。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group = Group.objects.create(name='club')
+        current_year = date.today().year
+        profiles = [
+            # (性别, 年龄, 本周距离, 本周运动时间)：有并列、距离为 0 和没有出生年份的成员
+            ('M', 42, 10000.0, 3000), ('F', 42, 10000.0, 3300), ('M', 55, 0.0, 0),
+            ('F', None, 8000.0, 2400), ('M', 42, 12000.0, 3500),
+        ]
+        cls.users = []
+        for i, (gender, age, distance, moving_time) in enumerate(profiles):
+            user = CustomUser.objects.create(
+                username=f'member{i}', email=f'member{i}@example.com', gender=gender,
+                birth_year=current_year - age if age else None,
+                weekly_run_distance=distance, weekly_run_moving_time=moving_time, weekly_run_elevation_gain=i * 10.0,
+            )
+            user.groups.add(cls.group)
+            cls.users.append(user)
+        inactive = CustomUser.objects.create(username='inactive', email='inactive@example.com', is_active=False)
+        inactive.groups.add(cls.group)
+        # 本月只有部分成员有汇总行，其他成员的月合计为空
+        for user, distance in zip(cls.users[:3], (5000.0, 7000.0, 5000.0)):
+            ActivityDailyRollup.objects.create(user=user, date=date.today(), distance=distance, moving_time=int(distance / 3), count=1)
+
+    def get_entries(self, period, gender, age, rank_type):
+        return list(LeaderboardEntry.objects.filter(
+            group=self.group, period=period, gender=gender, age=age, rank_type=rank_type,
+        ).order_by('position').values_list('user_id', 'rank', 'position'))
+
+    def test_matches_window_function_ranking(self):
+        rebuild_group_leaderboard(self.group)
+        combinations = set(LeaderboardEntry.objects.filter(group=self.group).values_list('period', 'gender', 'age', 'rank_type'))
+        self.assertEqual({(g, a) for _, g, a, _ in combinations}, {
+            ('all', 'all'), ('all', '40-44'), ('all', '55-59'), ('M', 'all'), ('M', '40-44'), ('M', '55-59'),
+            ('F', 'all'), ('F', '40-44'),
+        })
+        for period in PERIODS:
+            for rank_type in RANK_TYPES:
+                for gender, age in [('all', 'all'), ('M', '40-44'), ('F', 'all')]:
+                    expected = list(get_ranked_members(self.group, period, gender, age, rank_type).values_list(
+                        'pk', 'member_rank', 'member_position'
+                    ))
+                    self.assertEqual(self.get_entries(period, gender, age, rank_type), expected, (period, gender, age, rank_type))
+        weekly = self.get_entries('weekly', 'all', 'all', 'distance')
+        self.assertEqual([rank for _, rank, _ in weekly], [1, 2, 2, 4, 5])
+
+    def test_member_data_is_read_once_per_rollup_period(self):
+        with CaptureQueriesContext(connection) as queries:
+            rebuild_group_leaderboard(self.group)
+        reads = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        # 一条查询取成员和统计字段，月、季度各一条汇总查询
+        self.assertEqual(len(reads), 3)
+
+    def test_new_period_requests_rebuild(self):
+        rebuild_group_leaderboard(self.group)
+        self.assertEqual(request_stale_period_leaderboards(), 0)
+        LeaderboardEntry.objects.filter(group=self.group, period='month').update(period_start=date(2000, 1, 1))
+        self.assertEqual(request_stale_period_leaderboards(), 1)
+        self.assertEqual(rebuild_requested_leaderboards(StringIO(), delay_seconds=0), 1)
+        self.assertEqual(request_stale_period_leaderboards(), 0)
+        self.assertEqual(
+            set(LeaderboardEntry.objects.filter(group=self.group, period='month').values_list('period_start', flat=True)),
+            {date.today().replace(day=1)},
+        )
+
+    def test_requests_are_coalesced(self):
+        request_leaderboard_rebuild([self.group.pk])
+        self.assertEqual(rebuild_requested_leaderboards(StringIO()), 1)
+        # 刚重建过：之后的多次登记等到间隔过去再一起重建
+        request_leaderboard_rebuild([self.group.pk])
+        request_leaderboard_rebuild([self.group.pk])
+        self.assertEqual(rebuild_requested_leaderboards(StringIO()), 0)
+        LeaderboardRebuildRequest.objects.filter(group=self.group).update(built_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(rebuild_requested_leaderboards(StringIO()), 1)
+        self.assertEqual(rebuild_requested_leaderboards(StringIO(), delay_seconds=0), 0)
+
+
+class GroupCountTests(TestCase):
+    """
+    群组的 member_count / pending_count 整体重新统计；0026 跳过回填时，加上计数列的 migrate 结束后自动修正。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.groups = [Group.objects.create(name=f'club{i}') for i in range(2)]
+        users = [CustomUser.objects.create(username=f'member{i}', email=f'member{i}@example.com') for i in range(3)]
+        for user in users:
+            user.groups.add(cls.groups[0])
+        users[0].groups.add(cls.groups[1])
+        GroupApplication.objects.create(user=users[1], group=cls.groups[1])
+        GroupApplication.objects.create(user=users[2], group=cls.groups[1], status='rejected')
+
+    def setUp(self):
+        Group.objects.update(member_count=9, pending_count=9)
+
+    def get_counts(self):
+        return list(Group.objects.order_by('pk').values_list('member_count', 'pending_count'))
+
+    def test_refresh_group_counts(self):
+        refresh_group_counts([self.groups[1].pk])
+        self.assertEqual(self.get_counts(), [(9, 9), (1, 1)])
+        refresh_group_counts([group.pk for group in self.groups])
+        self.assertEqual(self.get_counts(), [(3, 0), (1, 1)])
+
+    def test_post_migrate_repairs_counts(self):
+        plan = [(SimpleNamespace(app_label='strava_web', name='0028_leaderboard_period_start_built_at'), False)]
+        repair_group_counts(sender=None, using='default', plan=plan)
+        self.assertEqual(self.get_counts(), [(9, 9), (9, 9)])
+        plan.append((SimpleNamespace(app_label='auth', name='0013_group_member_count'), False))
+        repair_group_counts(sender=None, using='default', plan=plan)
+        self.assertEqual(self.get_counts(), [(3, 0), (1, 1)])
+
+
+class ActivityUpsertTests(TestCase):
+    """
+    一页活动按指纹分成新增、修改和未变化三类：未变化的不写入，其余一次批量 upsert。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='runner', email='runner@example.com')
+
+    def summary(self, strava_id, **fields):
+        values = {
+            'id': strava_id, 'name': f'Run {strava_id}', 'type': 'Run', 'distance': 5000.0, 'moving_time': 1500,
+            'elapsed_time': 1600, 'total_elevation_gain': 10.0, 'start_date': '2024-03-01T07:00:00Z',
+            'start_date_local': '2024-03-01T07:00:00Z', 'timezone': '(GMT+00:00) UTC', 'average_speed': 3.3,
+        }
+        values.update(fields)
+        return values
+
+    def test_counts(self):
+        page = [self.summary(1), self.summary(2)]
+        self.assertEqual(upsert_activities(self.user, page), {'inserted': 2, 'updated': 0, 'unchanged': 0})
+        # 内容没变：只查一次指纹，不写入
+        with self.assertNumQueries(1):
+            self.assertEqual(upsert_activities(self.user, page), {'inserted': 0, 'updated': 0, 'unchanged': 2})
+        page = [self.summary(1, name='Tempo'), self.summary(2), self.summary(3)]
+        self.assertEqual(upsert_activities(self.user, page), {'inserted': 1, 'updated': 1, 'unchanged': 1})
+        self.assertEqual(
+            dict(Activity.objects.filter(user=self.user).values_list('strava_id', 'name')),
+            {1: 'Tempo', 2: 'Run 2', 3: 'Run 3'},
+        )
+
+
+class CursorPaginatorTests(TestCase):
+    """
+    键集分页：前后翻页不重复、不遗漏，可以为空的排序字段 NULL 排在最后，查询里没有 OFFSET。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create(username='runner', email='runner@example.com')
+        heartrates = [150, 140, None, 150, None, 160, 140]
+        cls.activities = [
+            create_activity(user, strava_id, average_heartrate=heartrate)
+            for strava_id, heartrate in enumerate(heartrates, start=1)
+        ]
+
+    def walk(self, paginator):
+        # 从第一页一直翻到最后一页，再翻回第一页
+        pages = [paginator.get_page()]
+        with CaptureQueriesContext(connection) as queries:
+            while pages[-1].has_next():
+                pages.append(paginator.get_page(pages[-1].next_cursor))
+            backward = [pages[-1]]
+            while backward[-1].has_previous():
+                backward.append(paginator.get_page(backward[-1].previous_cursor))
+        self.assertFalse([query['sql'] for query in queries.captured_queries if 'OFFSET' in query['sql']])
+        forward_rows = [[activity.strava_id for activity in page] for page in pages]
+        backward_rows = [[activity.strava_id for activity in page] for page in reversed(backward)]
+        self.assertEqual(backward_rows, forward_rows)
+        self.assertEqual([page.start_index() for page in pages], list(range(1, len(pages) * paginator.per_page, paginator.per_page)))
+        return forward_rows
+
+    def test_descending_with_nulls_last(self):
+        paginator = CursorPaginator(Activity.objects.all(), 2, 'average_heartrate', descending=True)
+        # 排序值相同时按 id 同方向排序
+        self.assertEqual(self.walk(paginator), [[6, 4], [1, 7], [2, 5], [3]])
+
+    def test_ascending_with_nulls_last(self):
+        paginator = CursorPaginator(Activity.objects.all(), 3, 'average_heartrate')
+        self.assertEqual(self.walk(paginator), [[2, 7, 1], [4, 6, 3], [5]])
+
+    def test_invalid_cursor_returns_first_page(self):
+        paginator = CursorPaginator(Activity.objects.all(), 2, 'average_heartrate', descending=True)
+        other = CursorPaginator(Activity.objects.all(), 2, 'start_date_local')
+        for cursor in ('garbage', other.get_page().next_cursor):
+            page = paginator.get_page(cursor)
+            self.assertEqual([activity.strava_id for activity in page], [6, 4])
+            self.assertFalse(page.has_previous())
+
+
+class DailyRollupRefreshTests(TestCase):
+    """
+    活动改了日期后，新旧两天的汇总都要重新计算，旧的一天不能留下这条活动的数据。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='runner', email='runner@example.com')
+
+    def get_rollups(self):
+        return {
+            rollup.date: (rollup.count, rollup.distance)
+            for rollup in ActivityDailyRollup.objects.filter(user=self.user)
+        }
+
+    def test_activity_moved_to_another_day(self):
+        first = datetime(2024, 3, 1, 7, 0, tzinfo=dt_timezone.utc)
+        moved = create_activity(self.user, 1, start_date_local=first, start_date=first, distance=5000.0)
+        create_activity(self.user, 2, start_date_local=first, start_date=first, distance=8000.0)
+        refresh_daily_rollups(self.user.pk, [date(2024, 3, 1)])
+        self.assertEqual(self.get_rollups(), {date(2024, 3, 1): (2, 13000.0)})
+        moved.start_date_local = datetime(2024, 3, 2, 0, 30, tzinfo=dt_timezone.utc)
+        moved.save()
+        refresh_daily_rollups(self.user.pk, [date(2024, 3, 1), get_local_date(moved.start_date_local)])
+        self.assertEqual(self.get_rollups(), {date(2024, 3, 1): (1, 8000.0), date(2024, 3, 2): (1, 5000.0)})
+        # 当天没有跑步活动了：删除那一天的汇总行
+        Activity.objects.filter(strava_id=2).update(activity_type='Ride')
+        refresh_daily_rollups(self.user.pk, [date(2024, 3, 1)])
+        self.assertEqual(self.get_rollups(), {date(2024, 3, 2): (1, 5000.0)})
+
+    def test_sync_refreshes_old_and_new_day(self):
+        summary = {
+            'id': 1, 'name': 'Run', 'type': 'Run', 'distance': 5000.0, 'moving_time': 1500, 'elapsed_time': 1600,
+            'start_date': '2024-03-01T23:30:00Z', 'start_date_local': '2024-03-01T23:30:00Z', 'timezone': '(GMT+00:00) UTC',
+        }
+        upsert_activities(self.user, [summary])
+        self.assertEqual(self.get_rollups(), {date(2024, 3, 1): (1, 5000.0)})
+        upsert_activities(self.user, [dict(summary, start_date='2024-03-02T00:30:00Z', start_date_local='2024-03-02T00:30:00Z')])
+        self.assertEqual(self.get_rollups(), {date(2024, 3, 2): (1, 5000.0)})
@@ -0,0 +1,178 @@
+# strava_web/tokens.py
+import threading
+import requests
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.timezone import now
+from strava_web.rate_limit import StravaRateLimitExceeded
+from strava_web.sync_queue import SyncLeaseLost
+from strava_web.strava_client import strava_client
+
+User = get_user_model()
+
+TOKEN_FIELDS = ['strava_access_token', 'strava_refresh_token', 'strava_token_expires_at']
+# 过期前 5 分钟就刷新
+REFRESH_MARGIN_SECONDS = 300
+
+class StravaTokenRevoked(Exception):
+    """
+    Strava 拒绝了 refresh_token（用户取消授权或令牌已失效），需要用户重新授权。
+    """
+    pass
+
+# 进程内按用户 id 分段加锁，同一进程的多个线程只刷新一次。锁的数量固定，
+# 长时间运行的 worker 不会因为处理过的用户越来越多而占用更多内存；不同用户偶尔共用一把锁只是多等一会儿
+USER_LOCK_STRIPES = 64
+_user_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+def _get_user_lock(user_id):
+    return _user_locks[hash(user_id) % USER_LOCK_STRIPES]
+
+def is_token_expiring(user_instance, margin_seconds=REFRESH_MARGIN_SECONDS):
+    expires_at = user_instance.strava_token_expires_at
+    return expires_at is not None and expires_at < now() + timedelta(seconds=margin_seconds)
+
+def request_token_refresh(refresh_token):
+    """
+    用 refresh_token 向 Strava 换取新令牌，返回 Strava 的令牌数据，不读写数据库。
+    Strava 拒绝时抛出 StravaTokenRevoked。
+    """
+    payload = {
+        'client_id': settings.STRAVA_CLIENT_ID,
+        'client_secret': settings.STRAVA_CLIENT_SECRET,
+        'grant_type': 'refresh_token',
+        'refresh_token': refresh_token
+    }
+
+    try:
+        response = strava_client.post_token(payload)
+        if response.status_code in (400, 401):
+            raise StravaTokenRevoked(f"Strava rejected the refresh token: {response.status_code} {response.text}")
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Failed to refresh Strava token: {e}")
+
+def _reload_tokens(user_instance):
+    current = User.objects.only(*TOKEN_FIELDS).get(pk=user_instance.pk)
+    for field in TOKEN_FIELDS:
+        setattr(user_instance, field, getattr(current, field))
+
+def _swap_tokens(user_instance, old_refresh_token, values):
+    """
+    只有数据库中的 refresh_token 仍是 old_refresh_token 时才写入（compare-and-swap），
+    返回是否写入。未写入说明其他线程或进程已经刷新过，重新读取它写入的令牌。
+    """
+    updated = User.objects.filter(pk=user_instance.pk, strava_refresh_token=old_refresh_token).update(**values)
+    if updated:
+        for field, value in values.items():
+            setattr(user_instance, field, value)
+    else:
+        _reload_tokens(user_instance)
+    return bool(updated)
+
+def refresh_strava_token(user_instance):
+    """
+    使用 refresh_token 获取新的 access_token 和 refresh_token，只写令牌相关的字段。
+    请求 Strava 时不持有数据库事务和行锁（请求可能重试、可能等待速率限制额度）；
+    写回时按旧的 refresh_token 做 compare-and-swap，其他进程先刷新时使用它的结果。
+    """
+    if not user_instance.strava_refresh_token:
+        raise ValueError("No refresh token available for this user.")
+    old_refresh_token = user_instance.strava_refresh_token
+    token_data = request_token_refresh(old_refresh_token)
+    _swap_tokens(user_instance, old_refresh_token, {
+        'strava_access_token': token_data['access_token'],
+        'strava_refresh_token': token_data['refresh_token'],
+        'strava_token_expires_at': now() + timedelta(seconds=token_data['expires_in']),
+    })
+    return {
+        'access_token': user_instance.strava_access_token,
+        'refresh_token': user_instance.strava_refresh_token,
+        'expires_in': token_data['expires_in']
+    }
+
+def clear_strava_tokens(user_instance, old_refresh_token):
+    """
+    刷新令牌已失效，需要用户重新授权：清除令牌。同样按旧的 refresh_token 做 compare-and-swap，
+    其他进程已经换到新令牌时不清除。返回是否清除。
+    """
+    return _swap_tokens(user_instance, old_refresh_token, {field: None for field in TOKEN_FIELDS})
+
+def confirm_deauthorization(user_instance):
+    """
+    收到取消授权的 webhook 事件后调用。事件本身没有签名，清除令牌前先用 refresh_token 向 Strava
+    换一次令牌确认：被拒绝才说明用户确实取消了授权，清除令牌并返回 True；
+    换令牌成功说明授权仍然有效，保存新令牌并返回 False。
+    """
+    with _get_user_lock(user_instance.pk):
+        _reload_tokens(user_instance)
+        if not user_instance.strava_refresh_token:
+            return False
+        old_refresh_token = user_instance.strava_refresh_token
+        try:
+            refresh_strava_token(user_instance)
+        except StravaTokenRevoked:
+            return clear_strava_tokens(user_instance, old_refresh_token)
+    return False
+
+def get_access_token(user_instance, margin_seconds=REFRESH_MARGIN_SECONDS):
+    """
+    返回有效的 access_token，需要时刷新。
+
+    同一进程内同一用户同时只会有一次刷新 (single-flight)：拿到线程锁后重新读取令牌，
+    其他线程已经刷新过就直接使用。跨进程不加行锁，刷新结果按旧的 refresh_token
+    compare-and-swap 写回，同时刷新的进程以先写入的为准。
+    """
+    if not user_instance.strava_access_token or not user_instance.strava_refresh_token:
+        return None
+    if not is_token_expiring(user_instance, margin_seconds):
+        return user_instance.strava_access_token
+
+    with _get_user_lock(user_instance.pk):
+        _reload_tokens(user_instance)
+        if not user_instance.strava_access_token or not user_instance.strava_refresh_token:
+            return None
+        if not is_token_expiring(user_instance, margin_seconds):
+            return user_instance.strava_access_token
+        old_refresh_token = user_instance.strava_refresh_token
+        try:
+            refresh_strava_token(user_instance)
+        except (StravaRateLimitExceeded, SyncLeaseLost):
+            raise # 额度不足（或同步任务的租约丢失）不代表令牌失效，保留令牌
+        except StravaTokenRevoked as e:
+            if not clear_strava_tokens(user_instance, old_refresh_token):
+                # 其他进程已经用同一个 refresh_token 刷新过，旧令牌因此失效
+                return user_instance.strava_access_token
+            raise ValueError(f"Failed to refresh Strava token for user {user_instance.username}: {e}. Please re-authorize.")
+        except Exception as e:
+            # 网络或 Strava 临时错误，保留令牌，下次再试
+            raise ValueError(f"Failed to refresh Strava token for user {user_instance.username}: {e}")
+    return user_instance.strava_access_token
+
+def renew_expiring_tokens(users, stdout, window_seconds=None):
+    """
+    同步开始前的批量预刷新：把在本次同步窗口内会过期的令牌提前刷新，
+    同步过程中就不需要再刷新令牌。返回 (刷新成功数, 失败数)。
+    """
+    if window_seconds is None:
+        window_seconds = getattr(settings, 'STRAVA_TOKEN_RENEW_WINDOW_SECONDS', 3600)
+    expiring = [
+        user for user in users
+        if user.strava_refresh_token and is_token_expiring(user, window_seconds)
+    ]
+    renewed = 0
+    failed = 0
+    for user in expiring:
+        try:
+            if get_access_token(user, window_seconds):
+                renewed += 1
+        except StravaRateLimitExceeded:
+            raise
+        except Exception as e:
+            failed += 1
+            stdout.write(f"Failed to renew Strava token for user {user.id}: {e}")
+    if expiring:
+        stdout.write(f"Renewed {renewed} Strava tokens expiring within {window_seconds}s ({failed} failed).")
+    return renewed, failed
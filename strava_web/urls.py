@@ -11,6 +11,7 @@ urlpatterns = [
     # Strava SSO 认证路由
     path('login/strava/', views_strava.strava_login, name='strava_login'),
     path('oauth/strava/callback/', views_strava.strava_callback, name='strava_callback'),
+    path('webhook/strava/', views_strava.strava_webhook, name='strava_webhook'),
 
     # 传统登录、登出路由
     path('login/', auth_views.LoginView.as_view(template_name='strava_web/login.html'), name='login'),
@@ -46,6 +47,9 @@ urlpatterns = [
     path('groups/<int:group_id>/edit/', views_group.group_edit, name='group_edit'),
     path('groups/<int:group_id>/manage_members/', views_group.group_manage_members, name='group_manage_members'),
     path('groups/<int:group_id>/remove/', views_group.remove_from_group, name='remove_from_group'),
+    path('groups/<int:group_id>/bulk-remove/', views_group.bulk_remove_from_group, name='bulk_remove_from_group'),
+    path('groups/<int:group_id>/bulk-review/', views_group.bulk_review_group_applications, name='bulk_review_group_applications'),
+    path('groups/<int:group_id>/import-roster/', views_group.import_group_roster, name='import_group_roster'),
     path('groups/<int:group_id>/apply/', views_group.apply_for_group, name='apply_group'),
     path('application/<int:application_id>/review/', views_group.review_group_application, name='review_group_application'),
     path('groups/<int:group_id>/join/', views_group.join_group, name='join_group'),
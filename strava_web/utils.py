@@ -1,4 +1,5 @@
-from datetime import timedelta
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from django.utils import timezone
 from django.urls import reverse
 
@@ -62,6 +63,65 @@ def local_now():
     utc_now = timezone.now()
     return timezone.localtime(utc_now)
 
+def parse_strava_timezone(value):
+    """
+    Strava 活动的 timezone 形如 "(GMT-08:00) America/Los_Angeles"，返回其中的 IANA 名称，无法识别时返回空字符串。
+    """
+    if not value:
+        return ''
+    name = value.rsplit(') ', 1)[-1].strip()
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ''
+    return name
+
+def get_athlete_today(tz_name, at=None):
+    # 用户所在时区（为空时用服务器 TIME_ZONE）的当天日期
+    tz = ZoneInfo(tz_name) if tz_name else timezone.get_default_timezone()
+    return (at or timezone.now()).astimezone(tz).date()
+
+def get_athlete_week_windows(tz_name, at=None):
+    """
+    按用户所在时区（为空时用服务器 TIME_ZONE）计算本周周一和 28 天前的零点。
+    Activity.start_date_local 存的是用户本地时间（标记为 UTC），所以返回值也是本地时间标记为 UTC，
+    可直接与 start_date_local 比较。返回 (本周周一日期, 本周开始, 28 天前)。
+    """
+    tz = ZoneInfo(tz_name) if tz_name else timezone.get_default_timezone()
+    athlete_now = (at or timezone.now()).astimezone(tz).replace(tzinfo=dt_timezone.utc)
+    week_start = get_monday_of_week(athlete_now)
+    return week_start.date(), week_start, get_days_ago(athlete_now, 28)
+
+def get_local_date_ranges(years, month=None, week=None):
+    """
+    把 年 / 月 / ISO 周 筛选换成半开区间 [start, end) 的列表，结果与 start_date_local__year / __month / __week 相同，
+    但不对列取函数，可以按 (user, start_date_local) 索引做范围查找。
+    返回值是用户本地时间标记为 UTC，与 start_date_local 一致。
+    """
+    ranges = []
+    for year in sorted(set(years)):
+        if month:
+            start = date(year, month, 1)
+            end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+        else:
+            start, end = date(year, 1, 1), date(year + 1, 1, 1)
+        if not week:
+            ranges.append((start, end))
+            continue
+        # ISO 周会跨年：日历年里的第 1 周或第 52/53 周可能属于相邻的 ISO 年
+        for iso_year in (year - 1, year, year + 1):
+            try:
+                monday = date.fromisocalendar(iso_year, week, 1)
+            except ValueError:
+                continue
+            week_start, week_end = max(start, monday), min(end, monday + timedelta(days=7))
+            if week_start < week_end:
+                ranges.append((week_start, week_end))
+    return [
+        (datetime.combine(start, time.min, tzinfo=dt_timezone.utc), datetime.combine(end, time.min, tzinfo=dt_timezone.utc))
+        for start, end in ranges
+    ]
+
 def get_next_url(request, def_next):
     next_url = request.POST.get('next')
     if not next_url:
@@ -6,10 +6,56 @@ from django.utils.translation import gettext_lazy as _
 from django.shortcuts import render, redirect
 from django.contrib.auth import get_user_model
 from django.contrib import messages
-from django.db.models.functions import Now, Cast
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from datetime import timedelta
+from .caching import get_or_compute, bump_group_data
 
 User = get_user_model()
 
+def refresh_group_counts(group_ids):
+    """
+    成员或申请变化后调用：重新统计这些群组的 member_count 和 pending_count，并作废相关缓存。
+    整体重新统计而不是加减，重复调用或并发修改也能保持准确。
+    """
+    group_ids = set(group_ids)
+    if not group_ids:
+        return
+    member_counts = User.groups.through.objects.filter(group=OuterRef('pk')).order_by().values('group').annotate(
+        count=Count('pk')
+    ).values('count')
+    pending_counts = GroupApplication.objects.filter(group=OuterRef('pk'), status='pending').order_by().values('group').annotate(
+        count=Count('pk')
+    ).values('count')
+    Group.objects.filter(pk__in=group_ids).update(
+        member_count=Coalesce(Subquery(member_counts), 0),
+        pending_count=Coalesce(Subquery(pending_counts), 0),
+    )
+    for group_id in group_ids:
+        bump_group_data(group_id)
+
+def attach_last_applications(groups, user):
+    """
+    给群组列表附上当前用户最近一次未通过的申请信息（last_application_*）。
+    每个用户对每个群组最多一条申请，一次查询取出，不用每个群组几个关联子查询；
+    天数在这里按当前时间计算，列表本身可以缓存。
+    """
+    applications = {
+        application.group_id: application
+        for application in GroupApplication.objects.filter(user=user).exclude(status='approved')
+    }
+    now = timezone.now()
+    for group in groups:
+        application = applications.get(group.pk)
+        group.last_application_id = application.pk if application else None
+        group.last_application_status = application.status if application else None
+        group.last_application_applied_at = application.applied_at if application else None
+        group.last_application_reviewed_at = application.reviewed_at if application else None
+        # 与原来数据库中 Now() - reviewed_at 的结果一致，单位是微秒
+        group.last_application_reviewed_at_days_old = (
+            (now - application.reviewed_at) // timedelta(microseconds=1) if application and application.reviewed_at else None
+        )
+
 def get_groups(request, mode: 0):
     """
     mode 0: group management list, 1: profile group
@@ -18,35 +64,12 @@ def get_groups(request, mode: 0):
     if mode == 0:
         if not request.user.is_superuser: # Admin 用户
             groups_list = Group.objects.filter(admin=request.user)
-        groups_list = groups_list.annotate(
-            member_count=Count('member', distinct=True),
-            request_count=Count('applications', distinct=True, filter=Q(applications__status='pending'))
-        )
+        # member_count / pending_count 是群组上预先统计好的字段
     elif mode == 1:
-        last_application_subquery = GroupApplication.objects.filter(
-            group=OuterRef('pk'),
-            user=request.user,
-        ).exclude(status='approved').order_by('-applied_at')[:1]
         groups_list = groups_list.annotate(
-            member_count=Count('member', distinct=True),
             is_member=Exists(
                 Group.objects.filter(pk=OuterRef('pk'), member=request.user)
             ),
-            last_application_id=Subquery(last_application_subquery.values('id')),
-            last_application_status=Subquery(last_application_subquery.values('status')),
-            last_application_applied_at=Subquery(last_application_subquery.values('applied_at')),
-            last_application_reviewed_at=Subquery(last_application_subquery.values('reviewed_at')),
-            last_application_reviewed_at_days_old=Case(
-                When(
-                    last_application_reviewed_at__isnull=False,
-                    then=Cast(
-                        Now() - F('last_application_reviewed_at'),
-                        output_field=fields.BigIntegerField()
-                    )
-                ),
-                default=None, # 如果 reviewed_at 为空，则返回 None
-                output_field=fields.BigIntegerField()
-            )
         )
     
     search_query = request.GET.get('search-input', '')
@@ -71,7 +94,7 @@ def get_groups(request, mode: 0):
         ('member_count',_('Members')),
     ]
     if mode == 0:
-        sortable_fields.append(('request_count',_('Requests')))
+        sortable_fields.append(('pending_count',_('Requests')))
     elif mode == 1:
         is_member_filter = request.GET.get('is_member_filter', '')
         if is_member_filter:
@@ -88,6 +111,16 @@ def get_groups(request, mode: 0):
     sort_field = f'-{sort_by}' if sort_order == 'desc' else sort_by
     groups_list = groups_list.order_by(sort_field)
 
+    # 成员数、申请数等统计按群组列表的代号缓存，成员或申请变化时作废
+    cache_params = {
+        'mode': mode, 'user': request.user.pk, 'superuser': request.user.is_superuser,
+        'search': search_query, 'group_type': group_type_filter, 'is_member': request.GET.get('is_member_filter', ''),
+        'sort': sort_field,
+    }
+    groups_list = get_or_compute('group_list', [('groups', 0)], cache_params, lambda: list(groups_list))
+    if mode == 1:
+        attach_last_applications(groups_list, request.user)
+
     paginator = Paginator(groups_list, 10) # 每页10行
     page_number = request.GET.get('page')
     try:
@@ -133,5 +166,6 @@ def save_group(request, group, context, next_url):
             messages.error(request, _(f"User with id '{admin_id}' does not exist."))
             return render(request, 'strava_web/group_edit.html', context)
     group.save()
+    bump_group_data(group.pk)
     messages.success(request, _("Group has been updated successfully."))
     return redirect(next_url)
@@ -5,14 +5,15 @@ from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.views import LogoutView
 from .forms import CustomUserProfileForm, CustomUserProfileAdminForm
 from django.http import JsonResponse
-from django.db.models.functions import Concat
 from django.contrib.auth.models import User
-from django.db.models import Q, Value as V, F
+from django.db.models import Q
 from django.contrib.auth import get_user_model
-from django.core.paginator import Paginator
+from .pagination import CursorPaginator
 from .utils import get_next_url
+from .caching import bump_user_data, bump_generation
+from .leaderboards import request_leaderboard_rebuild_for_user
 from django.contrib.auth.forms import SetPasswordForm
-from .models import CustomUser
+from .models import CustomUser, Activity
 
 User = get_user_model()
 
@@ -20,9 +21,16 @@ User = get_user_model()
 def personal_dashboard(request):
     # 可以从 request.user 获取个人信息
     user_groups = request.user.groups.all()
+    # 个人最好成绩按比赛距离的先后顺序显示
+    distance_order = {key: index for index, (key, _label) in enumerate(Activity.RACE_DISTANCE_CHOINCE)}
+    personal_records = sorted(
+        request.user.personal_records.select_related('activity'),
+        key=lambda record: distance_order.get(record.race_distance, len(distance_order)),
+    )
     context = {
         'user': request.user,
         'user_groups': user_groups,
+        'personal_records': personal_records,
     }
     return render(request, 'strava_web/personal_dashboard.html', context)
 
@@ -32,6 +40,11 @@ def profile_self_edit(request):
         form = CustomUserProfileForm(request.POST, instance=request.user)
         if form.is_valid():
             form.save()
+            # 性别、出生年份影响排行榜筛选，昵称显示在群组列表中
+            bump_user_data(request.user.pk)
+            bump_generation('groups')
+            if {'gender', 'birth_year'} & set(form.changed_data):
+                request_leaderboard_rebuild_for_user(request.user.pk)
             messages.success(request, _("You profile has been updated."))
             return redirect('personal_dashboard')
         else:
@@ -49,6 +62,10 @@ def profile_admin_edit(request, profile_id):
         form = CustomUserProfileAdminForm(request.POST, instance=user)
         if form.is_valid():
             form.save()
+            bump_user_data(user.pk)
+            bump_generation('groups')
+            if {'gender', 'birth_year', 'is_active'} & set(form.changed_data):
+                request_leaderboard_rebuild_for_user(user.pk)
             messages.success(request, _("You profile has been updated."))
             return redirect(next_url)
         else:
@@ -60,7 +77,7 @@ def profile_admin_edit(request, profile_id):
 
 @user_passes_test(lambda user: user.is_superuser)
 def profiles(request):
-    profiles_list_qs = CustomUser.objects.all().order_by('username')
+    profiles_list_qs = CustomUser.objects.all()
 
     # --- 搜索和筛选逻辑 ---
     search_query = request.GET.get('search', '')
@@ -99,15 +116,14 @@ def profiles(request):
         'birth_year', 'gender'
     ]
     if sort_by in valid_sort_fields:
-        if sort_order == 'desc':
-            profiles_list_qs = profiles_list_qs.order_by(f'-{sort_by}')
-        else:
-            profiles_list_qs = profiles_list_qs.order_by(sort_by)
+        sort_field, descending = sort_by, sort_order == 'desc'
+    else:
+        sort_field, descending = 'username', False
 
     # --- 分页逻辑 ---
-    paginator = Paginator(profiles_list_qs, 10) # 每页显示 10 个档案
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # 按 (排序字段, id) 键集分页，每页显示 10 个档案
+    paginator = CursorPaginator(profiles_list_qs, 10, sort_field, descending)
+    page_obj = paginator.get_page(request.GET.get('cursor'))
 
     context = {
         'page_obj': page_obj,
@@ -128,33 +144,37 @@ def home(request):
 class CustomLogoutView(LogoutView):
     next_page = 'home' #
 
+AUTOCOMPLETE_LIMIT = 20 # 选择用户时每次最多返回的条数
+
 @login_required
 def search_users_ajax(request):
-    query = request.GET.get('q', '')
-    users = User.objects.filter(is_active=True)
+    """
+    选择用户的自动补全：按用户名或昵称前缀匹配，按用户名排序，每次最多返回 AUTOCOMPLETE_LIMIT 条，
+    cursor 参数读取下一批。前缀匹配和按用户名的键集分页都能走索引，用户再多也只读这几行。
+    """
+    query = request.GET.get('q', '').strip()
+    users = User.objects.filter(is_active=True).only('id', 'username', 'first_name')
 
     if query:
         # 使用 Q 对象组合 OR 查询
         users = users.filter(
-            Q(username__icontains=query) |
-            Q(first_name__icontains=query)
-        )
-    # 按用户全名排序：username (first_name)
-    # 我们首先用 Concat 创建一个可排序的字符串
-    users = users.annotate(
-        full_name=Concat(
-            'username', V(' ('), F('first_name'), V(' '), V(')')
+            Q(username__istartswith=query) |
+            Q(first_name__istartswith=query)
         )
-    ).order_by('full_name')
+    page = CursorPaginator(users, AUTOCOMPLETE_LIMIT, 'username').get_page(request.GET.get('cursor'))
     # 准备返回的 JSON 列表
     results = [
         {
             'id': user.id,
             'text': f"{user.username} ({user.first_name})"
         }
-        for user in users
+        for user in page
     ]
-    return JsonResponse({'results': results})
+    return JsonResponse({
+        'results': results,
+        'pagination': {'more': page.has_next()},
+        'cursor': page.next_cursor,
+    })
 
 @user_passes_test(lambda user: user.is_superuser)
 def profile_password_change(request, profile_id):
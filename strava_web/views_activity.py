@@ -1,15 +1,27 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
-from .models import Activity, CustomUser
-from django.core.paginator import Paginator
+from .models import Activity, CustomUser, RACE_FILTER
+from .pagination import CursorPaginator
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.http import require_POST
 from django.http import JsonResponse
 from django.db.models import Q
 from .forms import ActivityEditForm
-from .utils import get_next_url
+from .utils import get_next_url, get_local_date_ranges
+from .rollups import get_activity_years
+from .records import refresh_personal_records
+from .search import search_activities
+from .caching import bump_user_data, get_or_compute
 from django.contrib import messages
 
+def get_choice_int(value, low, high):
+    # 筛选参数不是范围内的整数时当作未选择
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if low <= value <= high else None
+
 def select_distance(activities, request):
     selected_distance = request.GET.get('distance')
     DIST_5K = 5000 # 5 km
@@ -76,18 +88,24 @@ def activities(request, user_id=None):
     selected_week = request.GET.get('week')
     search_query = request.GET.get('search-input', '')
 
-    if selected_year:
-        user_activities = user_activities.filter(start_date_local__year=selected_year)
-    if selected_month:
-        user_activities = user_activities.filter(start_date_local__month=selected_month)
-    if selected_week:
-        user_activities = user_activities.filter(start_date_local__week=selected_week)
+    available_years = get_or_compute(
+        'activity_years', [('user', target_user.pk)], {'user': target_user.pk}, lambda: get_activity_years(target_user)
+    )
+
+    # 年/月/周筛选换成 start_date_local 的区间条件，可以走 (user, start_date_local) 索引；
+    # 只选了月或周时，在用户有活动的每一年里各取一段
+    year = get_choice_int(selected_year, 1, 9998)
+    month = get_choice_int(selected_month, 1, 12)
+    week = get_choice_int(selected_week, 1, 53)
+    if year or month or week:
+        date_filter = Q(pk__in=[])
+        for start, end in get_local_date_ranges([year] if year else available_years, month, week):
+            date_filter |= Q(start_date_local__gte=start, start_date_local__lt=end)
+        user_activities = user_activities.filter(date_filter)
     if search_query:
-        user_activities = user_activities.filter(Q(name__icontains=search_query))
+        # 活动名称走全文索引，见 search.py
+        user_activities = search_activities(user_activities, search_query)
 
-    available_years = Activity.objects.filter(user=target_user) \
-                                   .values_list('start_date_local__year', flat=True) \
-                                   .distinct().order_by('-start_date_local__year')
     available_months = [
         ('1', _('January')), ('2', _('February')), ('3', _('March')), ('4', _('April')),
         ('5', _('May')), ('6', _('June')), ('7', _('July')), ('8', _('August')),
@@ -103,26 +121,17 @@ def activities(request, user_id=None):
     # 3. Is Race Filter
     is_race_filter = request.GET.get('is_race_filter')
     if is_race_page:
-        user_activities = user_activities.filter(is_race=True)
+        user_activities = user_activities.filter(RACE_FILTER)
     elif is_race_filter:
         if is_race_filter == 'yes':
-            user_activities = user_activities.filter(is_race=True)
+            user_activities = user_activities.filter(RACE_FILTER)
         elif is_race_filter == 'no':
             user_activities = user_activities.filter(is_race=False)
 
-    selected_sort_by = request.GET.get('sort_by', 'start_date_local') # 默认按日期排序
+    # 默认按日期排序，搜索活动名称时默认按相关度排序
+    selected_sort_by = request.GET.get('sort_by', 'relevance' if search_query else 'start_date_local')
     selected_order = request.GET.get('order', 'desc') # 默认降序
 
-    if selected_order == 'desc':
-        user_activities = user_activities.order_by(f'-{selected_sort_by}')
-    else:
-        user_activities = user_activities.order_by(selected_sort_by)
-
-    # --- Pagination Logic ---
-    paginator = Paginator(user_activities, 10)  # 每页显示 10 条活动
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    
     sortable_fields = [
         ('start_date_local', _('Date')),
         ('name', _('Activity Name')),
@@ -139,7 +148,17 @@ def activities(request, user_id=None):
         )
     else:
         sortable_fields.append(('is_race',_('Is Race')))
-        
+
+    if selected_sort_by == 'relevance' and search_query:
+        selected_order = 'desc'
+    elif selected_sort_by not in [field_key for field_key, _name in sortable_fields]:
+        selected_sort_by = 'start_date_local'
+
+    # --- Pagination Logic ---
+    # 键集分页：按 (排序字段, id) 用游标翻页，深页和第一页一样快；总数最多数到 1000 条
+    paginator = CursorPaginator(user_activities, 10, selected_sort_by, selected_order == 'desc', count_limit=1000)
+    page_obj = paginator.get_page(request.GET.get('cursor'))
+
 
     context = {
         'page_obj': page_obj,
@@ -173,11 +192,14 @@ def activity_edit(request, activity_id):
     else:
         next_url = get_next_url(request, 'activities')
     if request.method == 'POST':
+        old_race_distance = activity.race_distance # 表单校验会修改 instance，先记下原来的距离
         form = ActivityEditForm(request.POST, instance=activity)
         if form.is_valid():
             if form.cleaned_data['is_race'] and (form.cleaned_data['chip_time'] is None or form.cleaned_data['chip_time'] == 0):
                 form.instance.chip_time = activity.elapsed_time
             activity = form.save()
+            refresh_personal_records(activity.user_id, [old_race_distance, activity.race_distance])
+            bump_user_data(activity.user_id)
             if is_race_page:
                 messages.success(request, _("The race has been updated successfully."))
             else:
@@ -199,6 +221,7 @@ def activity_edit(request, activity_id):
 @require_POST # 只允许 POST 请求
 def update_activity_ajax(request, activity_id):
     activity = get_object_or_404(Activity, id=activity_id, user=request.user)
+    old_race_distance = activity.race_distance # 表单校验会修改 instance，先记下原来的距离
     form = ActivityEditForm(request.POST, instance=activity)
 
     if form.is_valid():
@@ -206,6 +229,8 @@ def update_activity_ajax(request, activity_id):
         if form.cleaned_data['is_race'] and (form.cleaned_data['chip_time'] is None or form.cleaned_data['chip_time'] == 0):
             form.instance.chip_time = activity.elapsed_time # 使用原始活动的 elapsed_time
         activity = form.save()
+        refresh_personal_records(activity.user_id, [old_race_distance, activity.race_distance])
+        bump_user_data(activity.user_id)
         # 返回更新后的数据，用于前端刷新行
         return JsonResponse({
             'success': True,
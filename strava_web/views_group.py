@@ -7,9 +7,11 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import Group
 from .models import GroupApplication
 from django.utils.translation import gettext_lazy as _
-from .utils_group import get_groups, save_group
+from .utils_group import get_groups, save_group, refresh_group_counts
 from django.contrib.auth import get_user_model
 from .utils import get_next_url
+from .leaderboards import request_leaderboard_rebuild
+from .memberships import approve_applications, reject_applications, remove_members, import_roster
 
 User = get_user_model()
 
@@ -45,6 +47,7 @@ def apply_for_group(request, group_id):
         else: # 超过7天，可以重新申请
             existing_application.delete() # 删除旧的被拒绝申请以便创建新的
             GroupApplication.objects.create(user=request.user, group=group, status='pending')
+            refresh_group_counts([group.id])
             messages.success(request, _("Application to join %(group_name)s submitted, please wait for admin review.") % {'group_name': group.name})
             return redirect('group_membership_edit')
         return redirect('group_membership_edit')
@@ -52,6 +55,7 @@ def apply_for_group(request, group_id):
 
     # 创建新的申请
     GroupApplication.objects.create(user=request.user, group=group, status='pending')
+    refresh_group_counts([group.id])
     messages.success(request, _("Application to join %(group_name)s submitted, please wait for admin review.") % {'group_name': group.name})
     return redirect('group_membership_edit')
 
@@ -74,18 +78,12 @@ def review_group_application(request, application_id):
         messages.warning(request, _("The application has been processed."))
         return redirect('group_manage_members', group_id=group.id)
 
+    applications = GroupApplication.objects.filter(pk=application.pk)
     if action == 'approve':
-        application.status = 'approved'
-        application.reviewed_at = timezone.now()
-        application.reviewer = request.user
-        application.save()
-        group.members.add(application.user) # 将用户添加到群组
+        approve_applications(applications, request.user) # 将用户添加到群组
         messages.success(request, _("Approved %(username)s to join %(group_name)s.") % {'username': application.user.username,'group_name': group.name})
     elif action == 'reject':
-        application.status = 'rejected'
-        application.reviewed_at = timezone.now()
-        application.reviewer = request.user
-        application.save()
+        reject_applications(applications, request.user)
         messages.info(request, _("Rejected %(username)s from joining %(group_name)s.") % {'username': application.user.username,'group_name': group.name})
     else:
         messages.error(request, _("Invalid operation."))
@@ -98,6 +96,8 @@ def join_group(request, group_id):
     if group.is_open and group.has_dashboard and group.name != 'admin':
         if not request.user.groups.filter(id=group.id).exists():
             request.user.groups.add(group)
+            refresh_group_counts([group.id])
+            request_leaderboard_rebuild([group.id])
             messages.success(request, _("You have joined the group: %(gname)s.") % {'gname': group.name})
         else:
             messages.info(request, _("You are already in this group:%(gname)s.") % {'gname': group.name})
@@ -110,6 +110,8 @@ def leave_group(request, group_id):
     group = get_object_or_404(Group, id=group_id)
     if request.user.groups.filter(id=group.id).exists():
         request.user.groups.remove(group)
+        refresh_group_counts([group.id])
+        request_leaderboard_rebuild([group.id])
         messages.success(request, _("You have left the group: %(gname)s") % {'gname': group.name})
     else:
         messages.info(request, _("You do not belong to this group: %(gname)s") % {'gname': group.name})
@@ -126,13 +128,68 @@ def remove_from_group(request, group_id):
     if group.admin != request.user and not request.user.is_superuser:
         messages.error(request, _("You do not have permission to remove user from group: %(gname)s") % {'gname': group.name})
         return redirect('group_manage_members', group_id=group.id)
-    if request.user.groups.filter(id=group.id).exists():
-        request.user.groups.remove(group)
+    if remove_members(group, [user.id]):
         messages.success(request, _("You removed %(uname)s from the group: %(gname)s") % {'uname': user.username, 'gname': group.name})
     else:
         messages.info(request, _("User %(uname)s is not a member of the group: %(gname)s") % {'uname': user.username, 'gname': group.name})
     return redirect('group_manage_members', group_id=group.id)
 
+# 批量审核申请
+@staff_member_required
+@require_http_methods(["POST"])
+def bulk_review_group_applications(request, group_id):
+    group = get_object_or_404(Group, id=group_id)
+    if group.admin != request.user and not request.user.is_superuser:
+        messages.error(request, _("You do not have permission to review this request."))
+        return redirect('group_dashboard', group_id=group.id)
+    applications = GroupApplication.objects.filter(group=group, id__in=[pk for pk in request.POST.getlist('application_ids') if pk.isdigit()])
+    action = request.POST.get('action') # 'approve' 或 'reject'
+    if action == 'approve':
+        count = approve_applications(applications, request.user)
+        messages.success(request, _("Approved %(count)d applications to join %(group_name)s.") % {'count': count, 'group_name': group.name})
+    elif action == 'reject':
+        count = reject_applications(applications, request.user)
+        messages.info(request, _("Rejected %(count)d applications to join %(group_name)s.") % {'count': count, 'group_name': group.name})
+    else:
+        messages.error(request, _("Invalid operation."))
+    return redirect('group_manage_members', group_id=group.id)
+
+# 批量移除成员
+@staff_member_required
+@require_http_methods(["POST"])
+def bulk_remove_from_group(request, group_id):
+    group = get_object_or_404(Group, id=group_id)
+    if group.admin != request.user and not request.user.is_superuser:
+        messages.error(request, _("You do not have permission to remove user from group: %(gname)s") % {'gname': group.name})
+        return redirect('group_manage_members', group_id=group.id)
+    count = remove_members(group, [pk for pk in request.POST.getlist('user_ids') if pk.isdigit()])
+    messages.success(request, _("You removed %(count)d members from the group: %(gname)s") % {'count': count, 'gname': group.name})
+    return redirect('group_manage_members', group_id=group.id)
+
+# 按 CSV 名单（Strava ID、用户名或邮箱）批量导入成员
+@staff_member_required
+@require_http_methods(["POST"])
+def import_group_roster(request, group_id):
+    group = get_object_or_404(Group, id=group_id)
+    if group.admin != request.user and not request.user.is_superuser:
+        messages.error(request, _("You do not have permission to manage this group."))
+        return redirect('group_dashboard', group_id=group.id)
+    roster_file = request.FILES.get('roster')
+    if not roster_file:
+        messages.error(request, _("Please choose a CSV file."))
+        return redirect('group_manage_members', group_id=group.id)
+    try:
+        added, existing, not_found = import_roster(group, roster_file, request.user)
+    except (ValueError, UnicodeError) as e:
+        messages.error(request, _("Failed to import the roster: %(error)s") % {'error': e})
+        return redirect('group_manage_members', group_id=group.id)
+    messages.success(request, _("Imported roster into %(gname)s: %(added)d added, %(existing)d already members.") % {
+        'gname': group.name, 'added': added, 'existing': existing})
+    if not_found:
+        messages.warning(request, _("%(count)d users not found: %(users)s") % {
+            'count': len(not_found), 'users': ', '.join(not_found[:20]) + (' ...' if len(not_found) > 20 else '')})
+    return redirect('group_manage_members', group_id=group.id)
+
 @login_required
 @user_passes_test(is_admin_or_staff, login_url='/')
 def groups(request):
@@ -190,7 +247,7 @@ def group_manage_members(request, group_id):
     # 获取所有群组成员
     group_members = group.members.all()
     # 获取待处理的申请
-    pending_applications = GroupApplication.objects.filter(group=group, status='pending')
+    pending_applications = GroupApplication.objects.filter(group=group, status='pending').select_related('user')
     context = {
         'group': group,
         'group_members': group_members,
@@ -1,46 +1,19 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.db.models import F, Q, ExpressionWrapper, fields, OuterRef, Subquery
-from django.db.models.functions import Cast, ExtractYear
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
 from django.core.paginator import Paginator
+from .pagination import CursorPaginator, CursorPage
+from .caching import get_or_compute
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.decorators import login_required
-from .models import Group, CustomUser, Activity
+from .models import Group, CustomUser, Activity, LeaderboardEntry, PersonalRecord, RACE_FILTER
+from .leaderboards import AGE_RANGES, PERIODS, RANK_TYPES, GENDERS, request_leaderboard_rebuild
 from django.contrib import messages
 from .utils import get_next_url
 import datetime
 from django.utils import timezone
 from datetime import timedelta
-from django.db.models import Min
-
-AGE_RANGES = {
-    'all': (_('All Ages'), (None, None)),
-    '<40': (_('<40 years old'), (None, 39)),
-    '40-44': (_('40-44 years old'), (40, 44)),
-    '45-49': (_('45-49 years old'), (45, 49)),
-    '50-54': (_('50-54 years old'), (50, 54)),
-    '55-59': (_('55-59 years old'), (55, 59)),
-    '60-64': (_('60-64 years old'), (60, 64)),
-    '65-69': (_('65-69 years old'), (65, 69)),
-    '70-74': (_('70-74 years old'), (70, 74)),
-    '75-79': (_('75-79 years old'), (75, 79)),
-    '>=80': (_('>=80 years old'), (80, None)),
-}
-
-PERIODS = {
-    'weekly': _('This Week'),
-    'recent': _('4 Weeks'),
-    'ytd': _('YTD'),
-    'all_time': _('All Time'),
-}
-
-RANK_TYPES = {
-    'distance': _('Distance'),
-    'moving_time': _('Moving time'),
-    'avg_pace': _('Average Pace'),
-    'elevation_gain': _('Elevation Gain'),
-}
-
-GENDERS = {'all': _('All Genders'), 'M': _('Male'), 'F': _('Female')}
+from django.db.models import Min, Max
 
 @login_required
 def stats_ranking(request, group_id):
@@ -59,82 +32,57 @@ def stats_ranking(request, group_id):
     age_range_key = request.GET.get('age', 'all')
     rank_type = request.GET.get('rank_type', 'distance')
     
-    ranking_field_map = {
-        'distance': f'{period}_run_distance',
-        'moving_time': f'{period}_run_moving_time',
-        'avg_pace': f'{period}_run_distance',
-        'elevation_gain': f'{period}_run_elevation_gain',
-    }
-    ranking_position = list(ranking_field_map.keys()).index(rank_type) + 3
-    ranking_field = ranking_field_map.get(rank_type)
-    ranking_field2 = None
-    
-    if rank_type == 'avg_pace':
-        ranking_field2 = f'{period}_run_moving_time'
-    
-    group_members = CustomUser.objects.filter(groups=group,is_active=True)
-    if ranking_field2:
-        group_members.exclude(**{ranking_field2: None})
-    
-    if gender != 'all':
-        group_members = group_members.filter(gender=gender)
-    
-    if age_range_key != 'all' and age_range_key in AGE_RANGES:
-        group_members.exclude(Q(birth_year__isnull=True) | Q(birth_year=0))
-        start_age, end_age = AGE_RANGES[age_range_key][1]
-        current_year = datetime.date.today().year
-        q = Q()
-        if start_age is not None:
-            q &= Q(birth_year__lte=current_year - start_age)
-        if end_age is not None:
-            q &= Q(birth_year__gte=current_year - end_age)
-        group_members = group_members.filter(q)
+    # 只有这些组合预先计算过排行榜
+    period = period if period in PERIODS else 'weekly'
+    gender = gender if gender in GENDERS else 'all'
+    age_range_key = age_range_key if age_range_key in AGE_RANGES else 'all'
+    rank_type = rank_type if rank_type in RANK_TYPES else 'distance'
+    ranking_position = list(RANK_TYPES.keys()).index(rank_type) + 3
 
-    if rank_type == 'avg_pace':
-        group_members = group_members.annotate(
-            avg_pace_value=ExpressionWrapper(
-                Cast(F(ranking_field2), output_field=fields.FloatField()) / Cast(F(ranking_field), output_field=fields.FloatField()),
-                output_field=fields.FloatField()
-            )
-        ).order_by('avg_pace_value')
-    else:
-        group_members = group_members.order_by(F(ranking_field).desc(nulls_last=True))
+    # 排行榜在同步后预先算好 (LeaderboardEntry)，这里按 position 做范围读取；
+    # 还没有建好时登记重建，由后台任务完成，页面显示"正在生成"
+    is_building = not LeaderboardEntry.objects.filter(group=group).exists()
+    if is_building:
+        request_leaderboard_rebuild([group.pk])
+    # 只显示当前仍在群组中的启用用户：成员退出或被移除后，在排行榜重建前也不再显示
+    entries = LeaderboardEntry.objects.filter(
+        group=group, period=period, gender=gender, age=age_range_key, rank_type=rank_type,
+        user__groups=group, user__is_active=True,
+    )
 
-    paginator = Paginator(group_members, 10)
-    page_number = request.GET.get('page', 1)
+    paginator = Paginator(entries.select_related('user').order_by('position'), 10)
+    page_number = request.GET.get('page')
     
     total_participants = paginator.count
     current_user_rank = None
+    current_user_position = None
     
     if is_group_member:
-        user_ids = list(group_members.values_list('pk', flat=True))
-        try:
-            current_user_rank = user_ids.index(request.user.pk) + 1
-        except ValueError:
-            pass
-    
-    if is_group_member and current_user_rank:
-        page_number_to_show = (current_user_rank - 1) // 10 + 1
+        current_user_row = entries.filter(user=request.user).values_list('rank', 'position').first()
+        if current_user_row:
+            current_user_rank = current_user_row[0]
+            # 前面可能有已退出的成员被过滤掉，按过滤后的行数计算所在位置
+            current_user_position = entries.filter(position__lt=current_user_row[1]).count() + 1
+    
+    if current_user_position and not page_number:
+        # 没有指定页码时显示当前用户所在的页
+        page_number_to_show = (current_user_position - 1) // 10 + 1
     else:
-        page_number_to_show = int(page_number)
+        page_number_to_show = page_number or 1
         
-    try:
-        page_obj = paginator.page(page_number_to_show)
-    except:
-        page_obj = paginator.page(1)
+    page_obj = paginator.get_page(page_number_to_show)
     
     members_list = []
-    rank = page_obj.start_index()
-    for member in page_obj.object_list:
-        member_data = {
-            'rank': rank,
-            'username': f'{member.first_name}',
-            'is_current_user': (member.pk == request.user.pk),
-        }
-        for k, v in ranking_field_map.items():
-            member_data[k] = getattr(member, v)
-        rank += 1
-        members_list.append(member_data)
+    for entry in page_obj.object_list:
+        members_list.append({
+            'rank': entry.rank,
+            'username': f'{entry.user.first_name}',
+            'is_current_user': (entry.user_id == request.user.pk),
+            'distance': entry.distance,
+            'moving_time': entry.moving_time,
+            'avg_pace': entry.distance,
+            'elevation_gain': entry.elevation_gain,
+        })
     
     context = {
         'group': group,
@@ -153,6 +101,7 @@ def stats_ranking(request, group_id):
         'total_participants': total_participants,
         'ranking_position': ranking_position,
         'next_url': next_url,
+        'is_building': is_building,
     }
     
     return render(request, 'strava_web/stats_ranking.html', context)
@@ -170,17 +119,12 @@ def race_ranking(request, group_id):
     age_range = request.GET.get('age_range', 'all')
     fastest_only = request.GET.get('fastest_only') == 'yes'
     
-    if fastest_only:
-        queryset = Activity.objects.filter(
-            is_race=True,
-            chip_time__isnull=False,
-            user_id=OuterRef('user_id'),
-        ).select_related('user')
-    else:
-        queryset = Activity.objects.filter(
-            is_race=True,
-            chip_time__isnull=False
-        ).select_related('user')
+    # chip_time 为 0 的比赛没有有效成绩，与个人最好成绩（records._best_races）一样不参与排名，
+    # 否则限定时间段的每人最快一次会取到 0
+    queryset = Activity.objects.filter(
+        RACE_FILTER,
+        chip_time__gt=0
+    ).select_related('user')
     if group:
         queryset = queryset.filter(user__groups__pk=group_id)
     now = timezone.now()
@@ -188,15 +132,17 @@ def race_ranking(request, group_id):
         queryset = queryset.filter(start_date_local__gte=now - timedelta(days=365))
     elif date_range == 'last_6_months':
         queryset = queryset.filter(start_date_local__gte=now - timedelta(days=182))
-    elif date_range.isdigit():
-        queryset = queryset.filter(start_date_local__year=int(date_range))
+    elif date_range.isdigit() and datetime.MINYEAR <= int(date_range) < datetime.MAXYEAR:
+        # 半开区间 [1 月 1 日, 次年 1 月 1 日)，在 start_date_local 上直接用范围条件走索引
+        year_start = datetime.datetime(int(date_range), 1, 1, tzinfo=datetime.timezone.utc)
+        queryset = queryset.filter(start_date_local__gte=year_start, start_date_local__lt=year_start.replace(year=year_start.year + 1))
     if race_distance:
         queryset = queryset.filter(race_distance=race_distance)
     if gender != 'all':
         queryset = queryset.filter(user__gender=gender)
         
     if age_range != 'all' and age_range in AGE_RANGES:
-        queryset.exclude(Q(user__birth_year__isnull=True) | Q(user__birth_year=0))
+        queryset = queryset.exclude(Q(user__birth_year__isnull=True) | Q(user__birth_year=0))
         start_age, end_age = AGE_RANGES[age_range][1]
         current_year = datetime.date.today().year
         q = Q()
@@ -206,31 +152,51 @@ def race_ranking(request, group_id):
             q &= Q(user__birth_year__gte=current_year - end_age)
         queryset = queryset.filter(q)
 
-    if fastest_only:
-        fastest_times = queryset.order_by('chip_time').values('id')[:1]
-        queryset = Activity.objects.filter(
-            is_race=True,
-            chip_time__isnull=False
-        )
-        queryset = queryset.annotate(
-            min_id=Subquery(fastest_times)
-        ).filter(
-            id=F('min_id')
-        )
-    queryset = queryset.order_by('chip_time')
-    paginator = Paginator(queryset, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    
+    if fastest_only and date_range == 'all' and PersonalRecord.objects.exists():
+        # 不限时间时每人最快的一次就是个人最好成绩，直接读 PersonalRecord；
+        # 表还是空的（还没有回填）时按下面限定时间段的方式现算，否则排行榜会是空的
+        queryset = queryset.filter(personal_record__isnull=False)
+    elif fastest_only:
+        # 限定时间段时个人最好成绩可能不在范围内：在已筛选的结果上按用户分区编号，取第一名
+        # 放进子查询：分页的游标条件要在取第一名之后再过滤
+        fastest = queryset.annotate(
+            user_row_number=Window(
+                expression=RowNumber(),
+                partition_by=[F('user_id')],
+                order_by=[F('chip_time').asc(), F('start_date_local').asc(), F('pk').asc()],
+            )
+        ).filter(user_row_number=1)
+        queryset = Activity.objects.filter(pk__in=fastest.values('pk')).select_related('user')
+    # 按 (chip_time, id) 键集分页，游标里带着起始名次
+    paginator = CursorPaginator(queryset, 10, 'chip_time')
+    cursor = request.GET.get('cursor')
+
+    def get_page_rows():
+        page = paginator.get_page(cursor)
+        return list(page.object_list), page.start_index(), page.has_previous(), page.has_next()
+
+    # 按群组（全站排行用全站比赛数据）的代号缓存，成员的活动或资料变化时作废；
+    # 最近一年/半年的范围随日期变化，所以参数里带上当天日期
+    generations = [('group', group.pk)] if group else [('races', 0)]
+    cache_params = {
+        'date_range': date_range, 'race_distance': race_distance, 'gender': gender, 'age_range': age_range,
+        'fastest_only': fastest_only, 'cursor': cursor, 'today': now.date(),
+    }
+    rows, start_index, has_previous, has_next = get_or_compute('race_ranking', generations, cache_params, get_page_rows)
+    page_obj = CursorPage(rows, paginator, start_index, has_previous, has_next)
+
     # 获取所有可用的年份，用于筛选器
-    available_years = Activity.objects.filter(
-        is_race=True,
-        start_date_local__isnull=False
-    ).annotate(
-        year=ExtractYear('start_date_local')
-    ).values_list(
-        'year', flat=True
-    ).distinct().order_by('-year')
+    # 只取最早和最晚一场比赛的时间（比赛索引上的两端），不在每场比赛上取年份再去重；中间没有比赛的年份也列出
+    def get_available_years():
+        first_last = Activity.objects.filter(RACE_FILTER).aggregate(
+            first=Min('start_date_local'), last=Max('start_date_local'),
+        )
+        if first_last['first'] is None:
+            return []
+        first_year = first_last['first'].astimezone(datetime.timezone.utc).year
+        last_year = first_last['last'].astimezone(datetime.timezone.utc).year
+        return list(range(last_year, first_year - 1, -1))
+    available_years = get_or_compute('race_years', [('races', 0)], {}, get_available_years)
     
     context = {
         'page_obj': page_obj,
@@ -245,7 +211,6 @@ def race_ranking(request, group_id):
         'available_years': available_years,
         'is_race_ranking_page': True,
     }
-    print(date_range)
     return render(request, 'strava_web/race_ranking.html', context)
 
 @login_required
@@ -263,7 +228,6 @@ def group_dashboard(request, group_id):
     
     search_query = request.GET.get('search', '')
     gender_filter = request.GET.get('gender', 'all')
-    page_number = request.GET.get('page')
     members_list = group.members.filter(is_active=True)
     if search_query:
         members_list = members_list.filter(
@@ -274,14 +238,14 @@ def group_dashboard(request, group_id):
     if gender_filter != 'all':
         members_list = members_list.filter(gender=gender_filter)
 
-    # 分页
-    paginator = Paginator(members_list, 10)
-    page_obj = paginator.get_page(page_number)
+    # 分页：按 id 键集分页
+    paginator = CursorPaginator(members_list, 10)
+    page_obj = paginator.get_page(request.GET.get('cursor'))
 
     context = {
         'group': group,
         'page_obj': page_obj,
-        'members_count': group.members.count(),
+        'members_count': group.member_count,
         'search_query': search_query,
         'gender': gender_filter,
         'genders': GENDERS,
@@ -1,17 +1,22 @@
 import requests
 import json
-from datetime import timedelta
+from datetime import timedelta, datetime, timezone as dt_timezone
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.contrib.auth import login, authenticate, get_user_model
 from django.views.decorators.http import require_http_methods
+from django.views.decorators.csrf import csrf_exempt
 from django.contrib import messages
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
 from .forms import StravaUserRegistrationForm
+from .rate_limit import StravaRateLimitExceeded
+from .strava_client import strava_client
+from .models import StravaWebhookEvent, SyncJob
+from .sync_queue import enqueue_user_sync, enqueue_webhook_event
 from django.utils.translation import gettext_lazy as _
 
 User = get_user_model()
@@ -77,7 +82,7 @@ def strava_callback(request):
     }
 
     try:
-        response = requests.post(settings.STRAVA_TOKEN_URL, data=token_payload)
+        response = strava_client.post_token(token_payload, wait=False) # Web 请求中不等待，额度不足直接提示
         response.raise_for_status() # 检查 HTTP 错误
         token_data = response.json()
 
@@ -88,10 +93,7 @@ def strava_callback(request):
         token_expires_at = timezone.now() + timedelta(seconds=expires_in)
 
         # 获取更详细的 Strava 用户信息
-        athlete_info_response = requests.get(
-            f"{settings.STRAVA_API_BASE_URL}/athlete",
-            headers={'Authorization': f'Bearer {access_token}'}
-        )
+        athlete_info_response = strava_client.get("/athlete", access_token, 'athlete', wait=False)
         athlete_info_response.raise_for_status()
         athlete_info = athlete_info_response.json()
 
@@ -107,12 +109,15 @@ def strava_callback(request):
             }
         )
 
-        if not created:
+        if created:
+            # 新用户优先同步
+            enqueue_user_sync(user, priority=SyncJob.PRIORITY_HIGH)
+        else:
             # 如果用户已存在，更新其 Strava 令牌
             user.strava_access_token = access_token
             user.strava_refresh_token = refresh_token
             user.strava_token_expires_at = token_expires_at
-            user.save()
+            user.save(update_fields=['strava_access_token', 'strava_refresh_token', 'strava_token_expires_at'])
 
         # 对于通过 SSO 注册/登录的用户，设置密码为不可用 (如果他们没有手动设置过)
         if not user.has_usable_password():
@@ -134,6 +139,9 @@ def strava_callback(request):
             messages.error(request, _("Strava login failed, please try again."))
             return HttpResponseRedirect(reverse('login'))
 
+    except StravaRateLimitExceeded:
+        messages.error(request, _("Strava is busy right now, please try again in a few minutes."))
+        return HttpResponseRedirect(reverse('login'))
     except requests.exceptions.RequestException as e:
         messages.error(request, _("Connection to Strava failed: %(error_message)s") % {'error_message': e})
         return HttpResponseRedirect(reverse('login'))
@@ -144,6 +152,46 @@ def strava_callback(request):
         messages.error(request, _("Unknown error: %(error_message)s") % {'error_message': e})
         return HttpResponseRedirect(reverse('login'))
 
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def strava_webhook(request):
+    """
+    Strava 推送订阅回调。
+    GET: 订阅验证握手，校验 verify_token 后原样返回 hub.challenge。
+    POST: 活动创建/更新/删除、用户取消授权事件，只入队（高优先级 SyncJob）不做处理，保证在 2 秒内返回 200。
+    事件没有签名，只接受本站订阅（STRAVA_WEBHOOK_SUBSCRIPTION_ID）的事件；删除和取消授权在处理时
+    还会再向 Strava 确认，见 services.process_webhook_event。
+    """
+    if request.method == 'GET':
+        verify_token = settings.STRAVA_WEBHOOK_VERIFY_TOKEN
+        if request.GET.get('hub.mode') != 'subscribe' or not verify_token \
+                or request.GET.get('hub.verify_token') != verify_token:
+            return HttpResponseForbidden()
+        return JsonResponse({'hub.challenge': request.GET.get('hub.challenge', '')})
+
+    try:
+        event = json.loads(request.body)
+        subscription_id = settings.STRAVA_WEBHOOK_SUBSCRIPTION_ID
+        if not subscription_id or int(event['subscription_id']) != subscription_id:
+            return HttpResponseForbidden()
+        owner = User.objects.filter(strava_id=int(event['owner_id'])).first()
+        if owner is None:
+            # 不是本站用户的事件，直接确认
+            return HttpResponse()
+        with transaction.atomic():
+            webhook_event = StravaWebhookEvent.objects.create(
+                object_type=event['object_type'],
+                object_id=int(event['object_id']),
+                aspect_type=event['aspect_type'],
+                owner_id=int(event['owner_id']),
+                updates=event.get('updates') or {},
+                event_time=datetime.fromtimestamp(int(event['event_time']), tz=dt_timezone.utc),
+            )
+            enqueue_webhook_event(webhook_event, owner)
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest()
+    return HttpResponse()
+
 @login_required
 def register_user(request):
     """